@@ -5,9 +5,16 @@ from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_socketio import SocketIO
-from flask_session import Session
 
 from config import Config
+from .cache import LRUCache
+from .connections import ConnectionStates
+from .fanout import FanOutExecutor
+from .offload import LoopLagMonitor, ThreadOffload
+from .prefix_index import PrefixIndex
+from .profiling import StatementProfiler
+from .registry import SocketRegistry
+from .sessions import SessionStore
 
 import os
 
@@ -15,10 +22,21 @@ import os
 celery = Celery(__name__)
 database = SQLAlchemy()
 login_manager = LoginManager()
-flask_session = Session()
+session_store = SessionStore()
 mail = Mail()
 migrate = Migrate()
 socket_io = SocketIO(manage_session=False, async_mode='gevent')
+socket_registry = SocketRegistry()
+connection_states = ConnectionStates()
+chat_updates = FanOutExecutor('chat_updates')
+username_prefixes = PrefixIndex()
+chat_name_cache = LRUCache('chat_name_cache')
+user_principal_cache = LRUCache('user_principal_cache')
+auth_token_cache = LRUCache('auth_token_cache')
+credentials_cache = LRUCache('credentials_cache')
+cpu_offload = ThreadOffload('cpu_offload')
+loop_lag_monitor = LoopLagMonitor()
+statement_profiler = StatementProfiler()
 wsgi_application = Flask(__name__)
 
 
@@ -43,8 +61,7 @@ def create_app():
     login_manager.init_app(wsgi_application)
     mail.init_app(wsgi_application)
     migrate.init_app(wsgi_application, database)
-    socket_io.init_app(wsgi_application)
-    flask_session.init_app(wsgi_application)
+    session_store.init_app(wsgi_application)
 
     from .auth import auth as auth_blueprint
     from .auth.before_auth_request import before_auth_request
@@ -62,6 +79,23 @@ def create_app():
     from .main import main as main_blueprint
     wsgi_application.register_blueprint(main_blueprint)
 
+    # after the blueprints: event handlers registered
+    # before the first init_app are kept for the next ones
+    socket_io.init_app(wsgi_application,
+                       message_queue=(wsgi_application
+                                      .config['SOCKETIO_MESSAGE_QUEUE']))
+    socket_registry.init_app(wsgi_application)
+    connection_states.init_app(wsgi_application)
+    chat_updates.init_app(wsgi_application)
+    username_prefixes.init_app(wsgi_application)
+    chat_name_cache.init_app(wsgi_application)
+    user_principal_cache.init_app(wsgi_application)
+    auth_token_cache.init_app(wsgi_application)
+    credentials_cache.init_app(wsgi_application)
+    cpu_offload.init_app(wsgi_application)
+    loop_lag_monitor.init_app(wsgi_application)
+    statement_profiler.init_app(wsgi_application)
+
     return wsgi_application
 
 
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__)
 
-from . import authentication, chats, errors, messages
+from . import authentication, chats, errors, messages, monitoring
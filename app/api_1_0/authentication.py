@@ -29,12 +29,12 @@ def verify_password(email_or_token, password):
         g.current_user = User.verify_auth_token(email_or_token)
         g.token_used = True
         return g.current_user is not None
-    user = User.query.filter_by(email=email_or_token).first()
-    if not user:
+    user = User.verify_credentials(email_or_token, password)
+    if user is None:
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    return True
 
 
 @api.route('/token')
@@ -1,5 +1,6 @@
 from . import api
 from .authentication import auth
+from ..models import Chat
 
 from flask import abort, current_app, g, jsonify, request, url_for
 
@@ -31,7 +32,7 @@ def get_chats():
 def get_chat(chat_id):
     chat = (g.current_user
             .get_available_chats_query()
-            .filter_by(id=chat_id).first())
+            .filter(Chat.id == chat_id).first())
     if not chat:
         abort(404)
     return jsonify(chat.to_json(g.current_user))
\ No newline at end of file
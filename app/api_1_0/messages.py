@@ -1,51 +1,52 @@
 from . import api, errors
 from .authentication import auth
 from .. import database
-from ..models import Message, User
+from ..models import Chat, Message, User
 
-from flask import abort, current_app, g, jsonify, request, url_for
+from flask import abort, g, jsonify, request, url_for
 
 
 @api.route('/chats/<int:chat_id>/messages')
 @auth.login_required
 def get_messages(chat_id):
-    page = request.args.get('page', 1, type=int)
+    before = request.args.get('before')
+    after = request.args.get('after')
     prev_page = None
     next_page = None
     chat = (g.current_user
             .get_available_chats_query()
-            .filter_by(id=chat_id).first())
+            .filter(Chat.id == chat_id).first())
     if not chat:
         abort(404)
-    pagination = (chat
-                  .messages
-                  .paginate(page, 
-                            current_app.config['MESSAGES_PER_PAGE'],
-                            error_out=False))
-    if pagination.has_prev:
-        prev_page = url_for('api.get_messages', 
-                            chat_id=chat_id, 
-                            page=page-1, 
-                            _external=True)
-    if pagination.has_next:
-        next_page = url_for('api.get_messages', 
-                            chat_id=chat_id, 
-                            page=page+1, 
-                            _external=True)
-    messages = [message.to_json(g.current_user) 
-                for message 
-                in pagination.items]
-    return jsonify({'messages': messages,
-                    'previous': prev_page,
-                    'next': next_page,
-                    'count': pagination.total})
+    messages, has_more = Message.get_page(chat.messages, 
+                                          before=before, 
+                                          after=after)
+    if messages:
+        if after is not None or has_more:
+            prev_page = url_for('api.get_messages', 
+                                chat_id=chat_id, 
+                                before=messages[0].get_cursor(), 
+                                _external=True)
+        if before is not None or (after is not None and has_more):
+            next_page = url_for('api.get_messages', 
+                                chat_id=chat_id, 
+                                after=messages[-1].get_cursor(), 
+                                _external=True)
+    messages = Message.to_json_list(messages, g.current_user, chat)
+    response = {'messages': messages,
+                'previous': prev_page,
+                'next': next_page}
+    # counting scans the chat's whole history, so it is opt-in
+    if request.args.get('count', 0, type=int):
+        response['count'] = chat.messages.count()
+    return jsonify(response)
 
 @api.route('/chats/<int:chat_id>/messages/<int:message_id>')
 @auth.login_required
 def get_message(chat_id, message_id):
     chat = (g.current_user
             .get_available_chats_query()
-            .filter_by(id=chat_id).first())
+            .filter(Chat.id == chat_id).first())
     if not chat:
         abort(404)
     message = chat.messages.filter_by(id=message_id).first()
@@ -59,7 +60,7 @@ def get_message(chat_id, message_id):
 def new_message(chat_id):
     chat = (g.current_user
             .get_available_chats_query()
-            .filter_by(id=chat_id).first())
+            .filter(Chat.id == chat_id).first())
     if not chat:
         abort(404)
     recipient = None
@@ -74,10 +75,11 @@ def new_message(chat_id):
     if not message:
         return errors.generate_error(errors.CONFLICT,
                                      'cannot process client data')
-    message.sender = g.current_user
+    message.sender = g.current_user.get_user()
     message.chat = chat
     message.recipient = recipient
     database.session.add(message)
+    chat.increment_unread_counts(g.current_user)
     database.session.commit()
     return (jsonify(message.to_json(g.current_user)), 
             201,
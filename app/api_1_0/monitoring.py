@@ -0,0 +1,15 @@
+from flask import g
+
+from . import api, errors
+from ..metrics import metrics
+from ..models import Permission
+
+
+@api.route('/metrics')
+def get_metrics():
+    if not g.current_user.has_permission(Permission.ADMINISTRATION):
+        return errors.generate_error(errors.FORBIDDEN,
+                                     'Administrators only')
+    return (metrics.to_prometheus(),
+            200,
+            {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -3,7 +3,7 @@ from flask import request, url_for
 from flask_login import login_user, logout_user, login_required, current_user
 from smtplib import SMTPAuthenticationError
 from . import auth
-from .. import celery, database
+from .. import celery, database, username_prefixes
 from .decorators import disable_if_user_confirmed
 from .forms import LoginForm, RegistrationForm
 from ..tasks import send_email_task
@@ -25,6 +25,8 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         if user is not None and user.verify_password(form.password.data):
+            # saves the password hashed again with the current policy
+            database.session.commit()
             login_user(user, form.remember_me.data)
             next_page = request.args.get('next')
             if next_page is None or not next_page.startswith('/'):
@@ -64,6 +66,7 @@ def signup():
             user.password = form.password.data
             database.session.add(user)
             database.session.commit()
+            username_prefixes.add(user.id, user.username)
             token = user.generate_confirmation_token()
             subject = (current_app.config['MAIL_SUBJECT_PREFIX'] 
                        + 'Registration confirmation')
@@ -82,6 +85,7 @@ def signup():
                                            link=current_user.email)))
             return redirect(url_for('main.index'))
         except SMTPAuthenticationError:
+            username_prefixes.remove(user.id, user.username)
             database.session.delete(user)
             database.session.commit()
             error_message = 'Server can\'t send the email, '\
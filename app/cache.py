@@ -0,0 +1,148 @@
+import time
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+from .metrics import metrics
+
+
+class LRUCache:
+    """
+    Process-local mapping of at most max_size entries
+    evicting the least recently used entry when full.
+    Entries expire ttl seconds after they are set
+    (they never expire if ttl is None).
+    Keys are tuples whose first item is a group (e.g. a chat id),
+    so all the entries of a group can be invalidated at once.
+
+    The size is read from the configuration key <NAME>_SIZE,
+    the ttl from <NAME>_TTL if present.
+    Reports the metrics <name>_hits, <name>_misses, <name>_evictions,
+    <name>_size and <name>_hit_ratio (hits over lookups so far).
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    get(key, default=None)
+
+    set(key, value, ttl=None)
+
+    invalidate(key)
+
+    invalidate_group(group)
+
+    clear()
+    """
+    def __init__(self, name, max_size=10000, ttl=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.groups = defaultdict(set)
+        self.lock = Lock()
+        self.hits = metrics.counter(f'{name}_hits', 'Cache lookups found')
+        self.misses = metrics.counter(f'{name}_misses',
+                                      'Cache lookups not found')
+        self.evictions = metrics.counter(f'{name}_evictions',
+                                         'Entries evicted from a full cache')
+        self.size = metrics.gauge(f'{name}_size', 'Entries in the cache')
+        self.hit_ratio = metrics.gauge(f'{name}_hit_ratio',
+                                       'Share of cache lookups found')
+
+    def init_app(self, app):
+        self.max_size = app.config[f'{self.name.upper()}_SIZE']
+        self.ttl = app.config.get(f'{self.name.upper()}_TTL', self.ttl)
+        self.clear()
+
+    def get(self, key, default=None):
+        """
+        Return the value of the given key
+        marking it as recently used.
+
+        :param key: tuple (group, ...)
+        :param default: returned if the key is not cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None
+                    and entry[1] is not None
+                    and entry[1] <= time.monotonic()):
+                del self.entries[key]
+                self.discard_from_group(key)
+                self.size.set(len(self.entries))
+                entry = None
+            if entry is None:
+                self.misses.inc()
+                value = default
+            else:
+                self.entries.move_to_end(key)
+                self.hits.inc()
+                value = entry[0]
+            lookups = self.hits.value + self.misses.value
+            self.hit_ratio.set(self.hits.value / lookups)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store the given value evicting
+        the least recently used entry if the cache is full.
+
+        :param key: tuple (group, ...)
+        :param value: any object
+        :param ttl: seconds until the entry expires
+                    if shorter than the cache's ttl
+        """
+        if self.ttl is not None:
+            ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self.lock:
+            if self.max_size <= 0:
+                return
+            expires = None if ttl is None else time.monotonic() + ttl
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            self.groups[key[0]].add(key)
+            while len(self.entries) > self.max_size:
+                evicted, _ = self.entries.popitem(last=False)
+                self.discard_from_group(evicted)
+                self.evictions.inc()
+            self.size.set(len(self.entries))
+
+    def invalidate(self, key):
+        """
+        Drop the given key if cached.
+
+        :param key: tuple (group, ...)
+        """
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.discard_from_group(key)
+            self.size.set(len(self.entries))
+
+    def invalidate_group(self, group):
+        """
+        Drop all the keys of the given group.
+
+        :param group: first item of the keys
+        """
+        with self.lock:
+            for key in self.groups.pop(group, ()):
+                self.entries.pop(key, None)
+            self.size.set(len(self.entries))
+
+    def clear(self):
+        """
+        Drop all entries, metrics are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.groups.clear()
+            self.size.set(0)
+
+    def discard_from_group(self, key):
+        keys = self.groups.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.groups[key[0]]
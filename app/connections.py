@@ -0,0 +1,244 @@
+"""
+State of every open socket, kept apart from the session:
+the chat chosen in a browser tab belongs to the tab's connection,
+not to the cookie shared by all the tabs.
+The chat last chosen by a user is also kept per user,
+so the index page and the next connection
+(e.g. after reloading the page) start with it.
+"""
+
+
+class ConnectionState:
+    """
+    State of a single socket connection.
+    """
+    __slots__ = ('user_id', 'current_chat_id')
+
+    def __init__(self, user_id, current_chat_id=None):
+        self.user_id = user_id
+        self.current_chat_id = current_chat_id
+
+    def __eq__(self, other):
+        return (isinstance(other, ConnectionState)
+                and self.user_id == other.user_id
+                and self.current_chat_id == other.current_chat_id)
+
+    def __repr__(self):
+        return (f'ConnectionState(user_id={self.user_id}, '
+                f'current_chat_id={self.current_chat_id})')
+
+    def to_dict(self):
+        """
+        :returns: dictionary of strings
+        """
+        return {'user_id': str(self.user_id),
+                'current_chat_id': ('' if self.current_chat_id is None
+                                    else str(self.current_chat_id))}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: dictionary returned by to_dict
+        :returns: ConnectionState instance
+        """
+        current_chat_id = data.get('current_chat_id')
+        return cls(int(data['user_id']),
+                   int(current_chat_id) if current_chat_id else None)
+
+
+class MemoryBackend:
+    """
+    Connection state backend keeping the states
+    in dictionaries of the current process.
+    Suitable for a single worker and for tests.
+
+
+    Methods defined here:
+
+    get(sid)
+
+    set(sid, state)
+
+    delete(sid)
+
+    get_last_chat_id(user_id)
+
+    set_last_chat_id(user_id, chat_id)
+    """
+    def __init__(self):
+        self.states = {}
+        self.last_chat_ids = {}
+
+    def get(self, sid):
+        state = self.states.get(sid)
+        return None if state is None else ConnectionState(state.user_id,
+                                                          state.current_chat_id)
+
+    def set(self, sid, state):
+        self.states[sid] = ConnectionState(state.user_id,
+                                           state.current_chat_id)
+
+    def delete(self, sid):
+        self.states.pop(sid, None)
+
+    def get_last_chat_id(self, user_id):
+        return self.last_chat_ids.get(user_id)
+
+    def set_last_chat_id(self, user_id, chat_id):
+        if chat_id is None:
+            self.last_chat_ids.pop(user_id, None)
+        else:
+            self.last_chat_ids[user_id] = chat_id
+
+
+class RedisBackend:
+    """
+    Connection state backend keeping a Redis hash per socket
+    and the last chosen chat per user, shared by all workers and hosts.
+    The keys expire after ttl seconds without changes,
+    so states left by a killed worker do not stay forever.
+
+
+    Methods defined here:
+
+    get(sid)
+
+    set(sid, state)
+
+    delete(sid)
+
+    get_last_chat_id(user_id)
+
+    set_last_chat_id(user_id, chat_id)
+    """
+    def __init__(self, url, ttl, key_prefix='connection_state'):
+        import redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+
+    def get_key(self, sid):
+        return f'{self.key_prefix}:{sid}'
+
+    def get_user_key(self, user_id):
+        return f'{self.key_prefix}:user:{user_id}'
+
+    def get(self, sid):
+        data = self.client.hgetall(self.get_key(sid))
+        return ConnectionState.from_dict(data) if data else None
+
+    def set(self, sid, state):
+        key = self.get_key(sid)
+        (self
+         .client
+         .pipeline()
+         .hset(key, mapping=state.to_dict())
+         .expire(key, self.ttl)
+         .execute())
+
+    def delete(self, sid):
+        self.client.delete(self.get_key(sid))
+
+    def get_last_chat_id(self, user_id):
+        chat_id = self.client.get(self.get_user_key(user_id))
+        return int(chat_id) if chat_id else None
+
+    def set_last_chat_id(self, user_id, chat_id):
+        key = self.get_user_key(user_id)
+        if chat_id is None:
+            self.client.delete(key)
+        else:
+            self.client.set(key, chat_id, ex=self.ttl)
+
+
+class ConnectionStates:
+    """
+    Per-connection state of the open sockets.
+    The backend is chosen by the CONNECTION_STATE_URL setting:
+    Redis if the URL is given, the current process' memory otherwise.
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    open(user_id, sid)
+
+    close(sid)
+
+    get(sid)
+
+    get_current_chat_id(user_id, sid=None)
+
+    set_current_chat_id(user_id, sid, chat_id)
+    """
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('CONNECTION_STATE_URL')
+        if url:
+            self.backend = RedisBackend(url,
+                                        app.config['CONNECTION_STATE_TTL'])
+        else:
+            self.backend = MemoryBackend()
+
+    def open(self, user_id, sid):
+        """
+        Create the state of a new connection
+        starting with the chat last chosen by the user.
+
+        :param user_id: integer
+        :param sid: string
+        :returns: ConnectionState instance
+        """
+        state = ConnectionState(user_id,
+                                self.backend.get_last_chat_id(user_id))
+        self.backend.set(sid, state)
+        return state
+
+    def close(self, sid):
+        """
+        Drop the state of the given connection.
+
+        :param sid: string
+        """
+        self.backend.delete(sid)
+
+    def get(self, sid):
+        """
+        Return the state of the given connection.
+
+        :param sid: string
+        :returns: ConnectionState instance or None if unknown
+        """
+        return self.backend.get(sid)
+
+    def get_current_chat_id(self, user_id, sid=None):
+        """
+        Return the chat chosen in the given connection,
+        the chat last chosen by the user without a connection.
+
+        :param user_id: integer
+        :param sid: string or None
+        :returns: integer or None
+        """
+        if sid is not None:
+            state = self.backend.get(sid)
+            if state is not None and state.user_id == user_id:
+                return state.current_chat_id
+        return self.backend.get_last_chat_id(user_id)
+
+    def set_current_chat_id(self, user_id, sid, chat_id):
+        """
+        Choose the given chat in the given connection,
+        it becomes the chat last chosen by the user.
+
+        :param user_id: integer
+        :param sid: string
+        :param chat_id: integer or None if no chat is chosen
+        """
+        self.backend.set(sid, ConnectionState(user_id, chat_id))
+        self.backend.set_last_chat_id(user_id, chat_id)
@@ -0,0 +1,130 @@
+import gevent, logging, time
+from collections import deque
+from gevent.event import Event
+from gevent.pool import Pool
+
+from .metrics import metrics
+
+
+class FanOutExecutor:
+    """
+    Runs tasks in a bounded pool of greenlets.
+    At most 'size' tasks run at the same time,
+    at most 'max_pending' tasks wait for a free greenlet,
+    a caller submitting a task to a full queue waits
+    until a task leaves the queue (no task is ever dropped).
+    Exceptions raised by tasks are logged
+    by the logger of the application given to init_app.
+
+    Reports the metrics <name>_pending, <name>_in_flight,
+    <name>_completed, <name>_failed,
+    <name>_wait_seconds and <name>_run_seconds.
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    configure(size, max_pending)
+
+    submit(function, *args, **kwargs)
+
+    join(timeout=None)
+    """
+    def __init__(self, name, app=None):
+        self.name = name
+        self.app = None
+        self.pending = deque()
+        self.not_full = Event()
+        self.not_full.set()
+        self.pending_gauge = metrics.gauge(f'{name}_pending',
+                                           'Tasks waiting for a greenlet')
+        self.in_flight_gauge = metrics.gauge(f'{name}_in_flight',
+                                             'Tasks running')
+        self.completed = metrics.counter(f'{name}_completed',
+                                         'Tasks finished')
+        self.failed = metrics.counter(f'{name}_failed',
+                                      'Tasks finished with an exception')
+        self.wait_seconds = metrics.histogram(f'{name}_wait_seconds',
+                                              'Time from submission '
+                                              'to start')
+        self.run_seconds = metrics.histogram(f'{name}_run_seconds',
+                                             'Time from start to finish')
+        self.configure(10, 1000)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.configure(app.config['FANOUT_POOL_SIZE'],
+                       app.config['FANOUT_MAX_PENDING'])
+
+    def configure(self, size, max_pending):
+        """
+        Set the limits.
+        Running tasks are not affected, waiting ones are dropped.
+
+        :param size: maximum number of running tasks
+        :param max_pending: maximum number of waiting tasks
+        """
+        self.pool = Pool(size)
+        self.max_pending = max_pending
+        self.pending.clear()
+        self.pending_gauge.set(0)
+        self.not_full.set()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Schedule function(*args, **kwargs),
+        wait for a free place in the queue if it is full.
+
+        :param function: callable
+        """
+        while len(self.pending) >= self.max_pending:
+            self.not_full.clear()
+            self.not_full.wait()
+        self.pending.append((function, args, kwargs, time.monotonic()))
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Start waiting tasks while there are free greenlets.
+        """
+        while self.pending and self.pool.free_count() > 0:
+            task = self.pending.popleft()
+            self.not_full.set()
+            greenlet = self.pool.spawn(self.run, task)
+            greenlet.link(lambda _: self.dispatch())
+        self.pending_gauge.set(len(self.pending))
+
+    def run(self, task):
+        function, args, kwargs, submitted = task
+        started = time.monotonic()
+        self.wait_seconds.observe(started - submitted)
+        self.in_flight_gauge.inc()
+        try:
+            function(*args, **kwargs)
+            self.completed.inc()
+        except Exception:
+            self.failed.inc()
+            logger = (logging.getLogger(__name__) if self.app is None
+                      else self.app.logger)
+            logger.exception(f'{self.name} task {function!r} failed')
+        finally:
+            self.in_flight_gauge.dec()
+            self.run_seconds.observe(time.monotonic() - started)
+
+    def join(self, timeout=None):
+        """
+        Wait until there are no waiting and no running tasks.
+
+        :param timeout: seconds or None to wait forever
+        :returns: True if all tasks finished, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending or self.pool.free_count() < self.pool.size:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            self.pool.join(timeout=0.01)
+            gevent.sleep(0)
+        return True
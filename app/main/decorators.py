@@ -1,8 +1,82 @@
+import json, time
+from collections import namedtuple
 from functools import wraps
 from flask import redirect, request, url_for
 from flask_login import current_user
 from flask_socketio import disconnect
 
+from ..metrics import metrics
+from .. import statement_profiler
+
+
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+
+def get_event_name(default):
+    """
+    Return the name of the socket event being handled.
+
+    :param default: name returned outside of a socket event
+    :returns: string
+    """
+    return getattr(request, 'event', {}).get('message', default)
+
+
+EventMetrics = namedtuple('EventMetrics',
+                          ('seconds', 'payload_bytes', 'errors'))
+event_metrics = {}
+
+
+def get_event_metrics(event_name):
+    """
+    Return the metrics of the socket event with the given name.
+
+    :param event_name: string
+    :returns: EventMetrics instance
+    """
+    if event_name not in event_metrics:
+        labels = {'event': event_name}
+        event_metrics[event_name] = EventMetrics(
+            metrics.histogram('socket_event_seconds',
+                              'Socket event handling time',
+                              labels=labels),
+            metrics.histogram('socket_event_payload_bytes',
+                              'Size of socket event arguments in JSON',
+                              SIZE_BUCKETS,
+                              labels=labels),
+            metrics.counter('socket_event_errors',
+                            'Socket events failed with an exception',
+                            labels=labels))
+    return event_metrics[event_name]
+
+
+def instrumented(f):
+    """
+    Record the latency, the payload size
+    and uncaught exceptions of a socket event handler
+    in the metrics socket_event_seconds, socket_event_payload_bytes
+    and socket_event_errors labelled with the event's name,
+    its SQL statements are profiled as 'socket:<event>'
+    (see profiling.StatementProfiler).
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        event_name = get_event_name(f.__name__)
+        seconds, payload_bytes, errors = get_event_metrics(event_name)
+        if args:
+            payload_bytes.observe(len(json.dumps(args, default=str)))
+        started = time.monotonic()
+        statement_profiler.start(f'socket:{event_name}')
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            seconds.observe(time.monotonic() - started)
+            statement_profiler.finish()
+    return decorated
+
 
 def authenticated_only(f):
     @wraps(f)
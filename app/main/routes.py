@@ -1,29 +1,33 @@
-import gevent, traceback
-from gevent.pool import Pool
 from datetime import datetime, timezone
-from flask import copy_current_request_context, current_app
+from flask import current_app
 from flask import escape, redirect, url_for
-from flask import render_template, request, session
+from flask import render_template, request
 from flask_login import current_user, login_required
+from flask_socketio import join_room
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import NotFound
 
 from . import main
 from .decorators import authenticated_only, disable_if_unconfirmed
+from .decorators import get_event_metrics, get_event_name, instrumented
 from .forms import ChatSearchForm, MessageForm, UserSearchForm
-from .. import database, socket_io
-from ..models import Chat, Message, User
-
-
-USER_WEBSOCKET_MAPPING = dict()
-CHAT_UPDATES_POOL = Pool()
+from .. import chat_updates, connection_states, database
+from .. import socket_io, socket_registry
+from ..models import Chat, ChatReadState, Message, User, UserChatTable
 
 
 def log_exception():
-    traceback.print_exc()
+    """
+    Log the exception handled by a socket event handler
+    and count it in the event's socket_event_errors metric.
+    """
+    event_name = get_event_name('unknown')
+    get_event_metrics(event_name).errors.inc()
+    current_app.logger.exception(f'Socket event {event_name} failed')
 
 
 @socket_io.on('search_users')
+@instrumented
 @authenticated_only
 def search_users(data):
     try:
@@ -31,38 +35,46 @@ def search_users(data):
         username = username[:current_app.config['MAX_STRING_LENGTH']]
         page_number = int(data['page_number'])
         users = (current_user
-                 .search_users_query(username, 
-                                     current_user.get_other_users_query())
-                 .paginate(page_number,
-                           current_app.config['USERS_PER_PAGE'],
-                           error_out=False)
-                 .items)
-        users_dict_list = [{'username': user.username,
-                            'user_id': user.id} for user in users]
+                 .search_users_page(username,
+                                    page_number,
+                                    current_app.config['USERS_PER_PAGE']))
+        users_dict_list = [{'username': found_username,
+                            'user_id': user_id}
+                           for user_id, found_username in users]
         socket_io.emit('search_users',
                        {'found_users': users_dict_list,
                         'page_number': str(page_number)},
-                       room=USER_WEBSOCKET_MAPPING[current_user.id])
+                       room=request.sid)
     except (OverflowError, ValueError):
         log_exception()
 
 
 @socket_io.on('load_messages')
+@instrumented
 @authenticated_only
 def load_messages(data):
     try:
         chat_id = int(data['chat_id'])
+        before = data.get('before')
+        after = data.get('after')
         chat = Chat.query.get_or_404(chat_id)
-        message_dict_list = current_user.get_messages(chat)
+        message_dict_list, has_more = current_user.get_messages(chat,
+                                                                before=before,
+                                                                after=after)
         socket_io.emit('load_messages',
                         {'messages': message_dict_list,
+                         'chat_id': str(chat.id),
+                         'before': before,
+                         'after': after,
+                         'has_more': has_more,
                          'current_username': current_user.username},
-                        room=USER_WEBSOCKET_MAPPING[current_user.id])
+                        room=request.sid)
     except (AttributeError, OverflowError, ValueError, NotFound):
         log_exception()
 
 
 @socket_io.on('load_users')
+@instrumented
 @authenticated_only
 def load_users(data):
     try:
@@ -81,69 +93,79 @@ def load_users(data):
         socket_io.emit('load_users',
                        {'added_users': added_users_dict_list,
                         'clear_area': clear_area},
-                       room=USER_WEBSOCKET_MAPPING[current_user.id])
+                       room=request.sid)
     except (ValueError, OverflowError):
         log_exception()
 
 
 @socket_io.on('search_chats')
+@instrumented
 @authenticated_only
 def search_chats(data):
     try:
         chat_name = str(escape(data['chat_name']))
         chat_name = chat_name[:current_app.config['MAX_STRING_LENGTH']]
-        page_number = int(data['page_number'])
-
+        page_number = max(int(data['page_number']), 1)
+        chats_per_page = current_app.config['CHATS_PER_PAGE']
         chats = (Chat.search_chats_query(chat_name, current_user)
-                 .paginate(page_number, 
-                           current_app.config['CHATS_PER_PAGE'],
-                           error_out=False)
-                 .items)
-        chats_dict_list = [{'chat_name': chat.get_name(current_user),
-                            'chat_id': str(chat.id)}
-                            for chat 
+                 .with_entities(Chat.id, ChatReadState.display_name)
+                 .limit(chats_per_page)
+                 .offset((page_number - 1) * chats_per_page)
+                 .all())
+        chats_dict_list = [{'chat_name': name,
+                            'chat_id': str(chat_id)}
+                            for chat_id, name
                             in chats]
         socket_io.emit('search_chats',
                        {'found_chats': chats_dict_list,
                         'page_number': str(page_number)},
-                       room=USER_WEBSOCKET_MAPPING[current_user.id])
+                       room=request.sid)
     except (LookupError, ValueError, OverflowError):
         log_exception()
 
 
 @socket_io.on('load_chats')
+@instrumented
 @authenticated_only
 def load_chats(data):
     try:
-        page_number = int(data['page_number'])
-        chats = (current_user.get_available_chats_query()
-                 .paginate(page_number, 
-                           current_app.config['CHATS_PER_PAGE'],
-                           error_out=False)
-                 .items)
-        chats_dict_list = [{'chat_name': chat.get_name(current_user),
-                            'chat_id': str(chat.id)}
-                            for chat
-                            in chats]
+        page_number = max(int(data['page_number']), 1)
+        chats_per_page = current_app.config['CHATS_PER_PAGE']
+        chat_summaries = (current_user
+                          .get_chat_summaries_query()
+                          .limit(chats_per_page)
+                          .offset((page_number - 1) * chats_per_page)
+                          .all())
+        chats_dict_list = [{'chat_name': name,
+                            'chat_id': str(chat.id),
+                            'unread_messages_count': unread_messages_count}
+                            for chat, name, unread_messages_count
+                            in chat_summaries]
         socket_io.emit('load_chats', 
                        {'chats': chats_dict_list,
                         'page_number': str(page_number)},
-                       room=USER_WEBSOCKET_MAPPING[current_user.id])
+                       room=request.sid)
     except (LookupError, ValueError, OverflowError):
         log_exception()
 
 
 @socket_io.on('remove_chat')
+@instrumented
 @authenticated_only
 def remove_chat(data):
     try:
         chat_id = int(data['chat_id'])
         chat = Chat.query.get_or_404(chat_id)
-        session[(current_user.id, 'current_chat_id')] = None
+        if (connection_states.get_current_chat_id(current_user.id,
+                                                  request.sid)
+                == chat_id):
+            connection_states.set_current_chat_id(current_user.id,
+                                                  request.sid,
+                                                  None)
         current_user.mark_chats_as_removed([chat])
         socket_io.emit('remove_chat',
                        {'chat_id': str(chat_id)},
-                       room=USER_WEBSOCKET_MAPPING[current_user.id])
+                       room=socket_registry.get_room(current_user.id))
     except (AttributeError, LookupError, ValueError, OverflowError):
         log_exception()
     except IntegrityError as e:
@@ -152,33 +174,65 @@ def remove_chat(data):
 
 
 @socket_io.on('connect')
+@instrumented
 @authenticated_only
 def save_room():
-    global CHAT_UPDATES_POOL, USER_WEBSOCKET_MAPPING
     if current_user and not current_user.is_anonymous:
-        USER_WEBSOCKET_MAPPING[current_user.id] = request.sid
-        data = current_user.get_updated_chats(current_user, session)
+        join_room(socket_registry.get_room(current_user.id))
+        for chat_id, in current_user.get_chat_ids_query():
+            join_room(socket_registry.get_chat_room(chat_id))
+        socket_registry.add(current_user.id, request.sid)
+        state = connection_states.open(current_user.id, request.sid)
+        data = current_user.get_updated_chats(state.current_chat_id)
         if data:
-            worker = (gevent
-                      .spawn(copy_current_request_context(send_update),
-                             data=data,
-                             sid=request.sid))
-            CHAT_UPDATES_POOL.add(worker)
+            chat_updates.submit(send_update, 
+                                data=data, 
+                                room=request.sid)
 
 
 @socket_io.on('disconnect')
+@instrumented
 @authenticated_only
 def disconnect():
-    global CHAT_UPDATES_POOL, USER_WEBSOCKET_MAPPING
     if current_user and not current_user.is_anonymous:
-        if current_user.id in USER_WEBSOCKET_MAPPING:
-            del USER_WEBSOCKET_MAPPING[current_user.id]
+        socket_registry.remove(current_user.id, request.sid)
+        connection_states.close(request.sid)
+
+
+@socket_io.on('join_chat')
+@instrumented
+@authenticated_only
+def join_chat(data):
+    try:
+        chat_id = int(data['chat_id'])
+        is_member = (current_user
+                     .get_chat_ids_query()
+                     .filter(UserChatTable.c.chat_id == chat_id)
+                     .first())
+        if is_member:
+            join_room(socket_registry.get_chat_room(chat_id))
+    except (LookupError, OverflowError, ValueError):
+        log_exception()
+
+
+@socket_io.on('join_chats')
+@instrumented
+@authenticated_only
+def join_chats(data):
+    try:
+        chat_ids = [int(chat_id) for chat_id in data['chat_ids']]
+        for chat_id, in (current_user
+                         .get_chat_ids_query()
+                         .filter(UserChatTable.c.chat_id.in_(chat_ids))):
+            join_room(socket_registry.get_chat_room(chat_id))
+    except (LookupError, OverflowError, TypeError, ValueError):
+        log_exception()
 
 
 @socket_io.on('send_message')
+@instrumented
 @authenticated_only
 def send_message(data):
-    global CHAT_UPDATES_POOL
     try:
         message = None
         text = str(escape(data['message_text']).rstrip())
@@ -193,38 +247,33 @@ def send_message(data):
                         .filter(User.id != current_user.id)
                         .first())
         message = Message(text=text,
-                          sender=current_user,
+                          sender=current_user.get_user(),
                           recipient=recipient,
                           chat=chat)
         chat.date_modified = datetime.now(tz=timezone.utc)
         database.session.add_all([message, chat])
+        chat.increment_unread_counts(current_user)
+        chat.unmark_as_removed()
         database.session.commit()
-        recipients = (chat
-                      .users
-                      .filter(User.username != current_user.username)
-                      .all())
         message_dict = {
             'text': message.text,
             'date_created': message.date_created.isoformat(),
-            'sender_username': message.sender.username
+            'sender_username': current_user.username,
+            'cursor': message.get_cursor()
         }
         socket_io.emit('send_message', 
                        {'message': message_dict,
                         'current_username': current_user.username,
                         'chat_name': chat.get_name(current_user)},
-                       room=USER_WEBSOCKET_MAPPING[current_user.id])
-        for recipient in recipients:
-            recipient.unmark_chats_as_removed([chat])
-            if recipient.id in USER_WEBSOCKET_MAPPING:
-                sid = USER_WEBSOCKET_MAPPING[recipient.id]
-                data = recipient.get_updated_chats(current_user, 
-                                                   session)
-                if data:
-                    worker = (gevent
-                             .spawn(copy_current_request_context(send_update),
-                                    data=data,
-                                    sid=sid))
-                    CHAT_UPDATES_POOL.add(worker)
+                       room=request.sid)
+        # one delta for all the chat's sockets,
+        # every client adds the message or increments its unread counter
+        socket_io.emit('new_message',
+                       {'message': message_dict,
+                        'chat_id': str(chat.id),
+                        'chat_name': chat.name or ''},
+                       room=socket_registry.get_chat_room(chat.id),
+                       skip_sid=request.sid)
     except (AttributeError, LookupError, 
             OverflowError, ValueError, NotFound):
         log_exception()
@@ -234,114 +283,136 @@ def send_message(data):
 
 
 @socket_io.on('flush_messages')
+@instrumented
 @authenticated_only
 def flush_messages(data):
     try:
         chat_id = int(data['chat_id'])
         chat = Chat.query.get_or_404(chat_id)
-        Message.flush_messages(current_user.get_unread_messages_query(chat))
+        current_user.mark_chat_as_read(chat)
     except (AttributeError, OverflowError, ValueError, NotFound):
         log_exception()
 
 @socket_io.on('choose_chat')
+@instrumented
 @authenticated_only
 def choose_chat(data):
     try:
         chat_id = int(data['chat_id'])
-        saved_chat_id = session.get((current_user.id,'current_chat_id'))
+        saved_chat_id = connection_states.get_current_chat_id(current_user.id,
+                                                              request.sid)
         if saved_chat_id == chat_id:
-            session[(current_user.id,'current_chat_id')] = None
+            connection_states.set_current_chat_id(current_user.id,
+                                                  request.sid,
+                                                  None)
             socket_io.emit('choose_chat',
                            {'messages':[],
                             'chat_name': '',
                             'chat_id': str(chat_id),
                             'current_username': current_user.username},
-                           room=USER_WEBSOCKET_MAPPING[current_user.id])
+                           room=request.sid)
         else:
             chat = Chat.query.get_or_404(chat_id)
-            message_dict_list = current_user.get_messages(chat)
-            Message.flush_messages(current_user
-                                   .get_unread_messages_query(chat))
-            session[(current_user.id, 'current_chat_id')] = chat_id
+            message_dict_list, has_more = current_user.get_messages(chat)
+            current_user.mark_chat_as_read(chat)
+            connection_states.set_current_chat_id(current_user.id,
+                                                  request.sid,
+                                                  chat_id)
             socket_io.emit('choose_chat', 
                             {'messages': message_dict_list,
+                             'has_more': has_more,
                              'chat_name': chat.get_name(current_user),
                              'chat_id': str(chat.id),
                              'current_username': current_user.username},
-                            room=USER_WEBSOCKET_MAPPING[current_user.id])
+                            room=request.sid)
     except (OverflowError, ValueError, NotFound):
         log_exception()
 
 
 @socket_io.on('add_contacts_and_chats')
+@instrumented
 @authenticated_only
 def add_contacts_and_chats(data):
     try:
-        new_contacts = []
-        user_ids = [int(user_id) for user_id in data['user_ids']]
-        removed_query = current_user.get_removed_chats_query(user_ids)
-        removed_chats = removed_query.all()
-        current_user.unmark_chats_as_removed(removed_query)
-        added_chats = []
-        for chat in removed_chats:
-            added_chats.append({'chat_name': chat.get_name(current_user),
-                                'chat_id': str(chat.id)})
-            chat.date_modified = datetime.now(tz=timezone.utc)
-            database.session.add(chat)
-        for user in User.query.filter(User.id.in_(user_ids)):
-            if not current_user.has_contact(user):
-                new_contacts.append(user)
-            chat = Chat.get_chat([current_user, user])
-            if not chat:
-                chat = Chat()
-                database.session.add(chat)
-                chat.add_users([current_user, user])
-                user.mark_chats_as_removed([chat])
-                database.session.commit()
-                chat_data = {'chat_name': chat.get_name(current_user),
-                             'chat_id': str(chat.id)}
-                added_chats.append(chat_data)
+        user_ids = {int(user_id) for user_id in data['user_ids']}
+        current = current_user.get_user()
+        peer_ids = {user_id for user_id,
+                    in (database
+                        .session
+                        .query(User.id)
+                        .filter(User.id.in_(user_ids),
+                                User.id != current.id))}
+        chats, created_ids = Chat.get_or_create_direct_chats(current.id,
+                                                             peer_ids)
+        # read before the commit expires the chats
+        chat_ids = {peer_id: chat.id for peer_id, chat in chats.items()}
+        # new chats show up for the peers with the first message
+        Chat.mark_as_removed_for_users([(chat_ids[peer_id], peer_id)
+                                        for peer_id in created_ids])
+        existing_chats = {chat.id: chat
+                          for peer_id, chat in chats.items()
+                          if peer_id not in created_ids}
+        restored_ids = current.get_removed_chat_ids(list(existing_chats))
+        if restored_ids:
+            current.unmark_chats_as_removed([existing_chats[chat_id]
+                                             for chat_id in restored_ids])
+            (Chat
+             .query
+             .filter(Chat.id.in_(restored_ids))
+             .update({Chat._date_modified: datetime.now(tz=timezone.utc)},
+                     synchronize_session=False))
+        new_chat_ids = [chat_ids[peer_id] for peer_id in created_ids]
+        added_ids = sorted(restored_ids) + new_chat_ids
+        names = current.get_display_names(added_ids)
+        database.session.commit()
+        if new_chat_ids:
+            socket_io.emit('join_chats',
+                           {'chat_ids': [str(chat_id)
+                                         for chat_id in new_chat_ids]},
+                           room=socket_registry.get_room(current_user.id))
+        for peer_id in created_ids:
+            socket_io.emit('join_chats',
+                           {'chat_ids': [str(chat_ids[peer_id])]},
+                           room=socket_registry.get_room(peer_id))
         socket_io.emit('add_contacts_and_chats',
-                       {'added_chats': added_chats},
-                       room=USER_WEBSOCKET_MAPPING[current_user.id])
+                       {'added_chats': [{'chat_name': names.get(chat_id),
+                                         'chat_id': str(chat_id)}
+                                        for chat_id in added_ids]},
+                       room=socket_registry.get_room(current_user.id))
     except (ValueError, TypeError):
-        log_exception
+        log_exception()
     except IntegrityError:
         database.session.rollback()
-        log_exception
+        log_exception()
 
 
 @main.route('/')
 @login_required
 @disable_if_unconfirmed
 def index():
-    current = current_user._get_current_object()
+    current = current_user.get_user()
     users = current.get_other_users_query()
-    chats = current.get_available_chats_query()
     users = (users
              .paginate(1, per_page=current_app.config["USERS_PER_PAGE"],
                        error_out=False)
              .items)
+    chat_summaries = (current
+                      .get_chat_summaries_query()
+                      .limit(current_app.config['CHATS_PER_PAGE'])
+                      .all())
     chat_list = []
-    current_chat_id = session.get((current_user.id, 'current_chat_id'))
-    for chat in chats:
-        recipient = chat.users.filter(User.id != current_user.id).first()
-        name = chat.name or recipient.username
-        unread_messages_count = 0
+    current_chat_id = connection_states.get_current_chat_id(current_user.id)
+    current_chat_name = None
+    for chat, name, unread_messages_count in chat_summaries:
         if chat.id == current_chat_id:
-            Message.flush_messages(current.get_unread_messages_query(chat))
-        else:
-            unread_messages_count = (current_user
-                                    .get_unread_messages_query(chat)
-                                    .count())
+            current_chat_name = name
+            if unread_messages_count:
+                current.mark_chat_as_read(chat)
+            unread_messages_count = 0
         chat_list.append({'name': name,
                           'chat_id': chat.id,
                           'unread_messages_count': unread_messages_count})
-    current_chat_id = None
-    current_chat_name = None
-    if session.get((current_user.id, 'current_chat_id')):
-        current_chat_id = session.get((current_user.id, 'current_chat_id'))
-    if current_chat_id:
+    if current_chat_id and not current_chat_name:
         try:
             chat = Chat.query.get_or_404(current_chat_id)
             current_chat_name = chat.get_name(current)
@@ -358,6 +429,5 @@ def index():
                           )
 
 
-@authenticated_only
-def send_update(data, sid):
-    socket_io.emit('chat_updated', data, room=sid)
\ No newline at end of file
+def send_update(data, room):
+    socket_io.emit('chat_updated', data, room=room)
\ No newline at end of file
@@ -0,0 +1,215 @@
+from bisect import bisect_left
+from threading import Lock
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """
+    Monotonically increasing value.
+
+
+    Methods defined here:
+
+    inc(amount=1)
+    """
+    def __init__(self, name, description='', labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    """
+    Value which can go up and down.
+
+
+    Methods defined here:
+
+    set(value)
+
+    inc(amount=1)
+
+    dec(amount=1)
+    """
+    def __init__(self, name, description='', labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.value = 0
+        self.lock = Lock()
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+
+class Histogram:
+    """
+    Distribution of observed values
+    counted in buckets with the given upper bounds.
+
+
+    Methods defined here:
+
+    observe(value)
+    """
+    def __init__(self, name, description='', buckets=DEFAULT_BUCKETS,
+                 labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # the last bucket counts values above every bound
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.bucket_counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+
+class MetricsRegistry:
+    """
+    Collection of the application's metrics by name and labels.
+    Asking for an existing name (and labels) returns the existing metric,
+    so modules can declare their metrics on every application setup.
+    Labels are given as a dictionary, e.g. {'event': 'send_message'},
+    metrics with the same name and different labels
+    are series of the same metric.
+
+
+    Methods defined here:
+
+    counter(name, description='', labels=None)
+
+    gauge(name, description='', labels=None)
+
+    histogram(name, description='', buckets=DEFAULT_BUCKETS, labels=None)
+
+    get(name, labels=None)
+
+    get_metrics()
+
+    to_prometheus()
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def get_or_create(self, metric_class, name, labels, *args):
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            metric = self.metrics.get((name, labels))
+            if metric is None:
+                metric = metric_class(name, *args, labels=labels)
+                self.metrics[(name, labels)] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f'Metric {name} is not '
+                                 f'a {metric_class.__name__}.')
+            return metric
+
+    def counter(self, name, description='', labels=None):
+        return self.get_or_create(Counter, name, labels, description)
+
+    def gauge(self, name, description='', labels=None):
+        return self.get_or_create(Gauge, name, labels, description)
+
+    def histogram(self, name, description='', buckets=DEFAULT_BUCKETS,
+                  labels=None):
+        return self.get_or_create(Histogram, name, labels,
+                                  description, buckets)
+
+    def get(self, name, labels=None):
+        return self.metrics.get((name,
+                                 tuple(sorted((labels or {}).items()))))
+
+    def get_metrics(self):
+        """
+        Return all metrics sorted by name and labels.
+
+        :returns: list of Counter, Gauge and Histogram instances
+        """
+        with self.lock:
+            return [self.metrics[key] for key in sorted(self.metrics)]
+
+    def to_prometheus(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+
+        :returns: string
+        """
+        lines = []
+        described = set()
+        for metric in self.get_metrics():
+            if metric.name not in described:
+                described.add(metric.name)
+                metric_type = PROMETHEUS_TYPES[type(metric)]
+                description = (metric
+                               .description
+                               .replace('\\', '\\\\')
+                               .replace('\n', '\\n'))
+                lines.append(f'# HELP {metric.name} {description}')
+                lines.append(f'# TYPE {metric.name} {metric_type}')
+            if isinstance(metric, Histogram):
+                with metric.lock:
+                    bucket_counts = list(metric.bucket_counts)
+                    count, total = metric.count, metric.sum
+                cumulative = 0
+                bounds = [str(bound) for bound in metric.buckets] + ['+Inf']
+                for bound, bucket_count in zip(bounds, bucket_counts):
+                    cumulative += bucket_count
+                    labels = format_labels(metric.labels + (('le', bound),))
+                    lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+                labels = format_labels(metric.labels)
+                lines.append(f'{metric.name}_sum{labels} {total}')
+                lines.append(f'{metric.name}_count{labels} {count}')
+            else:
+                labels = format_labels(metric.labels)
+                lines.append(f'{metric.name}{labels} {metric.value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """
+    Return the given labels as '{name="value",...}'
+    or an empty string if there are none.
+
+    :param labels: sequence of pairs (name, value)
+    :returns: string
+    """
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name,
+                                      str(value)
+                                      .replace('\\', '\\\\')
+                                      .replace('"', '\\"')
+                                      .replace('\n', '\\n'))
+                     for name, value in labels)
+    return '{' + pairs + '}'
+
+
+PROMETHEUS_TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+
+metrics = MetricsRegistry()
@@ -1,26 +1,64 @@
 from . import login_manager
 from . import database
+from . import auth_token_cache, chat_name_cache, credentials_cache
+from . import user_principal_cache, username_prefixes
 from .exceptions import ValidationError
+from .passwords import check_password, hash_password, needs_rehash
+from .search import TrigramIndex, escape_like
 from datetime import datetime, timezone
-from itsdangerous import BadHeader, SignatureExpired
+from itsdangerous import BadData, BadHeader, SignatureExpired
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import and_, not_
+from sqlalchemy import and_, event, false, func, inspect, literal, not_
+from sqlalchemy import or_, select
+from sqlalchemy.orm import joinedload
 from flask import current_app, url_for
 from flask_login import UserMixin, AnonymousUserMixin
-from functools import partial
-from werkzeug.security import generate_password_hash, check_password_hash
+from functools import lru_cache, partial
+from hashlib import sha256
+import hmac
 
 
 utc_now = partial(datetime.now, tz=timezone.utc)
 
 
+@lru_cache(maxsize=16)
+def get_serializer(secret_key, expires_in=3600):
+    """
+    Return a token serializer for the given key and expiration,
+    instances are reused as they keep no state between calls.
+
+    :param secret_key: string
+    :param expires_in: seconds until the generated tokens expire
+    :returns: TimedJSONWebSignatureSerializer instance
+    """
+    return Serializer(secret_key, expires_in)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     """
-    Set up current user.
+    Set up current user as a UserPrincipal.
+    Principals of confirmed users are cached
+    (see app.cache.LRUCache), so authenticated requests
+    and socket events do not query 'users' and 'roles';
+    the cache entry is invalidated when the user's
+    confirmation, role, password or username changes.
     """
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    fields = user_principal_cache.get((user_id,))
+    if fields is not None:
+        return UserPrincipal(*fields)
+    user = (User
+            .query
+            .options(joinedload(User.role))
+            .get(user_id))
+    if user is None:
+        return None
+    principal = UserPrincipal.from_user(user)
+    if user.confirmed:
+        user_principal_cache.set((user_id,), principal.get_fields())
+    return principal
 
 
 def format_date(date):
@@ -34,6 +72,53 @@ def format_date(date):
     return date.strftime(date_format)
 
 
+def get_primary_key(instance):
+    """
+    Return the id of the given model instance
+    without loading its expired attributes
+    (instances are expired by every commit).
+
+    :param instance: model instance or UserPrincipal
+    :returns: integer or None if the instance has not been flushed
+    """
+    state = inspect(instance, raiseerr=False)
+    if state is None:
+        return instance.id
+    return state.identity[0] if state.identity else None
+
+
+def insert_ignore(model, rows=None, columns=None, query=None):
+    """
+    Return an INSERT statement for the given model
+    which skips the rows whose primary key (or another unique key)
+    already exists instead of failing
+    (INSERT ... ON CONFLICT DO NOTHING in PostgreSQL,
+    INSERT OR IGNORE in SQLite).
+    The rows are given either as a list of dictionaries
+    or as the names of the inserted columns and a SELECT statement.
+
+    :param model: model class or table
+    :param rows: list of dictionaries {column_name: value}
+    :param columns: names of the inserted columns
+    :param query: SELECT statement returning the columns' values
+    :returns: SQL statement
+    """
+    table = getattr(model, '__table__', model)
+    is_postgresql = database.engine.dialect.name == 'postgresql'
+    if is_postgresql:
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+    else:
+        statement = table.insert().prefix_with('OR IGNORE')
+    if query is None:
+        statement = statement.values(rows)
+    else:
+        statement = statement.from_select(columns, query)
+    if is_postgresql:
+        statement = statement.on_conflict_do_nothing()
+    return statement
+
+
 def add_test_users():
     """
     Load data to the database
@@ -126,7 +211,9 @@ UserChatTable = database.Table(
                     database.Integer,
                     database.ForeignKey('chats.id',
                                         ondelete="CASCADE"),
-                    primary_key=True)
+                    primary_key=True),
+    # the primary key only serves lookups by user_id
+    database.Index('ix_user_chat_link_chat_id_user_id', 'chat_id', 'user_id')
 )
 
 
@@ -137,6 +224,7 @@ class RemovedChat(database.Model):
     mark which chats as removed.
     """
     __tablename__ = 'removed_chats'
+    __table_args__ = (database.Index('ix_removed_chats_chat_id', 'chat_id'),)
     user_id = database.Column(database.Integer, 
                               database.ForeignKey('users.id',
                                                   ondelete="CASCADE"),
@@ -147,6 +235,41 @@ class RemovedChat(database.Model):
                               primary_key=True)
 
 
+class ChatReadState(database.Model):
+    """
+    Association table
+    keeping the number of unread messages,
+    the id of the last read message
+    and the chat's display name
+    for every user of every chat,
+    so that unread counts are not recomputed
+    from the messages table
+    and chats are searched by the names users see.
+    """
+    __tablename__ = 'chat_read_states'
+    __table_args__ = (database.Index('ix_chat_read_states_chat_id', 
+                                     'chat_id'),)
+    user_id = database.Column(database.Integer,
+                              database.ForeignKey('users.id',
+                                                  ondelete="CASCADE"),
+                              primary_key=True)
+    chat_id = database.Column(database.Integer,
+                              database.ForeignKey('chats.id',
+                                                  ondelete="CASCADE"),
+                              primary_key=True)
+    unread_count = database.Column(database.Integer,
+                                   default=0,
+                                   nullable=False)
+    last_read_message_id = database.Column(database.Integer,
+                                           database.ForeignKey('messages.id',
+                                                               ondelete=
+                                                               "SET NULL"),
+                                           nullable=True)
+    # the chat name seen by the user (see Chat.get_name),
+    # kept up to date by Chat.refresh_display_names
+    display_name = database.Column(database.String(64), nullable=True)
+
+
 class Role(database.Model):
     """
     Represents user role for managing
@@ -210,6 +333,7 @@ class Contact(database.Model):
     among User model instances.
     """
     __tablename__ = 'contacts'
+    __table_args__ = (database.Index('ix_contacts_contact_id', 'contact_id'),)
     user_id = database.Column(database.Integer,
                               database.ForeignKey('users.id'),
                               primary_key=True)
@@ -249,24 +373,67 @@ class Chat(database.Model):
 
     add_users(users)
 
-    delete_users(users)
+    remove_users(users)
+
+    increment_unread_counts(sender)
+
+    unmark_as_removed()
+
+    get_direct_peer_id(user_id)
 
 
     Static methods defined here:
 
+    membership_changed(chat_id, users)
+
+    mark_as_removed_for_users(chat_user_ids)
+
     from_json(json_object)
 
     search_chats_query(chat_name, user)
 
+    refresh_display_names(chat_ids, connection=None)
+
+    get_name_expression(user)
+
+    get_direct_key(user_id, peer_id)
+
 
     Class methods defined here:
     
     get_chat(users)
+
+    get_direct_chats_query(user_id, peer_ids)
+
+    get_direct_chats(user_id, peer_ids)
+
+    get_or_create_direct_chats(user_id, peer_ids)
+
+    get_or_create_direct_chat(user, peer)
     """
     __tablename__ = 'chats'
+    __table_args__ = (database.Index('ix_chats_date_modified', 
+                                     '_date_modified'),
+                      database.Index('ix_chats_direct_user_ids',
+                                     'direct_low_user_id',
+                                     'direct_high_user_id',
+                                     unique=True))
     id = database.Column(database.Integer, primary_key=True)
     name = database.Column(database.String(64))
     is_group_chat = database.Column(database.Boolean, default=False)
+    # the ids of the two users of a direct chat, the lower one first
+    # (NULL for group chats), so a direct chat is found
+    # with one probe of a unique index and cannot be created twice
+    direct_low_user_id = database.Column(database.Integer,
+                                         database.ForeignKey('users.id',
+                                                             ondelete=
+                                                             "SET NULL"),
+                                         nullable=True)
+    direct_high_user_id = database.Column(database.Integer,
+                                          database.ForeignKey('users.id',
+                                                              ondelete=
+                                                              "SET NULL"),
+                                          nullable=True)
     _date_created = database.Column(database.DateTime(timezone=True),
                                     default=utc_now)
     _date_modified = database.Column(database.DateTime(timezone=True),
@@ -276,6 +443,10 @@ class Chat(database.Model):
                                           backref='chat',
                                           lazy='dynamic',
                                           cascade='all, delete-orphan')
+    read_states = database.relationship('ChatReadState',
+                                        backref='chat',
+                                        lazy='dynamic',
+                                        cascade='all, delete-orphan')
     
     @hybrid_property
     def date_created(self):
@@ -326,137 +497,437 @@ class Chat(database.Model):
         of the first user of current chat's 'users' attribute
         which is not equal to the given user's username.
 
+        The username is cached per (chat id, user id)
+        (see app.cache.LRUCache), the cache is invalidated
+        by add_users, remove_users and username changes.
+
         :param user: User model instance
         :returns: string
         """
         if self.name:
             return self.name
-        recipient = (self
-                     .users
-                     .filter(User.username != user.username)
-                     .first())
-        return recipient.username
+        key = (self.id, user.id)
+        name = chat_name_cache.get(key)
+        if name is None:
+            recipient = (self
+                         .users
+                         .filter(User.username != user.username)
+                         .first())
+            name = recipient.username
+            if self.id is not None:
+                chat_name_cache.set(key, name)
+        return name
 
     def add_users(self, users):
         """
-        Add the given users to current chat.
+        Add the given users to current chat
+        skipping the ones who are members already,
+        with one statement per table for any number of users.
+        Current chat and the given users are flushed first
+        if they have no ids yet, a new chat which is not a group chat
+        becomes the direct chat of its two users (see get_direct_key)
+        unless they already have one: it is then left without the key,
+        use get_or_create_direct_chats to reuse the existing chat.
+        Does not commit.
 
         :param users: sequence of User model instances
         """
-        for user in users:
-            if not user in self.users.all():
-                self.users.append(user)
-        database.session.commit()
-    
+        users = list(users)
+        pending = [user for user in users if get_primary_key(user) is None]
+        if pending:
+            database.session.add_all(pending)
+            database.session.flush()
+        user_ids = {get_primary_key(user) for user in users}
+        if get_primary_key(self) is None:
+            if not self.is_group_chat and len(user_ids) == 2:
+                low_id, high_id = Chat.get_direct_key(*user_ids)
+                if (database
+                        .session
+                        .query(Chat.id)
+                        .filter(Chat.direct_low_user_id == low_id,
+                                Chat.direct_high_user_id == high_id)
+                        .first()) is None:
+                    self.direct_low_user_id = low_id
+                    self.direct_high_user_id = high_id
+            database.session.add(self)
+            database.session.flush()
+        chat_id = get_primary_key(self)
+        if not user_ids:
+            return
+        members = (select([User.id, literal(chat_id)])
+                   .where(User.id.in_(user_ids)))
+        database.session.execute(insert_ignore(UserChatTable,
+                                               columns=['user_id',
+                                                        'chat_id'],
+                                               query=members))
+        database.session.execute(insert_ignore(ChatReadState,
+                                               columns=['user_id',
+                                                        'chat_id',
+                                                        'unread_count'],
+                                               query=(members
+                                                      .column(literal(0)))))
+        self.membership_changed(chat_id, users)
+
     def remove_users(self, users):
         """
-        Delete the given users from current chat.
+        Delete the given users from current chat
+        with one statement per table for any number of users.
+        Does not commit.
 
         :param users: sequence of User model instances
         """
+        users = list(users)
+        chat_id = get_primary_key(self)
+        user_ids = {get_primary_key(user) for user in users}
+        if not user_ids:
+            return
+        database.session.execute(UserChatTable
+                                 .delete()
+                                 .where(and_(UserChatTable.c.chat_id
+                                             == chat_id,
+                                             UserChatTable.c.user_id
+                                             .in_(user_ids))))
+        (ChatReadState
+         .query
+         .filter(ChatReadState.chat_id == chat_id,
+                 ChatReadState.user_id.in_(user_ids))
+         .delete(synchronize_session=False))
+        self.membership_changed(chat_id, users)
+
+    @staticmethod
+    def membership_changed(chat_id, users):
+        """
+        Bring the rest of the session up to date after the users
+        of the given chat were changed with Core statements:
+        refresh the chat's display names, expire the users' chats
+        and invalidate the chat's cached names.
+        The names are invalidated again when the session's transaction
+        ends (see on_transaction_end_invalidate_chat_names):
+        other greenlets may have cached the previous names meanwhile.
+        Does not commit.
+
+        :param chat_id: integer
+        :param users: sequence of User model instances
+        """
+        Chat.refresh_display_names([chat_id])
+        chat_name_cache.invalidate_group(chat_id)
+        (database
+         .session
+         .info
+         .setdefault('changed_chat_ids', set())
+         .add(chat_id))
+        # the rows were written bypassing the ORM
         for user in users:
-            self.users.remove(user)
-        database.session.commit()
+            state = inspect(user, raiseerr=False)
+            if (state is not None
+                    and state.persistent
+                    and 'chats' not in state.unloaded):
+                database.session.expire(user, ['chats'])
+
+    def increment_unread_counts(self, sender):
+        """
+        Increment the unread messages counters
+        of all the users of current chat except the given sender.
+        Does not commit.
+
+        :param sender: User model instance
+        """
+        (ChatReadState
+         .query
+         .filter(ChatReadState.chat_id == self.id,
+                 ChatReadState.user_id != sender.id)
+         .update({'unread_count': ChatReadState.unread_count + 1},
+                 synchronize_session=False))
+
+    def unmark_as_removed(self):
+        """
+        Delete RemovedChat records of current chat for all its users
+        with a single statement.
+        Does not commit.
+        """
+        (RemovedChat
+         .query
+         .filter(RemovedChat.chat_id == self.id)
+         .delete(synchronize_session=False))
+
+    @staticmethod
+    def mark_as_removed_for_users(chat_user_ids):
+        """
+        Add RemovedChat records for the given pairs of chats and users
+        with a single statement, skipping the existing ones.
+        Does not commit.
+
+        :param chat_user_ids: collection of tuples (chat id, user id)
+        """
+        if chat_user_ids:
+            database.session.execute(insert_ignore(RemovedChat,
+                                                   [{'chat_id': chat_id,
+                                                     'user_id': user_id}
+                                                    for chat_id, user_id
+                                                    in chat_user_ids]))
     
     @staticmethod
     def from_json(json_chat, current_user):
         """
         Return a Chat model instance
-        created from the given json_chat dictionary.
+        created from the given json_chat dictionary,
+        a chat with a single recipient is the direct chat
+        of the recipient and current user,
+        the existing one is returned if they have one
+        (see get_or_create_direct_chat).
+        The chat is added to the session, does not commit.
 
         :param json_chat: dictionary
         :param current_user: current user (needed to get chat name)
-        :returns: Message model instance
+        :returns: Chat model instance
         """
         chat = Chat()
         chat_name = json_chat.get('chat_name')
         usernames = json_chat.get('users')
         users = User.query.filter(User.username.in_(usernames)).all()
+        user = current_user.get_user()
         if len(users) > 1:
             chat.is_group_chat = True
             if not chat_name:
                 raise ValidationError('Chat name or recipient name\
                                        must be present.')
-        chat.add_users(users)
-        chat.add_users([current_user])
+        elif users and users[0] != user:
+            chat, _ = Chat.get_or_create_direct_chat(user, users[0])
+            return chat
+        chat.add_users(users + [user])
         return chat
     
     @staticmethod
     def search_chats_query(chat_name, user):
         """
-        Return a query of chats
-        where each chat either:
-        - contains the given chat_name in 'name' column;
-        - has only two users ('is_group_chat' is False and 'name' is None),
-          and the user with 'username' not equal to (the given user).username
-          contains the given chat_name in 'username'.
+        Return a query of the given user's chats
+        whose name seen by the user (see get_name)
+        contains the given chat_name (case insensitive)
+        ordered by modification date in descending order.
+        The names are read from the user's ChatReadState rows,
+        so the search only scans the rows of the given user;
+        the query joins ChatReadState, so callers can select
+        ChatReadState.display_name along with the chats.
 
         :param chat_name: string to search for
-        :param user: user whose 'username' is excluded from search,
-                     i.e. if 
-                     chat.users == [User(username='bob'), 
-                                    User(username='arthur')] 
-                     and chat.name == None, 
-                     then search_chats('bob', User(username='bob'))
+        :param user: User model instance
         :returns: Chat model query
         """
-        subquery_current = (User
-                            .query
-                            .filter(User
-                                    .username == user.username)
-                            .subquery())
-        subquery_pattern = (User
-                            .query
-                            .filter(User.username != user.username,
-                                    User
-                                    .username
-                                    .ilike('%' + chat_name + '%'))
-                            .subquery())
-        subquery_current_chats = (database
-                                 .session
-                                 .query(UserChatTable.c.chat_id)
-                                 .join(subquery_current,
-                                       UserChatTable
-                                       .c
-                                       .user_id == subquery_current.c.id)
-                                 .subquery())
-        subquery_pattern_chats = (database
-                                  .session
-                                  .query(UserChatTable.c.chat_id)
-                                  .join(subquery_pattern,
-                                        UserChatTable
-                                        .c
-                                        .user_id == subquery_pattern.c.id)
-                                  .subquery())
-        chats = (database
-                 .session
-                 .query(Chat)
-                 .join(subquery_current_chats,
-                       Chat.id == subquery_current_chats.c.chat_id)
-                 .join(subquery_pattern_chats,
-                       subquery_current_chats
-                       .c
-                       .chat_id == subquery_pattern_chats.c.chat_id))
+        pattern = f'%{escape_like(chat_name.lower())}%'
+        return (Chat
+                .query
+                .join(ChatReadState,
+                      and_(ChatReadState.chat_id == Chat.id,
+                           ChatReadState.user_id == user.id))
+                .filter(func.lower(ChatReadState.display_name)
+                        .like(pattern, escape='\\'))
+                .order_by(Chat.date_modified.desc()))
 
-        return (database
-                .session
-                .query(Chat)
-                .filter(Chat.users.contains(user),
-                        Chat.name.ilike('%' + chat_name + '%'))
-                .union(chats))
+    @staticmethod
+    def refresh_display_names(chat_ids, connection=None):
+        """
+        Recompute ChatReadState.display_name
+        of all the users of the chats with the given ids
+        with a single statement.
+        Runs after every flush which changes chat names or usernames
+        or adds or deletes ChatReadState rows
+        (see on_flush_refresh_display_names),
+        inserts bypassing the ORM must call it themselves.
+
+        :param chat_ids: collection of integers
+        :param connection: SQLAlchemy connection,
+                           the session's connection by default
+        """
+        if not chat_ids:
+            return
+        if connection is None:
+            connection = database.session.connection()
+        read_states = ChatReadState.__table__
+        peer_link = UserChatTable.alias()
+        users = User.__table__
+        chats = Chat.__table__
+        peer_name = (select([users.c.username])
+                     .where(and_(peer_link.c.chat_id == read_states.c.chat_id,
+                                 peer_link.c.user_id == users.c.id,
+                                 users.c.id != read_states.c.user_id))
+                     .limit(1)
+                     .as_scalar())
+        name = (select([chats.c.name])
+                .where(chats.c.id == read_states.c.chat_id)
+                .as_scalar())
+        connection.execute(read_states
+                           .update()
+                           .where(read_states.c.chat_id.in_(chat_ids))
+                           .values(display_name=func.coalesce(
+                               func.nullif(name, ''), peer_name)))
+
+    @staticmethod
+    def get_name_expression(user):
+        """
+        Return an SQL expression evaluating to
+        the chat name seen by the given user
+        (the same value get_name(user) returns),
+        so that names can be selected along with chats
+        instead of being looked up one chat at a time.
+
+        :param user: User model instance
+        :returns: SQL column expression
+        """
+        peer_link = UserChatTable.alias()
+        peer_name = (select([User.username])
+                     .where(and_(peer_link.c.chat_id == Chat.id,
+                                 peer_link.c.user_id == User.id,
+                                 User.id != user.id))
+                     .limit(1)
+                     .correlate(Chat)
+                     .as_scalar())
+        return func.coalesce(func.nullif(Chat.name, ''), peer_name)
+
+    def get_direct_peer_id(self, user_id):
+        """
+        Return the id of the other user of current direct chat.
+
+        :param user_id: integer
+        :returns: integer
+        """
+        if self.direct_low_user_id == user_id:
+            return self.direct_high_user_id
+        return self.direct_low_user_id
+
+    @staticmethod
+    def get_direct_key(user_id, peer_id):
+        """
+        Return the key of the direct chat of the users with the given ids,
+        the same for both orders of the ids.
+
+        :param user_id: integer
+        :param peer_id: integer
+        :returns: tuple (lower id, higher id)
+        """
+        return (min(user_id, peer_id), max(user_id, peer_id))
 
     @classmethod
     def get_chat(cls, users):
         """
-        Return the chat of users in the given sequence.
+        Return the direct chat of the two given users
+        with one probe of the direct chats' unique index.
 
-        :param user: sequence of User model instances
-        :returns: Chat model instance
+        :param users: sequence of two User model instances
+        :returns: Chat model instance or None
         """
-        chat = cls.query
-        for user in users:
-            chat = chat.filter(cls.users.contains(user))
-        return chat.first()
+        low_id, high_id = cls.get_direct_key(*(get_primary_key(user)
+                                                for user in users))
+        return (cls
+                .query
+                .filter(cls.direct_low_user_id == low_id,
+                        cls.direct_high_user_id == high_id)
+                .first())
+
+    @classmethod
+    def get_direct_chats_query(cls, user_id, peer_ids):
+        """
+        Return a query of the direct chats
+        of the user with the given user_id
+        and the users with the given peer_ids
+        (one index probe per peer).
+
+        :param user_id: integer
+        :param peer_ids: collection of integers
+        :returns: Chat model query
+        """
+        lower_ids = [peer_id for peer_id in peer_ids if peer_id < user_id]
+        higher_ids = [peer_id for peer_id in peer_ids if peer_id > user_id]
+        conditions = []
+        if higher_ids:
+            conditions.append(and_(cls.direct_low_user_id == user_id,
+                                   cls.direct_high_user_id.in_(higher_ids)))
+        if lower_ids:
+            conditions.append(and_(cls.direct_high_user_id == user_id,
+                                   cls.direct_low_user_id.in_(lower_ids)))
+        return cls.query.filter(or_(*conditions) if conditions else false())
+
+    @classmethod
+    def get_direct_chats(cls, user_id, peer_ids):
+        """
+        Return the existing direct chats
+        of the user with the given user_id
+        and the users with the given peer_ids.
+
+        :param user_id: integer
+        :param peer_ids: collection of integers
+        :returns: dictionary {peer id: Chat model instance}
+        """
+        return {chat.get_direct_peer_id(user_id): chat
+                for chat in cls.get_direct_chats_query(user_id, peer_ids)}
+
+    @classmethod
+    def get_or_create_direct_chats(cls, user_id, peer_ids):
+        """
+        Return the direct chats
+        of the user with the given user_id
+        and the users with the given peer_ids,
+        creating the missing ones with their users and read states
+        in a constant number of statements.
+        Chats created concurrently by another transaction
+        are skipped by the unique index and returned as created.
+        Does not commit.
+
+        :param user_id: integer
+        :param peer_ids: collection of integers
+        :returns: tuple (dictionary {peer id: Chat model instance},
+                         set of the peer ids whose chats were created)
+        """
+        peer_ids = set(peer_ids) - {user_id}
+        chats = cls.get_direct_chats(user_id, peer_ids)
+        missing_ids = peer_ids - set(chats)
+        if not missing_ids:
+            return chats, set()
+        now = utc_now()
+        rows = []
+        for peer_id in missing_ids:
+            low_id, high_id = cls.get_direct_key(user_id, peer_id)
+            rows.append({'is_group_chat': False,
+                         '_date_created': now,
+                         '_date_modified': now,
+                         'direct_low_user_id': low_id,
+                         'direct_high_user_id': high_id})
+        database.session.execute(insert_ignore(cls, rows))
+        created = cls.get_direct_chats(user_id, missing_ids)
+        chat_ids = [chat.id for chat in created.values()]
+        members = (select([User.id, cls.id])
+                   .where(and_(cls.id.in_(chat_ids),
+                               or_(User.id == cls.direct_low_user_id,
+                                   User.id == cls.direct_high_user_id))))
+        database.session.execute(insert_ignore(UserChatTable,
+                                               columns=['user_id',
+                                                        'chat_id'],
+                                               query=members))
+        database.session.execute(insert_ignore(ChatReadState,
+                                               columns=['user_id',
+                                                        'chat_id',
+                                                        'unread_count'],
+                                               query=(members
+                                                      .column(literal(0)))))
+        cls.refresh_display_names(chat_ids)
+        chats.update(created)
+        return chats, set(created)
+
+    @classmethod
+    def get_or_create_direct_chat(cls, user, peer):
+        """
+        Return the direct chat of the given users,
+        creating it if it does not exist (see get_or_create_direct_chats).
+        Does not commit.
+
+        :param user: User model instance
+        :param peer: User model instance
+        :returns: tuple (Chat model instance, True if it was created)
+        """
+        peer_id = get_primary_key(peer)
+        chats, created = cls.get_or_create_direct_chats(get_primary_key(user),
+                                                        [peer_id])
+        return chats[peer_id], peer_id in created
+
 
 class User(UserMixin, database.Model):
     """
@@ -467,10 +938,14 @@ class User(UserMixin, database.Model):
 
     Methods defined here:
 
-    get_updated_chats(current_user, session)
+    get_updated_chats(current_chat_id=None)
+
+    get_chat_summaries_query()
 
     get_chat_query(user_ids)
 
+    get_chat_ids_query()
+
     get_removed_query(chat_query=None)
 
     get_removed_chats_query(user_ids)
@@ -479,6 +954,16 @@ class User(UserMixin, database.Model):
 
     unmark_chats_as_removed(chats)
 
+    get_removed_chat_ids(chat_ids)
+
+    get_display_names(chat_ids)
+
+    mark_chat_as_read(chat)
+
+    get_last_read_message_id(chat)
+
+    get_user()
+
     has_permission(permission)
 
     verify_password(password)
@@ -493,6 +978,8 @@ class User(UserMixin, database.Model):
     
     is_contacted_by(user)
     
+    get_contact_ids(user_ids)
+
     add_contacts(users, contact_group=None)
     
     delete_contacts(users)
@@ -501,7 +988,7 @@ class User(UserMixin, database.Model):
     
     get_available_chats_query()
     
-    get_messages(chat)
+    get_messages(chat, before=None, after=None)
     
     get_unread_messages_query(chat)
     
@@ -510,6 +997,8 @@ class User(UserMixin, database.Model):
 
     Static methods defined here:
 
+    verify_credentials(email, password)
+
     verify_auth_token(token)
     """
     __tablename__ = 'users'
@@ -558,6 +1047,10 @@ class User(UserMixin, database.Model):
                                           backref='user',
                                           lazy='dynamic',
                                           cascade='all, delete-orphan')
+    read_states = database.relationship('ChatReadState',
+                                        backref='user',
+                                        lazy='dynamic',
+                                        cascade='all, delete-orphan')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -601,43 +1094,63 @@ class User(UserMixin, database.Model):
     @password.setter
     def password(self, password):
         """
-        Assign the given password to current user.
+        Assign the given password to current user
+        hashed with the configured policy (see app.passwords).
 
         :param password: string
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
-    def get_updated_chats(self, current_user, session):
+    def get_updated_chats(self, current_chat_id=None):
         """
         Return information about the user's updated chats,
         if there are any.
+        Unread message counts and chat names are collected
+        with a single grouped query regardless of the number of chats.
 
-        :param current_user: the user currently logged in
-        :param session: flask session
+        :param current_chat_id: id of the chat chosen in the connection,
+                                its unread messages are included
         :returns: dictionary with the keys 
                   'chats', 'current_chat_messages', 'current_username'
                   or None
         """
-        available_chats = self.get_available_chats_query().all()
+        unread_counts_query = (self
+                               .get_chat_summaries_query()
+                               .filter(ChatReadState.unread_count > 0))
         chats = []
         messages = []
-        for chat in available_chats:
-            unread_messages_query = self.get_unread_messages_query(chat)
-            count = unread_messages_query.count()
-            if count:
-                chats.append({'chat_id': str(chat.id),
-                              'unread_messages_count': count,
-                              'chat_name': chat.get_name(self)})
-                current_chat_id = session.get((current_user.id, 
-                                               'current_chat_id'))
-                if current_chat_id == chat.id:
-                    messages = (Message
-                                .get_messages_list(unread_messages_query))
+        for chat, chat_name, count in unread_counts_query:
+            chats.append({'chat_id': str(chat.id),
+                          'unread_messages_count': count,
+                          'chat_name': chat_name})
+            if current_chat_id == chat.id:
+                messages = (Message
+                            .get_messages_list(self
+                                               .get_unread_messages_query(chat)))
         if chats:
             data = {'chats': chats,
                     'current_chat_messages': messages,
                     'current_username': self.username}
-            return data        
+            return data
+
+    def get_chat_summaries_query(self):
+        """
+        Return a query of tuples 
+        (chat, chat name, unread messages count)
+        for current user's chats not marked as removed
+        ordered by modification date in descending order.
+        Names and counts are selected by the same statement
+        as the chats, counts are read from ChatReadState.
+
+        :returns: query of tuples (Chat, string, integer)
+        """
+        return (self
+                .get_available_chats_query()
+                .outerjoin(ChatReadState,
+                           and_(ChatReadState.chat_id == Chat.id,
+                                ChatReadState.user_id == self.id))
+                .add_columns(Chat.get_name_expression(self),
+                             func.coalesce(ChatReadState.unread_count, 0)))
 
     def get_chat_query(self, user_ids):
         """
@@ -657,6 +1170,18 @@ class User(UserMixin, database.Model):
                     )
                 )
 
+    def get_chat_ids_query(self):
+        """
+        Return a query of the ids of all current user's chats,
+        including the ones marked as removed.
+
+        :returns: query of tuples (integer,)
+        """
+        return (database
+                .session
+                .query(UserChatTable.c.chat_id)
+                .filter(UserChatTable.c.user_id == self.id))
+
     def get_removed_query(self, chat_query=None):
         """
         Return RemovedChat query for currrent user
@@ -733,7 +1258,89 @@ class User(UserMixin, database.Model):
                                 .filter(RemovedChat.chat_id.in_(chat_ids),
                                         RemovedChat.user_id == self.id))
         removed_chats_query.delete(synchronize_session='fetch')
+
+    def get_removed_chat_ids(self, chat_ids):
+        """
+        Return the ids of the chats among the given ones
+        which current user marked as removed.
+
+        :param chat_ids: collection of integers
+        :returns: set of integers
+        """
+        if not chat_ids:
+            return set()
+        return {chat_id for chat_id,
+                in (database
+                    .session
+                    .query(RemovedChat.chat_id)
+                    .filter(RemovedChat.user_id == self.id,
+                            RemovedChat.chat_id.in_(chat_ids)))}
+
+    def get_display_names(self, chat_ids):
+        """
+        Return the names current user sees (see Chat.get_name)
+        of the chats with the given ids with a single query.
+
+        :param chat_ids: collection of integers
+        :returns: dictionary {chat id: string}
+        """
+        if not chat_ids:
+            return {}
+        return dict(database
+                    .session
+                    .query(ChatReadState.chat_id, ChatReadState.display_name)
+                    .filter(ChatReadState.user_id == self.id,
+                            ChatReadState.chat_id.in_(chat_ids)))
     
+    def mark_chat_as_read(self, chat):
+        """
+        Mark all the messages from the given chat
+        as read by current user
+        by moving current user's read cursor of the chat
+        to the last message and resetting the unread messages counter.
+        Costs a single-row UPDATE
+        regardless of the number of unread messages,
+        nothing changes if current user is not a member of the chat
+        (members have a ChatReadState row, see Chat.add_users).
+
+        :param chat: Chat model instance
+        """
+        last_message_id = (select([func.max(Message.id)])
+                           .where(Message.chat_id == chat.id)
+                           .as_scalar())
+        (ChatReadState
+         .query
+         .filter(ChatReadState.user_id == self.id,
+                 ChatReadState.chat_id == chat.id)
+         .update({'unread_count': 0,
+                  'last_read_message_id': last_message_id},
+                 synchronize_session=False))
+        database.session.commit()
+
+    def get_last_read_message_id(self, chat):
+        """
+        Return the id of the last message
+        from the given chat read by current user.
+
+        :param chat: Chat model instance
+        :returns: integer or None
+        """
+        return (database
+                .session
+                .query(ChatReadState.last_read_message_id)
+                .filter_by(user_id=self.id, chat_id=chat.id)
+                .scalar())
+
+    def get_user(self):
+        """
+        Return current user
+        (the User model instance behind current_user,
+        see UserPrincipal.get_user).
+
+        :returns: User model instance
+        """
+        return self
+
     def has_permission(self, permission):
         """
         Check if current user has the given permission.
@@ -750,12 +1357,19 @@ class User(UserMixin, database.Model):
     def verify_password(self, password):
         """
         Check if the given password matches current user's password.
+        If it does and the stored hash does not follow
+        the configured policy (see app.passwords),
+        the password is hashed again, the caller commits.
 
         :param password: string
         :returns: True if password matches current user's password, 
                   False otherwise
         """
-        return check_password_hash(self.password_hash, password)
+        if not check_password(self.password_hash, password):
+            return False
+        if needs_rehash(self.password_hash):
+            self.password = password
+        return True
     
     def generate_auth_token(self, expiration=3600):
         """
@@ -764,7 +1378,8 @@ class User(UserMixin, database.Model):
         :param expiration: Time in seconds after which token expires
         :returns: TimedJSONWebSignature
         """
-        serializer = Serializer(current_app.config['SECRET_KEY'], expiration)
+        serializer = get_serializer(current_app.config['SECRET_KEY'],
+                                    expiration)
         return serializer.dumps({'id': self.id})
     
     def generate_confirmation_token(self, expiration=3600):
@@ -774,7 +1389,8 @@ class User(UserMixin, database.Model):
         :param expiration: Time in seconds after which token expires
         :returns: TimedJSONWebSignature
         """
-        serializer = Serializer(current_app.config['SECRET_KEY'], expiration)
+        serializer = get_serializer(current_app.config['SECRET_KEY'],
+                                    expiration)
         return serializer.dumps({'confirm': self.id})
     
     def confirm(self, token):
@@ -787,7 +1403,7 @@ class User(UserMixin, database.Model):
         :returns: True if the given token belongs to current user,
                   False otherwise
         """
-        serializer = Serializer(current_app.config['SECRET_KEY'])
+        serializer = get_serializer(current_app.config['SECRET_KEY'])
         try:
             data = serializer.loads(token)
         except (BadHeader, SignatureExpired):
@@ -818,30 +1434,73 @@ class User(UserMixin, database.Model):
         """
         return bool(self.contacted.filter_by(user_id=user.id).first())
     
+    def get_contact_ids(self, user_ids):
+        """
+        Return the ids among the given ones
+        of the users current user has as contacts
+        with a single query.
+
+        :param user_ids: collection of integers
+        :returns: set of integers
+        """
+        if not user_ids:
+            return set()
+        return {contact_id for contact_id,
+                in (database
+                    .session
+                    .query(Contact.contact_id)
+                    .filter(Contact.user_id == get_primary_key(self),
+                            Contact.contact_id.in_(user_ids)))}
+
     def add_contacts(self, users, contact_group=None):
         """
-        Add  the given users to current user's contacts.
+        Add the given users to current user's contacts
+        with a single statement for any number of users,
+        the users who are contacts already keep their group.
+        Current user and the given users are flushed first
+        if they have no ids yet. Does not commit.
 
-        :param users: list of User model instances
+        :param users: sequence of User model instances
         :param contact_group: name of contact group
         """
-        for user in users:
-            if not self.has_contact(user):
-                relation = Contact(user=self, 
-                                   contact=user,
-                                   contact_group=contact_group)
-                database.session.add(relation)
+        users = list(users)
+        pending = [user for user in [self] + users
+                   if get_primary_key(user) is None]
+        if pending:
+            database.session.add_all(pending)
+            database.session.flush()
+        user_ids = {get_primary_key(user) for user in users}
+        if not user_ids:
+            return
+        contacts = (select([User.id,
+                            literal(get_primary_key(self)),
+                            literal(contact_group, database.String),
+                            literal(utc_now(),
+                                    database.DateTime(timezone=True))])
+                    .where(User.id.in_(user_ids)))
+        database.session.execute(insert_ignore(Contact,
+                                               columns=['contact_id',
+                                                        'user_id',
+                                                        'contact_group',
+                                                        '_date_created'],
+                                               query=contacts))
 
     def delete_contacts(self, users):
         """
-        Delete the given users from contacts of current user.
+        Delete the given users from contacts of current user
+        with a single statement for any number of users.
+        Does not commit.
 
         :param users: sequence of User model instances
         """
-        for user in users:
-            if self.has_contact(user):
-                relation = self.contacts.filter_by(contact_id=user.id).first()
-                database.session.delete(relation)
+        user_ids = {get_primary_key(user) for user in users}
+        if not user_ids:
+            return
+        (Contact
+         .query
+         .filter(Contact.user_id == get_primary_key(self),
+                 Contact.contact_id.in_(user_ids))
+         .delete(synchronize_session=False))
     
     def get_other_users_query(self):
         """
@@ -866,23 +1525,38 @@ class User(UserMixin, database.Model):
         removed_chats = self.get_removed_query()
         return (Chat
                 .query
-                .filter(Chat.users.contains(self))
+                .join(UserChatTable,
+                      and_(UserChatTable.c.chat_id == Chat.id,
+                           UserChatTable.c.user_id == self.id))
                 .filter(not_(Chat
                             .id
                             .in_(removed_chats
                                 .with_entities(RemovedChat.chat_id))))
                 .order_by(Chat.date_modified.desc()))
 
-    def get_messages(self, chat):
+    def get_messages(self, chat, before=None, after=None):
         """
-        Return a list of dictionaries with keys
-        'text', 'date_created', 'sender_username', 'recipient_username'
-        sorted by creation date in ascending order.
+        Return a page of messages from the given chat:
+        a list of dictionaries with keys
+        'text', 'date_created', 'sender_username', 'recipient_username',
+        'cursor'
+        sorted by creation date in ascending order
+        and whether there are more messages beyond it.
+        At most MESSAGES_PER_PAGE messages are returned:
+        the newest ones if no cursor is given,
+        otherwise the ones right before or right after the cursor
+        (see Message.get_page).
 
         :param chat: Chat model instance
-        :returns: list of dictionaries
-        """
-        messages = chat.messages.order_by(Message.date_created).all()
+        :param before: cursor string or None
+        :param after: cursor string or None
+        :returns: tuple (list of dictionaries, bool),
+                  the second item is True if there are more messages
+                  beyond the page in the direction of pagination
+        """
+        messages, has_more = Message.get_page(chat.messages, 
+                                              before=before,
+                                              after=after)
         message_dict_list = []
         for message in messages:
             sender = message.sender
@@ -892,57 +1566,165 @@ class User(UserMixin, database.Model):
             message_dict = {'text': message.text,
                             'date_created': message.date_created.isoformat(),
                             'sender_username': sender_name,
-                            'recipient_username': recipient_name}
+                            'recipient_username': recipient_name,
+                            'cursor': message.get_cursor()}
             message_dict_list.append(message_dict)
-        return message_dict_list
+        return message_dict_list, has_more
     
     def get_unread_messages_query(self, chat):
         """
-        Return a query of unread messages from the given chat.
+        Return a query of unread messages from the given chat,
+        i.e. messages from other users
+        with ids greater than current user's read cursor.
 
         :param chat: Chat model instance
         :returns: Message model query
         """
+        last_read_message_id = (select([ChatReadState.last_read_message_id])
+                                .where(and_(ChatReadState.user_id == self.id,
+                                            ChatReadState.chat_id == chat.id))
+                                .as_scalar())
         return (chat
                 .messages
-                .filter(Message.sender != self,
-                        not_(Message.was_read)))
+                .filter(Message.sender_id != self.id,
+                        Message.id > func.coalesce(last_read_message_id, 0)))
 
     def search_users_query(self, username, users_query):
         """
         Return a query of users (except current user) 
         from the given users_query
         containing the given username string in the 'username' column
-        in ascending lexicographical order by 'username'.
+        (looked up in a trigram index, see app.search):
+        usernames starting with the given string go first,
+        then the others, in ascending lexicographical order by 'username'.
 
         :param username: string to search in 'username' columns
         :param users_query: User model query to search
         :returns: User model query
         """
-        query = (users_query
-                 .filter(User.username.ilike('%' + username + '%')))
-        return query
-    
+        return (users_query
+                .filter(username_index.get_filter(username))
+                .order_by(None)
+                .order_by(username_index.get_rank(username), User.username))
+
+    def search_users_page(self, username, page_number, per_page):
+        """
+        Return a page of the results of search_users_query
+        over get_other_users_query as (id, username) pairs.
+        Usernames starting with the given string are read
+        from the in-memory prefix index (app.prefix_index),
+        the database is queried only for the other matches
+        when the page extends past the prefix matches
+        or if the index is disabled.
+
+        :param username: string to search in 'username' columns
+        :param page_number: number of the page starting from 1
+        :param per_page: maximum number of users in the page
+        :returns: list of tuples (integer id, string)
+        """
+        start = (max(page_number, 1) - 1) * per_page
+        if username_prefixes.enabled and username_prefixes.is_stale():
+            User.refresh_username_prefixes()
+        if not username_prefixes.enabled:
+            return (self
+                    .search_users_query(username,
+                                        self.get_other_users_query())
+                    .with_entities(User.id, User.username)
+                    .offset(start)
+                    .limit(per_page)
+                    .all())
+        exclude = (self.id, self.username)
+        found = username_prefixes.search(username, exclude, start, per_page)
+        if len(found) == per_page:
+            return found
+        offset = max(start - username_prefixes.count(username, exclude), 0)
+        others = (self
+                  .get_other_users_query()
+                  .with_entities(User.id, User.username)
+                  .filter(username_index.get_filter(username),
+                          username_index.get_rank(username) == 1)
+                  .offset(offset)
+                  .limit(per_page - len(found))
+                  .all())
+        return found + [tuple(row) for row in others]
+
     @staticmethod
-    def verify_auth_token(token):
+    def refresh_username_prefixes():
         """
-        Check the valididty of given token.
+        Build the in-memory username prefix index
+        or add the users created since the last refresh.
+        """
+        rows = (database
+                .session
+                .query(User.id, User.username)
+                .filter(User.id > username_prefixes.last_id)
+                .all())
+        if username_prefixes.is_built:
+            username_prefixes.add_many(rows)
+        else:
+            username_prefixes.build(rows)
+    
+    @staticmethod
+    def verify_credentials(email, password):
+        """
+        Return the principal (see load_user) of the user
+        with the given email if the given password matches.
+        Successful checks are cached for a short time
+        by an HMAC of the credentials (see app.cache.LRUCache),
+        so clients sending their password with every request
+        do not pay for the hash each time;
+        the user's entries are dropped when the password changes.
+        Commits if the password was hashed again.
+
+        :param email: string
+        :param password: string
+        :returns: UserPrincipal instance or None
+        """
+        digest = hmac.new(current_app.config['SECRET_KEY'].encode(),
+                          f'{email}\0{password}'.encode(),
+                          sha256).hexdigest()
+        key = (email, digest)
+        user_id = credentials_cache.get(key)
+        if user_id is None:
+            user = User.query.filter_by(email=email).first()
+            if user is None or not user.verify_password(password):
+                return None
+            user_id = user.id
+            if database.session.is_modified(user):
+                database.session.commit()
+            credentials_cache.set(key, user_id)
+        return load_user(user_id)
 
-        :param token: TimedJSONWebSignature
-        :returns: True if token is valid, 
-                  False otherwise
+    @staticmethod
+    def verify_auth_token(token):
         """
-        print('user verify function')
-        serializer = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            print('hey')
-            data = serializer.loads(token)
-            print('data', data)
-        except Exception as exception:
-            print(exception)
-            return None
-        print(data)
-        return User.query.get(data['id'])
+        Check the validity of given token
+        and return the principal of its user (see load_user).
+        Verified tokens are cached by their digest
+        until they expire (see app.cache.LRUCache),
+        so repeated API requests with the same token
+        neither check the signature nor query the database.
+
+        :param token: TimedJSONWebSignature as a string or bytes
+        :returns: UserPrincipal instance if token is valid,
+                  None otherwise
+        """
+        if isinstance(token, str):
+            token = token.encode()
+        key = (sha256(token).hexdigest(),)
+        user_id = auth_token_cache.get(key)
+        if user_id is None:
+            serializer = get_serializer(current_app.config['SECRET_KEY'])
+            try:
+                data, header = serializer.loads(token, return_header=True)
+            except BadData:
+                return None
+            user_id = data.get('id') if isinstance(data, dict) else None
+            if user_id is None:
+                return None
+            auth_token_cache.set(key, user_id,
+                                 ttl=header['exp'] - serializer.now())
+        return load_user(user_id)
 
 
 class Message(database.Model):
@@ -952,21 +1734,36 @@ class Message(database.Model):
 
     Methods defined here:
 
+    get_cursor()
+
+    is_read_by(user)
+
     to_json(user)
 
 
     Static methods defined here:
 
+    to_json_list(messages, user, chat)
+
     get_messages_list(message_query)
 
-    from_json(json_message)
+    parse_cursor(cursor)
+
+    get_page(message_query, before=None, after=None, per_page=None)
 
-    flush_messages(message_query)
+    from_json(json_message)
     """
     __tablename__ = 'messages'
+    __table_args__ = (
+        # chat history ordered by date (keyset pagination)
+        database.Index('ix_messages_chat_id_date_created_id',
+                       'chat_id', '_date_created', 'id'),
+        # unread messages: ids past a read cursor within a chat
+        database.Index('ix_messages_chat_id_id', 'chat_id', 'id'),
+        database.Index('ix_messages_sender_id', 'sender_id'),
+        database.Index('ix_messages_recipient_id', 'recipient_id'),
+    )
     id = database.Column(database.Integer, primary_key = True)
-    was_read = database.Column(database.Boolean,
-                               default=False)
     text = database.Column(database.Text)
     _date_created = database.Column(database.DateTime(timezone=True),
                                      nullable=False,
@@ -992,7 +1789,6 @@ class Message(database.Model):
         return (f'Message(id={self.id}, text={self.text}, ' 
                 + f'sender={self.sender}, '
                 + f'recipient={self.recipient}, ' 
-                + f'was_read={self.was_read}, '
                 + f'text={self.text}, '
                 + f'chat={self.chat}, '
                 + f'date_created={self.date_created})'
@@ -1010,29 +1806,79 @@ class Message(database.Model):
     def date_created(self, value):
         self._date_created = value
 
+    def get_cursor(self):
+        """
+        Return a string identifying the position of current message
+        in the chat history (its creation date and id)
+        for keyset pagination.
+
+        :returns: string
+        """
+        return f'{self._date_created.isoformat()}_{self.id}'
+
+    def is_read_by(self, user):
+        """
+        Check if the given user has read current message.
+
+        :param user: User model instance
+        :returns: True if user is the sender of current message
+                  or user's read cursor of the chat
+                  is not behind current message,
+                  False otherwise
+        """
+        if self.sender_id == user.id:
+            return True
+        last_read_message_id = user.get_last_read_message_id(self.chat)
+        return bool(last_read_message_id 
+                    and self.id <= last_read_message_id)
+
     def to_json(self, user):
         """
         Return a dictionary representation
         of current message.
 
-        :param user: current user (needed to get the chat name)
+        :param user: current user (needed to get the chat name
+                     and to check if the message was read)
         :returns: Message model instance turned into a dictionary
         """
-        if not self.recipient:
-            recipient_username = ''
-        else:
-            recipient_username = self.recipient.username
-    
-        message = {'id': self.id,
-                   'chat_id': self.chat_id,
-                   'was_read': self.was_read,
-                   'date_created': self.date_created,
-                   'text': self.text,
-                   'sender_username': self.sender.username,
-                   'recipient_username': recipient_username,
-                   'chat_name': self.chat.get_name(user)}
-        return message
+        return Message.to_json_list([self], user, self.chat)[0]
     
+    @staticmethod
+    def to_json_list(messages, user, chat):
+        """
+        Return a list of dictionary representations
+        of the given messages from the given chat (see to_json).
+        The chat name and the user's read cursor
+        are selected once for all messages,
+        so the messages should have their senders and recipients loaded
+        (see get_page).
+
+        :param messages: list of Message model instances
+        :param user: current user
+        :param chat: Chat model instance
+        :returns: list of dictionaries
+        """
+        chat_name = chat.get_name(user)
+        last_read_message_id = user.get_last_read_message_id(chat) or 0
+        message_dict_list = []
+        for message in messages:
+            if not message.recipient:
+                recipient_username = ''
+            else:
+                recipient_username = message.recipient.username
+            was_read = (message.sender_id == user.id
+                        or message.id <= last_read_message_id)
+            message_dict = {'id': message.id,
+                            'chat_id': message.chat_id,
+                            'was_read': was_read,
+                            'date_created': message.date_created,
+                            'text': message.text,
+                            'sender_username': message.sender.username,
+                            'recipient_username': recipient_username,
+                            'chat_name': chat_name}
+            message_dict_list.append(message_dict)
+        return message_dict_list
+
     @staticmethod
     def get_messages_list(message_query):
         """
@@ -1040,13 +1886,17 @@ class Message(database.Model):
         'text', 'sender_username', 'date_created'
         for the messages from the given message_query
         sorted by modification date in ascending order.
+        Senders are selected by the same statement as the messages.
 
         :param message_query: Message model query
         :returns: list of dictionaries
         """
 
         message_dict_list = []
-        for message in message_query.order_by(Message.date_created).all():
+        for message in (message_query
+                        .options(joinedload(Message.sender))
+                        .order_by(Message.date_created)
+                        .all()):
             sender = message.sender
             sender_username = sender.username if sender else None
             date_created = message.date_created
@@ -1056,6 +1906,75 @@ class Message(database.Model):
             message_dict_list.append(message_dict)
         return message_dict_list
     
+    @staticmethod
+    def parse_cursor(cursor):
+        """
+        Return the creation date and the id
+        encoded in the given cursor (see get_cursor).
+
+        :param cursor: string
+        :returns: tuple (DateTime instance, integer)
+        :raises ValidationError: if the cursor is malformed
+        """
+        try:
+            date_created, _, message_id = str(cursor).rpartition('_')
+            return datetime.fromisoformat(date_created), int(message_id)
+        except ValueError:
+            raise ValidationError('Invalid cursor.')
+
+    @staticmethod
+    def get_page(message_query, before=None, after=None, per_page=None):
+        """
+        Return a page of messages from the given message_query
+        sorted by creation date and id in ascending order.
+        Pages are selected by the key (creation date, id)
+        instead of an offset, so every page costs the same:
+        - if after is given, the messages right after it are returned;
+        - if before is given, the messages right before it are returned;
+        - otherwise the newest messages are returned.
+        Senders and recipients are selected by the same statement
+        as the messages.
+
+        :param message_query: Message model query
+        :param before: cursor string or None
+        :param after: cursor string or None
+        :param per_page: maximum number of messages,
+                         MESSAGES_PER_PAGE by default
+        :returns: tuple (list of Message model instances, bool),
+                  the second item is True if there are more messages
+                  beyond the page in the direction of pagination
+        """
+        if per_page is None:
+            per_page = current_app.config['MESSAGES_PER_PAGE']
+        if after is not None:
+            date_created, message_id = Message.parse_cursor(after)
+            query = (message_query
+                     .filter(or_(Message._date_created > date_created,
+                                 and_(Message._date_created == date_created,
+                                      Message.id > message_id)))
+                     .order_by(Message._date_created, Message.id))
+        else:
+            query = message_query
+            if before is not None:
+                date_created, message_id = Message.parse_cursor(before)
+                query = (query
+                         .filter(or_(Message._date_created < date_created,
+                                     and_(Message
+                                          ._date_created == date_created,
+                                          Message.id < message_id))))
+            query = query.order_by(Message._date_created.desc(),
+                                   Message.id.desc())
+        messages = (query
+                    .options(joinedload(Message.sender),
+                             joinedload(Message.recipient))
+                    .limit(per_page + 1)
+                    .all())
+        has_more = len(messages) > per_page
+        messages = messages[:per_page]
+        if after is None:
+            messages.reverse()
+        return messages, has_more
+
     @staticmethod
     def from_json(json_message):
         """
@@ -1074,16 +1993,113 @@ class Message(database.Model):
         except (LookupError, ValueError):
             pass
 
-    @staticmethod  
-    def flush_messages(message_query):
+
+class UserPrincipal:
+    """
+    Lightweight stand-in for the logged in user
+    holding the fields needed for authentication and authorization.
+    Any other attribute (columns, relationships, methods)
+    is looked up on the User model instance,
+    which is loaded on first use.
+
+
+    Methods defined here:
+
+    get_id()
+
+    get_fields()
+
+    get_user()
+
+    has_permission(permission)
+
+
+    Static methods defined here:
+
+    from_user(user)
+    """
+    __slots__ = ('id', 'username', 'confirmed', 'permissions', 'user')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, confirmed, permissions, user=None):
+        self.id = id
+        self.username = username
+        self.confirmed = confirmed
+        self.permissions = permissions
+        self.user = user
+
+    def __getattr__(self, name):
+        return getattr(self.get_user(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, (User, UserPrincipal)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'UserPrincipal(id={self.id}, username={self.username})'
+
+    @staticmethod
+    def from_user(user):
         """
-        Set 'was_read' column to True for all messages 
-        from the given message_query.
+        Return a principal of the given user.
 
-        :param message_query: Message model query
+        :param user: User model instance
+        :returns: UserPrincipal instance
         """
-        message_query.update({'was_read': True}, synchronize_session=False)
-        database.session.commit()
+        permissions = None if user.role is None else user.role.permissions
+        return UserPrincipal(user.id, user.username, user.confirmed,
+                             permissions, user)
+
+    def get_id(self):
+        return str(self.id)
+
+    def get_fields(self):
+        """
+        Return the cached fields of current principal.
+
+        :returns: tuple (id, username, confirmed, permissions)
+        """
+        return (self.id, self.username, self.confirmed, self.permissions)
+
+    def get_user(self):
+        """
+        Return the User model instance of current principal
+        loading it from the database on first call.
+
+        :returns: User model instance
+        """
+        if self.user is None:
+            self.user = User.query.get(self.id)
+        return self.user
+
+    def has_permission(self, permission):
+        """
+        Check if current principal's role has the given permission.
+
+        :param permission: integer representing permission
+        :returns: True if current user has a role
+                  and the role has permission,
+                  False otherwise
+        """
+        return (self.permissions is not None
+                and (self.permissions & permission == permission))
+
+    @property
+    def is_admin(self):
+        return self.has_permission(Permission.ADMINISTRATION)
 
 
 class AnonymousUser(AnonymousUserMixin):
@@ -1100,3 +2116,95 @@ class Permission:
 
 
 login_manager.anonymous_user = AnonymousUser
+
+
+@event.listens_for(database.session, 'after_flush')
+def on_flush_refresh_display_names(session, flush_context):
+    """
+    Refresh the display names of the chats
+    whose names or sets of users were changed by the flush
+    and of the chats of the users whose usernames were changed.
+    """
+    chat_ids = set()
+    renamed_user_ids = set()
+    for instance in session.new | session.deleted:
+        if isinstance(instance, ChatReadState):
+            chat_ids.add(instance.chat_id)
+    for instance in session.dirty:
+        if (isinstance(instance, Chat)
+                and inspect(instance).attrs.name.history.has_changes()):
+            chat_ids.add(instance.id)
+        elif (isinstance(instance, User)
+                and inspect(instance).attrs.username.history.has_changes()):
+            renamed_user_ids.add(instance.id)
+    connection = session.connection()
+    if renamed_user_ids:
+        chat_ids.update(chat_id for chat_id, in connection.execute(
+            select([UserChatTable.c.chat_id])
+            .where(UserChatTable.c.user_id.in_(renamed_user_ids))))
+    Chat.refresh_display_names(chat_ids, connection)
+
+
+@event.listens_for(database.session, 'after_commit')
+@event.listens_for(database.session, 'after_rollback')
+def on_transaction_end_invalidate_chat_names(session):
+    """
+    Drop the cached names of the chats
+    whose users were changed in the transaction (see membership_changed),
+    also on rollback: names read inside the transaction may have been cached.
+    """
+    for chat_id in session.info.pop('changed_chat_ids', ()):
+        chat_name_cache.invalidate_group(chat_id)
+
+
+@event.listens_for(User, 'after_update')
+def on_user_update_invalidate_principal(mapper, connection, target):
+    """
+    Drop the cached principal of a user
+    whose cached fields or password change.
+    """
+    attributes = inspect(target).attrs
+    if any(attributes[name].history.has_changes()
+           for name in ('confirmed', 'role_id', 'role',
+                        'password_hash', 'username')):
+        user_principal_cache.invalidate((target.id,))
+
+
+@event.listens_for(User, 'after_update')
+def on_user_update_invalidate_credentials(mapper, connection, target):
+    """
+    Drop the cached credential checks of a user
+    whose password or email changes.
+    """
+    attributes = inspect(target).attrs
+    if (attributes.password_hash.history.has_changes()
+            or attributes.email.history.has_changes()):
+        for email in attributes.email.history.sum():
+            credentials_cache.invalidate_group(email)
+
+
+@event.listens_for(User, 'after_delete')
+def on_user_delete_invalidate_principal(mapper, connection, target):
+    user_principal_cache.invalidate((target.id,))
+
+
+@event.listens_for(Role, 'after_update')
+def on_role_update_clear_principals(mapper, connection, target):
+    """
+    Drop all cached principals when role permissions change.
+    """
+    if inspect(target).attrs.permissions.history.has_changes():
+        user_principal_cache.clear()
+
+
+@event.listens_for(User, 'after_update')
+def on_username_update_clear_chat_names(mapper, connection, target):
+    """
+    Drop the cached chat names when a username changes
+    (the cache is not indexed by the users whose names it holds).
+    """
+    if inspect(target).attrs.username.history.has_changes():
+        chat_name_cache.clear()
+
+
+username_index = TrigramIndex(User, 'username')
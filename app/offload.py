@@ -0,0 +1,144 @@
+"""
+CPU-bound work off the gevent event loop.
+
+A greenlet computing a password hash holds the loop
+until it finishes, stalling every other request and socket
+of the worker. ThreadOffload runs such functions
+in a pool of native threads instead, the calling greenlet
+waits for the result while the loop serves the others
+(hashlib releases the GIL while hashing).
+LoopLagMonitor measures how late the loop wakes up a sleeping greenlet,
+which is the delay every socket of the worker sees.
+"""
+import gevent, time
+from gevent.threadpool import ThreadPool
+
+from .metrics import metrics
+
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class ThreadOffload:
+    """
+    Runs functions in a pool of 'size' native threads,
+    the pool is created on first use in the calling thread's hub.
+
+    Reports the metrics <name>_in_flight, <name>_completed,
+    <name>_failed and <name>_run_seconds.
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    configure(size)
+
+    run(function, *args, **kwargs)
+    """
+    def __init__(self, name='offload', size=4):
+        self.name = name
+        self.pool = None
+        self.in_flight = metrics.gauge(f'{name}_in_flight',
+                                       'Functions running in threads')
+        self.completed = metrics.counter(f'{name}_completed',
+                                         'Functions finished in threads')
+        self.failed = metrics.counter(f'{name}_failed',
+                                      'Functions finished in threads '
+                                      'with an exception')
+        self.run_seconds = metrics.histogram(f'{name}_run_seconds',
+                                             'Time from submission '
+                                             'to result')
+        self.configure(size)
+
+    def init_app(self, app):
+        self.configure(app.config['OFFLOAD_POOL_SIZE'])
+
+    def configure(self, size):
+        """
+        Set the number of threads,
+        the running functions of the previous pool finish in it.
+
+        :param size: integer
+        """
+        if self.pool is not None:
+            self.pool.kill()
+        self.size = size
+        self.pool = None
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) in a thread of the pool
+        and return its result (or raise its exception),
+        the calling greenlet waits without blocking the loop.
+
+        :param function: callable
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.size)
+        started = time.monotonic()
+        self.in_flight.inc()
+        try:
+            result = self.pool.apply(function, args, kwargs)
+            self.completed.inc()
+            return result
+        except Exception:
+            self.failed.inc()
+            raise
+        finally:
+            self.in_flight.dec()
+            self.run_seconds.observe(time.monotonic() - started)
+
+
+class LoopLagMonitor:
+    """
+    Greenlet sleeping for 'interval' seconds in a loop
+    and recording how much later than requested it wakes up.
+
+    Reports the metrics event_loop_lag_seconds (histogram)
+    and event_loop_lag_last_seconds (gauge).
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    start(interval)
+
+    stop()
+    """
+    def __init__(self):
+        self.greenlet = None
+        self.lag = metrics.histogram('event_loop_lag_seconds',
+                                     'Delay of the event loop '
+                                     'waking up a sleeping greenlet',
+                                     LAG_BUCKETS)
+        self.last_lag = metrics.gauge('event_loop_lag_last_seconds',
+                                      'Last measured event loop delay')
+
+    def init_app(self, app):
+        interval = app.config['LOOP_LAG_INTERVAL']
+        if interval > 0:
+            self.start(interval)
+
+    def start(self, interval):
+        """
+        Start measuring if not started yet.
+
+        :param interval: seconds between measurements
+        """
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self.measure, interval)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def measure(self, interval):
+        while True:
+            started = time.monotonic()
+            gevent.sleep(interval)
+            lag = max(time.monotonic() - started - interval, 0)
+            self.lag.observe(lag)
+            self.last_lag.set(lag)
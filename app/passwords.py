@@ -0,0 +1,67 @@
+"""
+Password hashing policy.
+
+Hashes are werkzeug strings '<method>$<salt>$<hash>',
+the method records the algorithm and its cost
+(e.g. 'pbkdf2:sha256:150000'), so a stored hash can be compared
+with the configured PASSWORD_HASH_METHOD and PASSWORD_SALT_LENGTH
+and replaced on the next successful login (see User.verify_password).
+Hashing runs in a thread (see app.offload.ThreadOffload).
+"""
+from flask import current_app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from . import cpu_offload
+
+
+def get_method():
+    """
+    Return the configured hash method
+    with the number of iterations made explicit.
+
+    :returns: string
+    """
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        method = f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+    return method
+
+
+def hash_password(password):
+    """
+    Return a hash of the given password made with the configured policy.
+
+    :param password: string
+    :returns: string
+    """
+    return cpu_offload.run(generate_password_hash,
+                           password,
+                           get_method(),
+                           current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def check_password(password_hash, password):
+    """
+    Check if the given password matches the given hash.
+
+    :param password_hash: string
+    :param password: string
+    :returns: True if the password matches, False otherwise
+    """
+    return cpu_offload.run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """
+    Check if the given hash was made with a method
+    or a salt length other than the configured ones.
+
+    :param password_hash: string
+    :returns: True if the password should be hashed again
+    """
+    if password_hash.count('$') < 2:
+        return True
+    method, salt, _ = password_hash.split('$', 2)
+    return (method != get_method()
+            or len(salt) < current_app.config['PASSWORD_SALT_LENGTH'])
@@ -0,0 +1,237 @@
+import time
+from array import array
+from bisect import bisect_left
+
+
+# separates the lowercase key from the original text in an entry,
+# sorts before any other character,
+# so entries are ordered by their keys
+SEPARATOR = '\x00'
+# sorts after any character of a key
+MAX_CHARACTER = '\U0010ffff'
+# batches of at least this many rows are merged by sorting
+BATCH_THRESHOLD = 16
+
+
+class PrefixIndex:
+    """
+    Process-local index of (id, text) pairs
+    answering case-insensitive prefix queries in sorted order.
+
+    Entries are kept in two parallel arrays sorted by lowercase text:
+    a list of strings '<lowercase text>\\x00<text>'
+    and an array of 64-bit ids,
+    so a prefix query is two binary searches and a slice.
+    The index disables itself (and is emptied)
+    if it would hold more than max_size entries,
+    callers then fall back to the database.
+    A disabled index stays disabled until it is cleared
+    and is never stale, so it is not loaded again.
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    clear()
+
+    build(rows)
+
+    add_many(rows)
+
+    add(owner_id, text)
+
+    remove(owner_id, text)
+
+    disable()
+
+    is_stale()
+
+    count(prefix, exclude=None)
+
+    search(prefix, exclude=None, offset=0, limit=None)
+    """
+    def __init__(self, max_size=1000000, refresh_interval=5):
+        self.max_size = max_size
+        self.refresh_interval = refresh_interval
+        self.clear()
+
+    def init_app(self, app):
+        self.max_size = app.config['USERNAME_INDEX_MAX_SIZE']
+        self.refresh_interval = app.config['USERNAME_INDEX_REFRESH_INTERVAL']
+        self.clear()
+
+    def clear(self):
+        """
+        Drop all entries, the index has to be built again.
+        """
+        self.entries = []
+        self.ids = array('q')
+        self.last_id = 0
+        self.enabled = True
+        self.is_built = False
+        self.refreshed_at = None
+
+    def build(self, rows):
+        """
+        Replace the entries by the given rows.
+
+        :param rows: iterable of tuples (integer id, string)
+        """
+        self.clear()
+        self.add_many(rows)
+        self.is_built = True
+
+    def add_many(self, rows):
+        """
+        Add the given rows which are not in the index yet,
+        re-sorting the arrays once for a large batch
+        instead of inserting the rows one by one.
+        Advances last_id, so it must be given every row
+        with a greater id than last_id (they are read with 'id > last_id').
+
+        :param rows: iterable of tuples (integer id, string)
+        """
+        rows = list(rows)
+        self.refreshed_at = time.monotonic()
+        if not self.enabled or not rows:
+            return
+        self.last_id = max(self.last_id,
+                           max(owner_id for owner_id, _ in rows))
+        rows = [(owner_id, text) for owner_id, text in dict.fromkeys(rows)
+                if self.find(owner_id, text) is None]
+        if len(self.entries) + len(rows) > self.max_size:
+            self.disable()
+        elif len(rows) < BATCH_THRESHOLD:
+            for owner_id, text in rows:
+                self.add(owner_id, text)
+        else:
+            pairs = list(zip(self.entries, self.ids))
+            pairs.extend((self.get_entry(text), owner_id)
+                         for owner_id, text in rows)
+            pairs.sort()
+            self.entries = [entry for entry, _ in pairs]
+            self.ids = array('q', (owner_id for _, owner_id in pairs))
+
+    def add(self, owner_id, text):
+        """
+        Insert a single row (e.g. a user who has just signed up).
+        Does not advance last_id: rows with smaller ids
+        may have been added by other processes in the meantime.
+
+        :param owner_id: integer
+        :param text: string
+        """
+        if not self.enabled or self.find(owner_id, text) is not None:
+            return
+        if len(self.entries) >= self.max_size:
+            self.disable()
+            return
+        entry = self.get_entry(text)
+        position = bisect_left(self.entries, entry)
+        self.entries.insert(position, entry)
+        self.ids.insert(position, owner_id)
+
+    def remove(self, owner_id, text):
+        """
+        Delete a single row if present.
+
+        :param owner_id: integer
+        :param text: string
+        """
+        position = self.find(owner_id, text)
+        if position is not None:
+            del self.entries[position]
+            del self.ids[position]
+
+    def disable(self):
+        """
+        Drop all entries and stop accepting new ones
+        because there are more than max_size of them.
+        last_id is kept and the index counts as built and refreshed.
+        """
+        self.entries = []
+        self.ids = array('q')
+        self.enabled = False
+        self.is_built = True
+        self.refreshed_at = time.monotonic()
+
+    def is_stale(self):
+        """
+        Check if the index has to be built
+        or rows added by other processes should be loaded
+        (see refresh_interval).
+        A disabled index is never stale.
+        """
+        if not self.enabled:
+            return False
+        return (not self.is_built
+                or self.refreshed_at is None
+                or (time.monotonic() - self.refreshed_at
+                    > self.refresh_interval))
+
+    def count(self, prefix, exclude=None):
+        """
+        Return the number of rows starting with the given prefix.
+
+        :param prefix: string
+        :param exclude: tuple (id, text) of a row not to count or None
+        :returns: integer
+        """
+        start, end = self.get_range(prefix)
+        skipped = self.get_skipped(start, end, exclude)
+        return end - start - (skipped is not None)
+
+    def search(self, prefix, exclude=None, offset=0, limit=None):
+        """
+        Return rows starting with the given prefix
+        sorted by lowercase text.
+
+        :param prefix: string
+        :param exclude: tuple (id, text) of a row to leave out or None
+        :param offset: number of matching rows to skip
+        :param limit: maximum number of rows or None
+        :returns: list of tuples (integer id, string)
+        """
+        start, end = self.get_range(prefix)
+        skipped = self.get_skipped(start, end, exclude)
+        first = start + offset
+        if skipped is not None and skipped < first:
+            first += 1
+        last = end if limit is None else min(end, first + limit)
+        if skipped is not None and first <= skipped < last:
+            last = min(end, last + 1)
+        return [(self.ids[position], self.get_text(self.entries[position]))
+                for position in range(first, last)
+                if position != skipped]
+
+    @staticmethod
+    def get_entry(text):
+        return f'{text.lower()}{SEPARATOR}{text}'
+
+    @staticmethod
+    def get_text(entry):
+        return entry.partition(SEPARATOR)[2]
+
+    def get_range(self, prefix):
+        prefix = prefix.lower()
+        return (bisect_left(self.entries, prefix),
+                bisect_left(self.entries, prefix + MAX_CHARACTER))
+
+    def find(self, owner_id, text):
+        entry = self.get_entry(text)
+        position = bisect_left(self.entries, entry)
+        while (position < len(self.entries)
+               and self.entries[position] == entry):
+            if self.ids[position] == owner_id:
+                return position
+            position += 1
+        return None
+
+    def get_skipped(self, start, end, exclude):
+        if exclude is None:
+            return None
+        position = self.find(*exclude)
+        if position is not None and start <= position < end:
+            return position
+        return None
@@ -0,0 +1,253 @@
+import os, sys, time
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .exceptions import StatementBudgetExceeded
+from .metrics import metrics
+
+
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIRECTORY = os.path.dirname(APP_DIRECTORY)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# call sites listed when a handler exceeds its budget
+WORST_SITES = 5
+
+
+class QueryCounter:
+    """
+    Context manager counting SQL statements
+    executed by the database engine.
+
+
+    Usage:
+
+    with QueryCounter() as counter:
+        user.get_updated_chats(chat_id)
+    print(counter.count)
+    """
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        if self.engine is None:
+            from . import database
+            self.engine = database.engine
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, conn, cursor, statement,
+                   parameters, context, executemany):
+        """
+        Record the given statement.
+        """
+        self.count += 1
+        self.statements.append(statement)
+
+
+class StatementProfile:
+    """
+    SQL statements executed while handling
+    a single HTTP request or socket event,
+    counted with their time by call site
+    (the closest line of the application's code).
+
+
+    Methods defined here:
+
+    record(site, seconds)
+
+    get_worst_sites(limit=WORST_SITES)
+
+    format_worst_sites(limit=WORST_SITES)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.seconds = 0
+        self.sites = {}
+
+    def record(self, site, seconds):
+        """
+        Count a statement.
+
+        :param site: string 'file:line in function'
+        :param seconds: time spent executing the statement
+        """
+        self.count += 1
+        self.seconds += seconds
+        site_count, site_seconds = self.sites.get(site, (0, 0))
+        self.sites[site] = (site_count + 1, site_seconds + seconds)
+
+    def get_worst_sites(self, limit=WORST_SITES):
+        """
+        Return the call sites executing the most statements.
+
+        :param limit: maximum number of call sites
+        :returns: list of tuples (site, count, seconds)
+        """
+        sites = sorted(self.sites.items(),
+                       key=lambda item: item[1],
+                       reverse=True)
+        return [(site, site_count, site_seconds)
+                for site, (site_count, site_seconds) in sites[:limit]]
+
+    def format_worst_sites(self, limit=WORST_SITES):
+        return '\n'.join(f'    {site_count:4} statements '
+                         f'{site_seconds * 1000:8.1f} ms  {site}'
+                         for site, site_count, site_seconds
+                         in self.get_worst_sites(limit))
+
+
+class StatementProfiler:
+    """
+    Counts SQL statements and their time
+    per HTTP request (named by endpoint, e.g. 'main.index')
+    and per socket event (named 'socket:<event>', see
+    main.decorators.instrumented).
+
+    A handler executing more statements than its budget
+    (SQL_STATEMENT_BUDGETS by name, else SQL_STATEMENT_BUDGET)
+    is logged with its worst call sites and kept in 'violations';
+    with SQL_STATEMENT_BUDGET_STRICT StatementBudgetExceeded is raised.
+    Configuration is read on every request, so tests can change it.
+    Reports the metrics handler_statements and handler_db_seconds
+    labelled with the handler's name.
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    start(name)
+
+    finish()
+
+    get_budget(name)
+    """
+    def __init__(self):
+        self.violations = []
+
+    def init_app(self, app):
+        self.violations = []
+        # the application object is reused by create_app
+        if self.start_request not in app.before_request_funcs.get(None, ()):
+            app.before_request(self.start_request)
+            app.teardown_request(self.finish_request)
+
+    def start(self, name):
+        """
+        Start counting the statements of the current request context.
+
+        :param name: string
+        """
+        if current_app.config['SQL_PROFILER_ENABLED']:
+            request.statement_profile = StatementProfile(name)
+
+    def finish(self):
+        """
+        Stop counting, record the metrics and check the budget.
+
+        :returns: StatementProfile instance or None if not started
+        """
+        profile = get_profile()
+        if profile is None:
+            return None
+        request.statement_profile = None
+        labels = {'handler': profile.name}
+        (metrics
+         .histogram('handler_statements',
+                    'SQL statements per request or socket event',
+                    STATEMENT_BUCKETS,
+                    labels=labels)
+         .observe(profile.count))
+        (metrics
+         .histogram('handler_db_seconds',
+                    'SQL execution time per request or socket event',
+                    labels=labels)
+         .observe(profile.seconds))
+        budget = self.get_budget(profile.name)
+        if budget is not None and profile.count > budget:
+            self.violations.append(profile)
+            message = (f'{profile.name} executed {profile.count} '
+                       f'SQL statements (budget {budget}) '
+                       f'in {profile.seconds * 1000:.1f} ms, '
+                       f'worst call sites:\n'
+                       f'{profile.format_worst_sites()}')
+            if current_app.config['SQL_STATEMENT_BUDGET_STRICT']:
+                raise StatementBudgetExceeded(message)
+            current_app.logger.warning(message)
+        return profile
+
+    def get_budget(self, name):
+        """
+        Return the maximum number of statements of the given handler.
+
+        :param name: string
+        :returns: integer or None if unlimited
+        """
+        return (current_app
+                .config['SQL_STATEMENT_BUDGETS']
+                .get(name, current_app.config['SQL_STATEMENT_BUDGET']))
+
+    def start_request(self):
+        if request.endpoint is not None:
+            self.start(request.endpoint)
+
+    def finish_request(self, exception):
+        self.finish()
+
+
+def get_profile():
+    """
+    Return the statement profile of the current request context.
+
+    :returns: StatementProfile instance or None
+    """
+    if has_request_context():
+        return getattr(request, 'statement_profile', None)
+    return None
+
+
+site_names = {}
+
+
+def get_call_site():
+    """
+    Return the innermost line of the application's code
+    on the stack outside of this module.
+
+    :returns: string 'file:line in function'
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIRECTORY) and filename != __file__:
+            name = site_names.get(filename)
+            if name is None:
+                name = os.path.relpath(filename, PROJECT_DIRECTORY)
+                site_names[filename] = name
+            return f'{name}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'outside of the application'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement,
+                    parameters, context, executemany):
+    if get_profile() is not None:
+        context.profiler_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement,
+                     parameters, context, executemany):
+    profile = get_profile()
+    started = getattr(context, 'profiler_started', None)
+    if profile is not None and started is not None:
+        profile.record(get_call_site(), time.perf_counter() - started)
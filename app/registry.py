@@ -0,0 +1,180 @@
+from collections import defaultdict
+
+
+class MemoryBackend:
+    """
+    Socket registry backend keeping socket ids
+    in a dictionary of the current process.
+    Suitable for a single worker and for tests.
+
+
+    Methods defined here:
+
+    add(user_id, sid)
+
+    remove(user_id, sid)
+
+    get(user_id)
+    """
+    def __init__(self):
+        self.sids = defaultdict(set)
+
+    def add(self, user_id, sid):
+        self.sids[user_id].add(sid)
+
+    def remove(self, user_id, sid):
+        sids = self.sids.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self.sids[user_id]
+
+    def get(self, user_id):
+        return set(self.sids.get(user_id, ()))
+
+
+class RedisBackend:
+    """
+    Socket registry backend keeping socket ids
+    in a Redis set per user, shared by all workers and hosts.
+    Every set expires after ttl seconds without new connections,
+    so socket ids left by a killed worker do not stay forever.
+
+
+    Methods defined here:
+
+    add(user_id, sid)
+
+    remove(user_id, sid)
+
+    get(user_id)
+    """
+    def __init__(self, url, ttl, key_prefix='socket_registry'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+
+    def get_key(self, user_id):
+        return f'{self.key_prefix}:{user_id}'
+
+    def add(self, user_id, sid):
+        key = self.get_key(user_id)
+        (self
+         .client
+         .pipeline()
+         .sadd(key, sid)
+         .expire(key, self.ttl)
+         .execute())
+
+    def remove(self, user_id, sid):
+        self.client.srem(self.get_key(user_id), sid)
+
+    def get(self, user_id):
+        return {sid.decode()
+                for sid
+                in self.client.smembers(self.get_key(user_id))}
+
+
+class SocketRegistry:
+    """
+    Registry of the open sockets of every user.
+    A user may have several sockets (one per browser tab).
+    The backend is chosen by the SOCKET_REGISTRY_URL setting:
+    Redis if the URL is given, the current process' memory otherwise.
+
+    Every socket also joins the user's room (see get_room),
+    so events for all of the user's tabs are emitted to the room
+    and delivered through the Socket.IO message queue
+    by whichever worker holds the socket.
+
+
+    Methods defined here:
+
+    init_app(app)
+
+    add(user_id, sid)
+
+    remove(user_id, sid)
+
+    get_sids(user_id)
+
+    is_online(user_id)
+
+
+    Static methods defined here:
+
+    get_room(user_id)
+
+    get_chat_room(chat_id)
+    """
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('SOCKET_REGISTRY_URL')
+        if url:
+            self.backend = RedisBackend(url,
+                                        app.config['SOCKET_REGISTRY_TTL'])
+        else:
+            self.backend = MemoryBackend()
+
+    def add(self, user_id, sid):
+        """
+        Register the given socket id for the given user.
+
+        :param user_id: integer
+        :param sid: string
+        """
+        self.backend.add(user_id, sid)
+
+    def remove(self, user_id, sid):
+        """
+        Unregister the given socket id of the given user.
+
+        :param user_id: integer
+        :param sid: string
+        """
+        self.backend.remove(user_id, sid)
+
+    def get_sids(self, user_id):
+        """
+        Return the socket ids of the given user.
+
+        :param user_id: integer
+        :returns: set of strings
+        """
+        return self.backend.get(user_id)
+
+    def is_online(self, user_id):
+        """
+        Check if the given user has at least one open socket.
+
+        :param user_id: integer
+        :returns: bool
+        """
+        return bool(self.get_sids(user_id))
+
+    @staticmethod
+    def get_room(user_id):
+        """
+        Return the name of the Socket.IO room
+        joined by all sockets of the given user.
+
+        :param user_id: integer
+        :returns: string
+        """
+        return f'user_{user_id}'
+
+    @staticmethod
+    def get_chat_room(chat_id):
+        """
+        Return the name of the Socket.IO room
+        joined by all sockets of the given chat's users.
+
+        :param chat_id: integer
+        :returns: string
+        """
+        return f'chat_{chat_id}'
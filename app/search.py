@@ -0,0 +1,196 @@
+"""
+Substring search over text columns.
+
+'ILIKE %term%' can not use a B-tree index,
+so every searchable column gets a trigram index:
+- in PostgreSQL it is a GIN index with pg_trgm's gin_trgm_ops
+  (created by the migrations and on create_all),
+  which serves ILIKE directly;
+- in other databases it is a side table of (trigram, owner id) rows
+  maintained by ORM events; a search looks up the owners
+  having all the trigrams of the term and checks only them with ILIKE.
+Bulk inserts bypassing the ORM must call TrigramIndex.rebuild().
+"""
+from sqlalchemy import DDL, and_, case, event, func, inspect, select
+
+from . import database
+
+
+TRIGRAM_LENGTH = 3
+
+
+def get_trigrams(text):
+    """
+    Return the set of lowercase substrings
+    of length TRIGRAM_LENGTH of the given text.
+
+    :param text: string or None
+    :returns: set of strings
+    """
+    text = (text or '').lower()
+    return {text[start:start + TRIGRAM_LENGTH]
+            for start in range(len(text) - TRIGRAM_LENGTH + 1)}
+
+
+def escape_like(text):
+    """
+    Escape LIKE wildcards in the given text (escape character is '\\').
+
+    :param text: string
+    :returns: string
+    """
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+class TrigramIndex:
+    """
+    Trigram index of a text column of a model
+    with an integer primary key 'id'.
+
+
+    Methods defined here:
+
+    is_native()
+
+    get_filter(term)
+
+    get_rank(term)
+
+    update(connection, owner_id, text)
+
+    rebuild(connection=None)
+    """
+    def __init__(self, model, column_name):
+        self.model = model
+        self.column_name = column_name
+        self.column = getattr(model, column_name)
+        owner_table = model.__table__
+        name = f'{owner_table.name}_{column_name}'
+        self.table = database.Table(
+            f'{name}_trigrams',
+            database.Column('trigram',
+                            database.String(TRIGRAM_LENGTH),
+                            primary_key=True),
+            database.Column('owner_id',
+                            database.Integer,
+                            database.ForeignKey(f'{owner_table.name}.id',
+                                                ondelete='CASCADE'),
+                            primary_key=True),
+            database.Index(f'ix_{name}_trigrams_owner_id', 'owner_id'))
+        native_index = DDL(f'CREATE EXTENSION IF NOT EXISTS pg_trgm; '
+                           f'CREATE INDEX ix_{name}_trgm '
+                           f'ON {owner_table.name} '
+                           f'USING gin ({column_name} gin_trgm_ops)')
+        event.listen(owner_table, 'after_create',
+                     native_index.execute_if(dialect='postgresql'))
+        event.listen(model, 'after_insert', self.on_insert)
+        event.listen(model, 'after_update', self.on_update)
+        event.listen(model, 'after_delete', self.on_delete)
+
+    def is_native(self):
+        """
+        Check if the database has a native trigram index.
+        """
+        return database.engine.dialect.name == 'postgresql'
+
+    def get_filter(self, term):
+        """
+        Return an SQL condition true for the rows
+        whose column contains the given term (case insensitive).
+
+        :param term: string
+        :returns: SQL expression
+        """
+        contains = self.column.ilike(f'%{escape_like(term)}%', escape='\\')
+        trigrams = get_trigrams(term)
+        if self.is_native() or not trigrams:
+            return contains
+        candidates = (select([self.table.c.owner_id])
+                      .where(self.table.c.trigram.in_(trigrams))
+                      .group_by(self.table.c.owner_id)
+                      .having(func.count() == len(trigrams)))
+        return and_(self.model.id.in_(candidates), contains)
+
+    def get_rank(self, term):
+        """
+        Return an SQL expression evaluating to 0
+        for the rows whose column starts with the given term
+        (case insensitive) and to 1 for the others,
+        for ordering prefix matches first.
+
+        :param term: string
+        :returns: SQL expression
+        """
+        prefix = f'{escape_like(term.lower())}%'
+        return case([(func.lower(self.column).like(prefix, escape='\\'), 0)],
+                    else_=1)
+
+    def update(self, connection, owner_id, text):
+        """
+        Replace the trigrams of the given owner in the side table.
+
+        :param connection: SQLAlchemy connection
+        :param owner_id: integer
+        :param text: new value of the column
+        """
+        connection.execute(self
+                           .table
+                           .delete()
+                           .where(self.table.c.owner_id == owner_id))
+        trigrams = get_trigrams(text)
+        if trigrams:
+            connection.execute(self.table.insert(),
+                               [{'trigram': trigram, 'owner_id': owner_id}
+                                for trigram in trigrams])
+
+    def rebuild(self, connection=None, batch_size=10000):
+        """
+        Fill the side table from scratch
+        (not needed if the index is native).
+
+        :param connection: SQLAlchemy connection,
+                           the session's connection by default
+        :param batch_size: number of owner rows read at a time
+        """
+        if self.is_native():
+            return
+        if connection is None:
+            connection = database.session.connection()
+        connection.execute(self.table.delete())
+        owner_table = self.model.__table__
+        text_column = owner_table.c[self.column_name]
+        last_id = 0
+        while True:
+            rows = connection.execute(select([owner_table.c.id, text_column])
+                                      .where(owner_table.c.id > last_id)
+                                      .order_by(owner_table.c.id)
+                                      .limit(batch_size)).fetchall()
+            if not rows:
+                break
+            trigram_rows = [{'trigram': trigram, 'owner_id': owner_id}
+                            for owner_id, text in rows
+                            for trigram in get_trigrams(text)]
+            if trigram_rows:
+                connection.execute(self.table.insert(), trigram_rows)
+            last_id = rows[-1][0]
+
+    def on_insert(self, mapper, connection, target):
+        if connection.dialect.name != 'postgresql':
+            self.update(connection, target.id,
+                        getattr(target, self.column_name))
+
+    def on_update(self, mapper, connection, target):
+        history = inspect(target).attrs[self.column_name].history
+        if connection.dialect.name != 'postgresql' and history.has_changes():
+            self.update(connection, target.id,
+                        getattr(target, self.column_name))
+
+    def on_delete(self, mapper, connection, target):
+        if connection.dialect.name != 'postgresql':
+            connection.execute(self
+                               .table
+                               .delete()
+                               .where(self.table.c.owner_id == target.id))
@@ -0,0 +1,226 @@
+"""
+Server-side sessions.
+
+The browser keeps only a random session id in the session cookie,
+the session's data is kept by a store shared by HTTP requests
+and socket events: the memory of the current process (an LRU cache)
+or Redis when several workers serve the application.
+A session is written only when it was changed
+(logging in or out, flashing a message, a new CSRF token),
+requests and socket events reading it cost a single lookup
+(and an expiry refresh, see SESSION_REFRESH_EACH_REQUEST).
+"""
+import secrets
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from .cache import LRUCache
+
+
+SESSION_ID_BYTES = 32
+
+
+class StoredSession(CallbackDict, SessionMixin):
+    """
+    Session data loaded from a store,
+    'modified' is set by any assignment or deletion
+    (values may be changed in place and assigned back, e.g. by flash).
+    Sessions are permanent unless made otherwise
+    if 'default_permanent' is set.
+    """
+    def __init__(self, initial=None, sid=None, new=False,
+                 default_permanent=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.default_permanent = default_permanent
+        self.modified = False
+
+    @property
+    def permanent(self):
+        return self.get('_permanent', self.default_permanent)
+
+    @permanent.setter
+    def permanent(self, value):
+        self['_permanent'] = bool(value)
+
+
+class MemorySessionBackend:
+    """
+    Session store backend keeping serialized sessions
+    in an LRU cache of the current process,
+    the least recently used sessions are dropped when it is full.
+    Suitable for a single worker and for tests.
+
+
+    Methods defined here:
+
+    configure(max_size)
+
+    load(sid)
+
+    save(sid, data, ttl)
+
+    touch(sid, ttl)
+
+    delete(sid)
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def configure(self, max_size):
+        self.cache.max_size = max_size
+        self.cache.clear()
+
+    def load(self, sid):
+        return self.cache.get((sid,))
+
+    def save(self, sid, data, ttl):
+        self.cache.set((sid,), data, ttl)
+
+    def touch(self, sid, ttl):
+        data = self.cache.get((sid,))
+        if data is not None:
+            self.cache.set((sid,), data, ttl)
+
+    def delete(self, sid):
+        self.cache.invalidate((sid,))
+
+
+class RedisSessionBackend:
+    """
+    Session store backend keeping serialized sessions
+    in Redis, shared by all workers and hosts.
+    Every session expires ttl seconds after it was last written.
+
+
+    Methods defined here:
+
+    load(sid)
+
+    save(sid, data, ttl)
+
+    touch(sid, ttl)
+
+    delete(sid)
+    """
+    def __init__(self, url, key_prefix='session'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.key_prefix = key_prefix
+
+    def get_key(self, sid):
+        return f'{self.key_prefix}:{sid}'
+
+    def load(self, sid):
+        data = self.client.get(self.get_key(sid))
+        return None if data is None else data.decode()
+
+    def save(self, sid, data, ttl):
+        self.client.set(self.get_key(sid), data, ex=max(int(ttl), 1))
+
+    def touch(self, sid, ttl):
+        self.client.expire(self.get_key(sid), max(int(ttl), 1))
+
+    def delete(self, sid):
+        self.client.delete(self.get_key(sid))
+
+
+class StoreSessionInterface(SessionInterface):
+    """
+    Flask session interface loading sessions from a backend
+    by the id in the session cookie.
+    Sessions are serialized with the same tagged JSON
+    as Flask's cookie sessions and written only if modified,
+    empty sessions are neither stored nor given a cookie.
+    Unchanged permanent sessions have their expiry refreshed
+    (in the store and in the cookie) on every request
+    if SESSION_REFRESH_EACH_REQUEST is set, as Flask's cookie sessions do.
+    """
+    serializer = TaggedJSONSerializer()
+    session_class = StoredSession
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        permanent = app.config['SESSION_PERMANENT']
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self.backend.load(sid)
+            if data is not None:
+                try:
+                    return self.session_class(self.serializer.loads(data),
+                                              sid=sid,
+                                              default_permanent=permanent)
+                except ValueError:
+                    self.backend.delete(sid)
+        return self.session_class(sid=secrets.token_urlsafe(SESSION_ID_BYTES),
+                                  new=True,
+                                  default_permanent=permanent)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain,
+                                       path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.modified:
+            self.backend.save(session.sid,
+                              self.serializer.dumps(dict(session)),
+                              lifetime)
+        else:
+            self.backend.touch(session.sid, lifetime)
+        session.modified = False
+        session.new = False
+        response.set_cookie(app.session_cookie_name,
+                            session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain,
+                            path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+class SessionStore:
+    """
+    Server-side session store of the application.
+    The backend is chosen by the SESSION_STORE_URL setting:
+    Redis if the URL is given, an LRU cache of at most
+    SESSION_CACHE_SIZE sessions in the current process' memory otherwise.
+    Sessions expire PERMANENT_SESSION_LIFETIME after they were last changed,
+    permanent ones (SESSION_PERMANENT) and their cookies
+    after the last request if SESSION_REFRESH_EACH_REQUEST is set.
+
+    Reports the metrics of the in-memory cache
+    (session_cache_hits, session_cache_misses, ...).
+
+
+    Methods defined here:
+
+    init_app(app)
+    """
+    def __init__(self):
+        self.cache = LRUCache('session_cache')
+        self.backend = None
+
+    def init_app(self, app):
+        url = app.config.get('SESSION_STORE_URL')
+        if url:
+            self.backend = RedisSessionBackend(url)
+        else:
+            self.backend = MemorySessionBackend(self.cache)
+            self.backend.configure(app.config['SESSION_CACHE_SIZE'])
+        app.session_interface = StoreSessionInterface(self.backend)
@@ -4,6 +4,7 @@
 // server sends numbers as strings on requests
 // assume moment.js is loaded
 // assume socket.io is loaded
+// assume CURRENT_USERNAME is defined by the page
 
 
 // constants
@@ -254,6 +255,15 @@ class ChatWindow {
         
     }).bind(this));
 
+    this.chatList.addEventListener("scroll", (function() {
+      const scroll = this.chatList.scrollHeight 
+                     - this.chatList.scrollTop
+                     - this.chatList.clientHeight;
+      if (-1 < scroll && scroll < 1 && !this.isSearching()) {
+        this.loadChats(this.getPageNumber());
+      }
+    }).bind(this));
+
     this
     .chatSearchInput.addEventListener("input", (function () {
       if (this.chatSearchInput.value 
@@ -283,6 +293,17 @@ class ChatWindow {
     }
   };
 
+  incrementUnreadCount(chatId) {
+    let chatItem = document.getElementById(CHAT_PREFIX + chatId);
+    let chatNameSpan = document.querySelector("#" + chatItem.id + " span");
+    let messagesCountSpan = chatNameSpan.nextElementSibling;
+    let unreadMessagesCount = 1;
+    if (messagesCountSpan) {
+      unreadMessagesCount += Number(messagesCountSpan.innerText);
+    }
+    this.setChatAsUpdated(chatId, unreadMessagesCount);
+  };
+
   unsetChatAsUpdated(chatId) {
     let chatItem = document.getElementById(CHAT_PREFIX + chatId);
     let chatNameSpan = document.querySelector("#" + chatItem.id + " span");
@@ -296,6 +317,11 @@ class ChatWindow {
     return Math.trunc(this.chats.size / this.CHATS_PER_PAGE + 1);
   };
 
+  isSearching() {
+    return Boolean(this.chatSearchInput.value 
+                   && this.chatSearchInput.value.length > 2);
+  };
+
   setChats() {
     if (this.chatList) {
       for (let chat of this.chatList.children) {
@@ -353,7 +379,7 @@ class ChatWindow {
     SOCKET.emit("choose_chat", {chat_id: chatId});
   };
 
-  addChat(chatName, chatId, clearArea=false) {
+  addChat(chatName, chatId, append=false) {
     if (!this.chats.has(chatId)) {
       let listItem = document.createElement("li");
       let chatNameSpan = document.createElement("span");
@@ -365,7 +391,7 @@ class ChatWindow {
       }
       chatNameSpan.innerText = " " + chatName;
       listItem.appendChild(chatNameSpan);
-      if (clearArea){
+      if (append){
         this.chatList.appendChild(listItem);
       }
       else {
@@ -375,7 +401,7 @@ class ChatWindow {
     }
   };
 
-  addChats(addedChats, clearArea=true) {
+  addChats(addedChats, clearArea=true, append=clearArea) {
     if (clearArea) {
       this.chatList.innerText = "";
       this.chats.clear();
@@ -383,7 +409,11 @@ class ChatWindow {
     for (let chat of addedChats) {
       this.addChat(chat["chat_name"],
                    chat["chat_id"],
-                   clearArea);
+                   append);
+      if (chat["unread_messages_count"]) {
+        this.setChatAsUpdated(chat["chat_id"], 
+                              chat["unread_messages_count"]);
+      }
     }
     this.userWindowReference.updateAddContactButton();
   };
@@ -436,6 +466,20 @@ class MessageWindow {
     this.sendMessageButton = document.querySelector(sendMessageButtonClass);
     this.chatWindowReference = null;
     this.userWindowReference = null;
+    this.oldestCursor = null;
+    this.hasMoreMessages = false;
+    this.loadingOlderMessages = false;
+
+    this.messageArea.addEventListener("scroll", (function() {
+      const chatId = this.chatWindowReference.selectedChatId;
+      if (this.messageArea.scrollTop < 1 
+          && chatId
+          && this.hasMoreMessages 
+          && !this.loadingOlderMessages) {
+        this.loadingOlderMessages = true;
+        this.loadMessages(chatId, this.oldestCursor);
+      }
+    }).bind(this));
 
     this.sendMessageButton.addEventListener("click", (function(){
         if (this.chatWindowReference.selectedChatId) {
@@ -450,16 +494,28 @@ class MessageWindow {
     
   }
 
-  loadMessages(chatId) {
+  loadMessages(chatId, before=null) {
     SOCKET.emit("load_messages",
-                {"chat_id": chatId})
+                {"chat_id": chatId,
+                 "before": before})
+  };
+
+  setHistory(messages, hasMore) {
+    if (messages.length) {
+      this.oldestCursor = messages[0]["cursor"];
+    }
+    else if (!this.loadingOlderMessages) {
+      this.oldestCursor = null;
+    }
+    this.hasMoreMessages = hasMore;
+    this.loadingOlderMessages = false;
   };
 
   setChatHeader(header) {
     this.chatHeader.innerText = header;
   };
 
-  addMessage(currentUsername, message) {
+  createMessage(currentUsername, message) {
     const text = message["text"];
     const dateCreated = format_date(message["date_created"]);
     const sender_username = message["sender_username"];
@@ -487,12 +543,29 @@ class MessageWindow {
     messageDiv.appendChild(br);
     messageDiv.appendChild(textSpan);
     messageDiv.className = "message";
-    
+    return messageDiv;
+  };
+
+  addMessage(currentUsername, message) {
+    const messageDiv = this.createMessage(currentUsername, message);
     this.messageArea.appendChild(messageDiv);
-    this.messageArea.appendChild(br);
+    this.messageArea.appendChild(document.createElement("br"));
     this.scrollDown();
   };
 
+  prependMessages(currentUsername, messages) {
+    const previousHeight = this.messageArea.scrollHeight;
+    const firstChild = this.messageArea.firstChild;
+    for (let message of messages) {
+      const messageDiv = this.createMessage(currentUsername, message);
+      this.messageArea.insertBefore(messageDiv, firstChild);
+      this.messageArea.insertBefore(document.createElement("br"), 
+                                    firstChild);
+    }
+    this.messageArea.scrollTop = (this.messageArea.scrollHeight 
+                                  - previousHeight);
+  };
+
   addMessages(currentUsername, messages, clearArea = true) {
     if (clearArea) {
       this.messageArea.innerHTML = "";
@@ -556,7 +629,10 @@ chatWindow.setUserWindowReference(userWindow);
 chatWindow.setMessageWindowReference(messageWindow);
 
 
-let SOCKET = io.connect('http://' + document.domain + ':' + location.port);
+// websocket only: polling requests of one client
+// could reach different workers
+let SOCKET = io.connect('http://' + document.domain + ':' + location.port,
+                        {transports: ['websocket']});
 
 
 window
@@ -564,8 +640,17 @@ window
     SOCKET.on("load_messages", function(response) {
       const messages = response["messages"];
       const currentUsername = response["current_username"];
-      messageWindow.addMessages(currentUsername,
-                                messages);
+      if (response["chat_id"] !== chatWindow.selectedChatId) {
+        return;
+      }
+      if (response["before"]) {
+        messageWindow.prependMessages(currentUsername, messages);
+      }
+      else {
+        messageWindow.addMessages(currentUsername,
+                                  messages);
+      }
+      messageWindow.setHistory(messages, response["has_more"]);
     });
     SOCKET.on("search_users", function(response) {
       const foundUsers = response["found_users"];
@@ -600,7 +685,13 @@ window
       if (pageNumber < 2) {
         clearArea = true;
       }
-      chatWindow.addChats(addedChats, clearArea);
+      chatWindow.addChats(addedChats, clearArea, true);
+      // the first page is rendered by the server,
+      // the rest is streamed page by page
+      if (addedChats.length == chatWindow.CHATS_PER_PAGE
+          && !chatWindow.isSearching()) {
+        chatWindow.loadChats(Number(pageNumber) + 1);
+      }
     });
     SOCKET.on("chat_updated", (function(message) {
       const chats = message["chats"];
@@ -622,6 +713,35 @@ window
         }
       }
     }));
+    SOCKET.on("new_message", function(data) {
+      const message = data["message"];
+      const chatId = data["chat_id"];
+      const isOwnMessage = message["sender_username"] === CURRENT_USERNAME;
+      if (!chatWindow.chats.has(chatId)) {
+        // own messages from another tab to a chat not loaded here
+        // show up with the next chat list load
+        if (isOwnMessage || chatWindow.isSearching()) {
+          return;
+        }
+        chatWindow.addChat(data["chat_name"] || message["sender_username"],
+                           chatId);
+      }
+      if (chatWindow.selectedChatId === chatId) {
+        messageWindow.addMessage(CURRENT_USERNAME, message);
+        if (!isOwnMessage) {
+          SOCKET.emit("flush_messages", {chat_id: chatId});
+        }
+      }
+      else if (!isOwnMessage) {
+        chatWindow.incrementUnreadCount(chatId);
+      }
+    });
+    SOCKET.on("join_chat", function(data) {
+      SOCKET.emit("join_chat", {chat_id: data["chat_id"]});
+    });
+    SOCKET.on("join_chats", function(data) {
+      SOCKET.emit("join_chats", {chat_ids: data["chat_ids"]});
+    });
     SOCKET.on("remove_chat", function(data) {
       const chatId = data["chat_id"];
       chatWindow.removeChat(chatId);
@@ -637,6 +757,7 @@ window
       const chatId = data["chat_id"];
       chatWindow.chooseChatItem(currentUsername, chatName, 
                                 chatId, messages);
+      messageWindow.setHistory(messages, data["has_more"]);
     });
     SOCKET.on("send_message", function(data) {
       const message = data["message"];
@@ -661,4 +782,7 @@ window
             chatWindow.showRemoveChatButton();
             messageWindow.loadMessages(chatWindow.selectedChatId);
     }
+    if (chatWindow.chats.size == chatWindow.CHATS_PER_PAGE) {
+      chatWindow.loadChats(2);
+    }
 });
@@ -0,0 +1,83 @@
+"""
+Benchmarks for the application's hot paths.
+
+Every module named bench_*.py in this package
+defines a run() function which prints its results.
+Run them with 'flask benchmark' or 'flask benchmark <name>'.
+Benchmarks create and drop all tables, so they use
+the database given by the BENCHMARK_DATABASE_URI environment variable
+(an in-memory SQLite database by default).
+"""
+import time
+
+from contextlib import contextmanager
+
+from app import database
+from app.models import Role, User, utc_now
+
+
+def set_up_database():
+    """
+    Create empty tables and default roles.
+    """
+    database.drop_all()
+    database.create_all()
+    Role.insert_roles()
+
+
+def tear_down_database():
+    """
+    Drop all tables.
+    """
+    database.session.remove()
+    database.drop_all()
+
+
+def insert_users(count, prefix='user'):
+    """
+    Insert the given number of confirmed users
+    bypassing password hashing and return their ids.
+
+    :param count: number of users
+    :param prefix: prefix of usernames and emails
+    :returns: list of integers
+    """
+    role = Role.query.filter_by(is_default=True).first()
+    last_id = database.session.query(database.func.max(User.id)).scalar() or 0
+    rows = [{'username': f'{prefix}{number}',
+             'email': f'{prefix}{number}@{prefix}.{prefix}',
+             'password_hash': 'hash',
+             'confirmed': True,
+             'role_id': role.id,
+             '_date_created': utc_now()}
+            for number in range(last_id + 1, last_id + count + 1)]
+    database.session.execute(User.__table__.insert(), rows)
+    database.session.commit()
+    return [user_id for user_id, 
+            in (database
+                .session
+                .query(User.id)
+                .filter(User.id > last_id)
+                .order_by(User.id))]
+
+
+@contextmanager
+def timer():
+    """
+    Measure the time spent inside the with-block.
+
+    Usage:
+
+    with timer() as elapsed:
+        do_something()
+    print(elapsed())
+    """
+    start = time.perf_counter()
+    end = None
+
+    def elapsed():
+        return (end or time.perf_counter()) - start
+    try:
+        yield elapsed
+    finally:
+        end = time.perf_counter()
@@ -0,0 +1,68 @@
+"""
+Authentication overhead of the REST API:
+User.verify_auth_token and a whole token-authenticated request
+with empty caches (first request with a token)
+versus warm caches (every following request).
+"""
+from base64 import b64encode
+from flask import current_app
+
+from app import auth_token_cache, database, user_principal_cache
+from app.models import User
+from app.profiling import QueryCounter
+
+from . import insert_users, set_up_database, tear_down_database, timer
+
+
+REPEATS = 1000
+REQUESTS = 200
+
+
+def clear_caches():
+    auth_token_cache.clear()
+    user_principal_cache.clear()
+
+
+def measure(function, repeats, cold):
+    """
+    Return the mean time of the given function
+    and the number of statements of its last call.
+    """
+    total = 0
+    for _ in range(repeats):
+        if cold:
+            clear_caches()
+        database.session.remove()
+        with QueryCounter() as counter, timer() as elapsed:
+            function()
+        total += elapsed()
+    return total / repeats, counter.count
+
+
+def run():
+    set_up_database()
+    try:
+        user = User.query.get(insert_users(1)[0])
+        token = user.generate_auth_token().decode()
+        credentials = b64encode(f'{token}:'.encode()).decode()
+        headers = {'Authorization': f'Basic {credentials}'}
+        client = current_app.test_client()
+
+        def verify():
+            User.verify_auth_token(token)
+
+        def request():
+            response = client.get('/api/v1.0/chats', headers=headers)
+            assert response.status_code == 200, response.status_code
+
+        for name, function, repeats in (('verify_auth_token', verify,
+                                         REPEATS),
+                                        ('GET /api/v1.0/chats', request,
+                                         REQUESTS)):
+            for label, cold in (('cold', True), ('warm', False)):
+                mean, count = measure(function, repeats, cold)
+                print(f'{name:>20} {label}: {mean * 1000:.3f} ms, '
+                      + f'{count} statements')
+    finally:
+        clear_caches()
+        tear_down_database()
@@ -0,0 +1,112 @@
+"""
+Chat search over a user with many chats:
+the previous plan (matching chat names and peers' usernames,
+then Chat.get_name for every chat of the page)
+versus Chat.search_chats_query over the user's display names.
+"""
+from sqlalchemy import and_, or_, select
+
+from app import database
+from app.models import Chat, ChatReadState, User, UserChatTable
+from app.models import username_index
+from app.profiling import QueryCounter
+from app.search import escape_like
+
+from . import insert_users, set_up_database, tear_down_database, timer
+
+
+CHAT_COUNTS = (100, 1000, 5000)
+TERMS = ('user1', 'user42', 'nobody')
+PER_PAGE = 10
+REPEATS = 5
+
+
+def add_chats(user, peer_ids):
+    """
+    Create a chat between the given user and every peer.
+    """
+    chats = [Chat() for peer_id in peer_ids]
+    database.session.add_all(chats)
+    database.session.flush()
+    links = []
+    for chat, peer_id in zip(chats, peer_ids):
+        links.append({'user_id': user.id, 'chat_id': chat.id})
+        links.append({'user_id': peer_id, 'chat_id': chat.id})
+    database.session.execute(UserChatTable.insert(), links)
+    database.session.execute(ChatReadState.__table__.insert(),
+                             [{'user_id': link['user_id'],
+                               'chat_id': link['chat_id'],
+                               'unread_count': 0}
+                              for link in links])
+    Chat.refresh_display_names([chat.id for chat in chats])
+    database.session.commit()
+
+
+def search_by_members(chat_name, user):
+    """
+    The chat search before display names were stored.
+    """
+    member = UserChatTable.alias()
+    peer = UserChatTable.alias()
+    peer_chat_ids = (select([peer.c.chat_id])
+                     .select_from(peer.join(User, User.id == peer.c.user_id))
+                     .where(and_(peer.c.user_id != user.id,
+                                 username_index.get_filter(chat_name))))
+    chats = (Chat
+             .query
+             .join(member,
+                   and_(member.c.chat_id == Chat.id,
+                        member.c.user_id == user.id))
+             .filter(or_(Chat.name.ilike(f'%{escape_like(chat_name)}%',
+                                         escape='\\'),
+                         Chat.id.in_(peer_chat_ids)))
+             .order_by(Chat.date_modified.desc())
+             .limit(PER_PAGE)
+             .all())
+    return [(chat.id, chat.get_name(user)) for chat in chats]
+
+
+def search_by_display_names(chat_name, user):
+    return (Chat
+            .search_chats_query(chat_name, user)
+            .with_entities(Chat.id, ChatReadState.display_name)
+            .limit(PER_PAGE)
+            .all())
+
+
+def measure(search, chat_name, user):
+    """
+    Return the number of found chats, the number of statements
+    and the best time of REPEATS runs.
+    """
+    best = None
+    for _ in range(REPEATS):
+        database.session.expire_all()
+        with QueryCounter() as counter, timer() as elapsed:
+            found = search(chat_name, user)
+        best = elapsed() if best is None else min(best, elapsed())
+    return len(found), counter.count, best
+
+
+def run():
+    set_up_database()
+    try:
+        user = User.query.get(insert_users(1, prefix='owner')[0])
+        chat_count = 0
+        for target in CHAT_COUNTS:
+            add_chats(user, insert_users(target - chat_count))
+            username_index.rebuild()
+            database.session.commit()
+            chat_count = target
+            for term in TERMS:
+                found, old_count, old_time = measure(search_by_members,
+                                                     term, user)
+                _, new_count, new_time = measure(search_by_display_names,
+                                                 term, user)
+                print(f'{chat_count:>5} chats, {term!r:>8}: '
+                      + f'{found:>2} found, '
+                      + f'members {old_count} statements {old_time:.4f} s, '
+                      + f'display names {new_count} statements '
+                      + f'{new_time:.4f} s')
+    finally:
+        tear_down_database()
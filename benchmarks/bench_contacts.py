@@ -0,0 +1,56 @@
+"""
+Importing, checking and deleting contacts in bulk:
+User.add_contacts, get_contact_ids and delete_contacts
+run one statement each regardless of the number of contacts.
+The previous per-user approach (has_contact before every change)
+is measured on a smaller import for comparison.
+"""
+from app import database
+from app.models import Contact, User
+from app.profiling import QueryCounter
+
+from . import insert_users, set_up_database, tear_down_database, timer
+
+
+CONTACT_COUNT = 10000
+ONE_BY_ONE_COUNT = 1000
+
+
+def add_contacts_one_by_one(owner, users):
+    for user in users:
+        if not owner.has_contact(user):
+            database.session.add(Contact(user=owner, contact=user))
+
+
+def measure(name, function, *args):
+    with QueryCounter() as counter, timer() as elapsed:
+        result = function(*args)
+        database.session.commit()
+    print(f'{name:>30}: {elapsed() * 1000:9.1f} ms, '
+          + f'{counter.count} statements')
+    return result
+
+
+def run():
+    set_up_database()
+    try:
+        owner = User.query.get(insert_users(1, prefix='owner')[0])
+        user_ids = insert_users(CONTACT_COUNT, prefix='contact')
+        users = User.query.filter(User.id.in_(user_ids)).all()
+        measure(f'one by one ({ONE_BY_ONE_COUNT})',
+                add_contacts_one_by_one, owner, users[:ONE_BY_ONE_COUNT])
+        owner.delete_contacts(users)
+        database.session.commit()
+        measure(f'add_contacts ({CONTACT_COUNT})',
+                owner.add_contacts, users)
+        assert owner.contacts.count() == CONTACT_COUNT
+        measure(f'add_contacts again ({CONTACT_COUNT})',
+                owner.add_contacts, users)
+        contact_ids = measure(f'get_contact_ids ({CONTACT_COUNT})',
+                              owner.get_contact_ids, user_ids)
+        assert contact_ids == set(user_ids)
+        measure(f'delete_contacts ({CONTACT_COUNT})',
+                owner.delete_contacts, users)
+        assert owner.contacts.count() == 0
+    finally:
+        tear_down_database()
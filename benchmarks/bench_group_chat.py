@@ -0,0 +1,60 @@
+"""
+Chat.add_users and Chat.remove_users for a large group chat:
+the number of SQL statements must not grow with the number of members.
+The previous per-user ORM approach (checking every user
+against the reloaded membership) is measured for comparison.
+"""
+from app import database
+from app.models import Chat, ChatReadState, User
+from app.profiling import QueryCounter
+
+from . import insert_users, set_up_database, tear_down_database, timer
+
+
+MEMBER_COUNTS = (100, 1000)
+
+
+def add_users_one_by_one(chat, users):
+    for user in users:
+        if not user in chat.users.all():
+            chat.users.append(user)
+            chat.read_states.append(ChatReadState(user=user))
+    database.session.flush()
+
+
+def add_users_in_bulk(chat, users):
+    chat.add_users(users)
+
+
+def measure(function, chat, users):
+    with QueryCounter() as counter, timer() as elapsed:
+        function(chat, users)
+        database.session.commit()
+    return elapsed(), counter.count
+
+
+def run():
+    set_up_database()
+    try:
+        for member_count in MEMBER_COUNTS:
+            user_ids = insert_users(member_count,
+                                    prefix=f'member{member_count}_')
+            users = User.query.filter(User.id.in_(user_ids)).all()
+            for name, function in (('one by one', add_users_one_by_one),
+                                   ('add_users', add_users_in_bulk)):
+                chat = Chat(name=f'group{member_count}', is_group_chat=True)
+                database.session.add(chat)
+                database.session.commit()
+                seconds, count = measure(function, chat, users)
+                assert chat.users.count() == member_count
+                print(f'{member_count:5} members, {name:>10}: '
+                      + f'{seconds * 1000:9.1f} ms, {count} statements')
+            seconds, count = measure(add_users_in_bulk, chat, users)
+            print(f'{member_count:5} members,    re-add: '
+                  + f'{seconds * 1000:9.1f} ms, {count} statements')
+            seconds, count = measure(Chat.remove_users, chat, users)
+            assert chat.users.count() == 0
+            print(f'{member_count:5} members,    remove: '
+                  + f'{seconds * 1000:9.1f} ms, {count} statements')
+    finally:
+        tear_down_database()
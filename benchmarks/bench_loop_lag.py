@@ -0,0 +1,63 @@
+"""
+Event loop lag while greenlets hash passwords:
+hashing on the loop versus in the offload thread pool (app.offload).
+A LoopLagMonitor greenlet wakes up every few milliseconds,
+its worst delay is what every socket of the worker would see.
+"""
+import gevent
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from app import cpu_offload
+from app.offload import LoopLagMonitor
+
+from . import timer
+
+
+HASHES = 16
+INTERVAL = 0.005
+
+
+def hash_inline(password, method):
+    return generate_password_hash(password, method)
+
+
+def hash_offloaded(password, method):
+    return cpu_offload.run(generate_password_hash, password, method)
+
+
+def measure(hash_password, method):
+    """
+    Hash HASHES passwords in concurrent greenlets
+    and return the total time, the number of times
+    the monitor woke up and its mean lag.
+    """
+    monitor = LoopLagMonitor()
+    count, total = monitor.lag.count, monitor.lag.sum
+    monitor.start(INTERVAL)
+    gevent.sleep(INTERVAL)
+    try:
+        with timer() as elapsed:
+            greenlets = [gevent.spawn(hash_password, f'password{number}',
+                                      method)
+                         for number in range(HASHES)]
+            gevent.joinall(greenlets, raise_error=True)
+        # lets the monitor record the last delay
+        gevent.sleep(INTERVAL * 2)
+    finally:
+        monitor.stop()
+    samples = monitor.lag.count - count
+    mean = (monitor.lag.sum - total) / samples if samples else 0
+    return elapsed(), samples, mean
+
+
+def run():
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    print(f'{HASHES} hashes ({method}), '
+          + f'{cpu_offload.size} offload threads')
+    for name, hash_password in (('on the loop', hash_inline),
+                                ('offloaded', hash_offloaded)):
+        total, samples, mean = measure(hash_password, method)
+        print(f'{name:>12}: {total:.2f} s, '
+              + f'{samples} loop wake-ups, '
+              + f'mean loop lag {mean * 1000:.1f} ms')
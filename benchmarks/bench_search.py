@@ -0,0 +1,74 @@
+"""
+User.search_users_query over synthetic users:
+trigram index lookup versus a plain ILIKE scan.
+The number of users is set by BENCHMARK_SEARCH_USERS (1000000 by default).
+"""
+import os, random, string
+
+from app import database
+from app.models import Role, User, username_index, utc_now
+
+from . import set_up_database, tear_down_database, timer
+
+
+BATCH_SIZE = 10000
+TERMS = ('abc', 'qwer', 'zzzx', 'user1')
+REPEATS = 5
+
+
+def insert_random_users(count, seed=0):
+    """
+    Insert the given number of users with random lowercase usernames.
+    """
+    generator = random.Random(seed)
+    role = Role.query.filter_by(is_default=True).first()
+    for start in range(0, count, BATCH_SIZE):
+        rows = []
+        for number in range(start, min(start + BATCH_SIZE, count)):
+            name = ''.join(generator.choices(string.ascii_lowercase,
+                                             k=generator.randint(4, 10)))
+            rows.append({'username': f'{name}{number}',
+                         'email': f'{number}@user.user',
+                         'password_hash': 'hash',
+                         'confirmed': True,
+                         'role_id': role.id,
+                         '_date_created': utc_now()})
+        database.session.execute(User.__table__.insert(), rows)
+    database.session.commit()
+
+
+def measure(query):
+    """
+    Return the number of rows in the first page of the given query
+    and the best time of REPEATS runs.
+    """
+    best = None
+    for _ in range(REPEATS):
+        with timer() as elapsed:
+            rows = query.limit(10).all()
+        best = elapsed() if best is None else min(best, elapsed())
+    return len(rows), best
+
+
+def run():
+    user_count = int(os.environ.get('BENCHMARK_SEARCH_USERS', 1000000))
+    set_up_database()
+    try:
+        with timer() as elapsed:
+            insert_random_users(user_count)
+        print(f'{user_count} users inserted in {elapsed():.2f} s')
+        with timer() as elapsed:
+            username_index.rebuild()
+            database.session.commit()
+        print(f'trigram index built in {elapsed():.2f} s')
+        user = User.query.first()
+        users_query = user.get_other_users_query()
+        for term in TERMS:
+            found, indexed = measure(user.search_users_query(term,
+                                                             users_query))
+            _, scan = measure(users_query
+                              .filter(User.username.ilike(f'%{term}%')))
+            print(f'{term!r:>8}: {found:>2} rows, '
+                  + f'index {indexed:.4f} s, scan {scan:.4f} s')
+    finally:
+        tear_down_database()
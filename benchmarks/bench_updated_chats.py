@@ -0,0 +1,50 @@
+"""
+User.get_updated_chats:
+the number of SQL statements must not grow with the number of chats.
+"""
+from app import database
+from app.models import Message, User, UserChatTable, Chat, utc_now
+from app.profiling import QueryCounter
+
+from . import insert_users, set_up_database, tear_down_database, timer
+
+
+CHAT_COUNTS = (10, 100, 500)
+
+
+def add_chats_with_unread_messages(user, peer_ids):
+    """
+    Create a chat between the given user and every peer
+    with one unread message from the peer.
+    """
+    chats = [Chat() for peer_id in peer_ids]
+    database.session.add_all(chats)
+    database.session.flush()
+    links = []
+    messages = []
+    for chat, peer_id in zip(chats, peer_ids):
+        links.append({'user_id': user.id, 'chat_id': chat.id})
+        links.append({'user_id': peer_id, 'chat_id': chat.id})
+        messages.append({'text': 'hi', 'sender_id': peer_id,
+                         'recipient_id': user.id, 'chat_id': chat.id,
+                         '_date_created': utc_now()})
+    database.session.execute(UserChatTable.insert(), links)
+    database.session.execute(Message.__table__.insert(), messages)
+    database.session.commit()
+
+
+def run():
+    set_up_database()
+    try:
+        user = User.query.get(insert_users(1, prefix='owner')[0])
+        chat_count = 0
+        for target in CHAT_COUNTS:
+            peer_ids = insert_users(target - chat_count)
+            add_chats_with_unread_messages(user, peer_ids)
+            chat_count = target
+            with QueryCounter() as counter, timer() as elapsed:
+                data = user.get_updated_chats()
+            print(f'{len(data["chats"]):>5} chats with unread messages: '
+                  + f'{counter.count} statements, {elapsed():.4f} s')
+    finally:
+        tear_down_database()
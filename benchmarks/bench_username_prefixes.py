@@ -0,0 +1,70 @@
+"""
+User.search_users_page served by the in-memory username prefix index
+versus the same page read from the database (User.search_users_query).
+Reports the time and memory needed to build the index.
+Terms with fewer prefix matches than a page
+also query the database for the other matches.
+The number of users is set by BENCHMARK_SEARCH_USERS (1000000 by default).
+"""
+import os, tracemalloc
+
+from app import database, username_prefixes
+from app.models import User, username_index
+
+from . import set_up_database, tear_down_database, timer
+from .bench_search import insert_random_users
+
+
+TERMS = ('a', 'abc', 'qwer', 'zzzx', 'user1')
+REPEATS = 5
+PER_PAGE = 10
+
+
+def measure(function):
+    """
+    Return the result of the given function
+    and the best time of REPEATS runs.
+    """
+    best = None
+    for _ in range(REPEATS):
+        with timer() as elapsed:
+            result = function()
+        best = elapsed() if best is None else min(best, elapsed())
+    return result, best
+
+
+def run():
+    user_count = int(os.environ.get('BENCHMARK_SEARCH_USERS', 1000000))
+    username_prefixes.max_size = max(username_prefixes.max_size, user_count)
+    username_prefixes.refresh_interval = float('inf')
+    set_up_database()
+    try:
+        with timer() as elapsed:
+            insert_random_users(user_count)
+            username_index.rebuild()
+            database.session.commit()
+        print(f'{user_count} users inserted in {elapsed():.2f} s')
+        tracemalloc.start()
+        with timer() as elapsed:
+            User.refresh_username_prefixes()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'prefix index built in {elapsed():.2f} s, '
+              + f'{size / 2 ** 20:.1f} MiB '
+              + f'(peak {peak / 2 ** 20:.1f} MiB)')
+        user = User.query.first()
+        users_query = user.get_other_users_query()
+        for term in TERMS:
+            found, memory = measure(
+                lambda: user.search_users_page(term, 1, PER_PAGE))
+            _, database_page = measure(
+                lambda: (user
+                         .search_users_query(term, users_query)
+                         .with_entities(User.id, User.username)
+                         .limit(PER_PAGE)
+                         .all()))
+            print(f'{term!r:>8}: {len(found):>2} rows, '
+                  + f'memory {memory:.6f} s, database {database_page:.4f} s')
+    finally:
+        username_prefixes.clear()
+        tear_down_database()
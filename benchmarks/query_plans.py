@@ -0,0 +1,161 @@
+"""
+Run EXPLAIN on the model queries over a seeded dataset
+and fail if any of them reads a whole table.
+
+Run with 'flask check_query_plans'.
+PostgreSQL is told not to use sequential scans (enable_seqscan = off),
+so a 'Seq Scan' in a plan means no usable index exists.
+SQLite reports such a table as 'SCAN <table>' without 'USING'.
+"""
+from sqlalchemy import and_
+
+from app import database
+from app.models import Chat, ChatReadState, Message, RemovedChat
+from app.models import User
+
+from . import insert_users, set_up_database, tear_down_database
+
+
+USER_COUNT = 50
+MESSAGES_PER_CHAT = 20
+
+
+def seed():
+    """
+    Create users, direct chats between the first user and the others
+    and messages in every chat.
+    """
+    user_ids = insert_users(USER_COUNT)
+    owner = User.query.get(user_ids[0])
+    for peer_id in user_ids[1:]:
+        peer = User.query.get(peer_id)
+        chat = Chat()
+        chat.add_users([owner, peer])
+        for number in range(MESSAGES_PER_CHAT):
+            sender, recipient = (owner, peer) if number % 2 else (peer, owner)
+            database.session.add(Message(text=f'message {number}',
+                                         sender=sender,
+                                         recipient=recipient,
+                                         chat=chat))
+    owner.add_contacts([User.query.get(user_id)
+                        for user_id in user_ids[1:10]])
+    owner.mark_chats_as_removed(owner.chats[:5])
+    database.session.commit()
+    return owner, User.query.get(user_ids[1])
+
+
+def get_queries(user, peer):
+    """
+    Return a list of pairs (description, query or statement)
+    covering the queries the models run.
+    """
+    chat = Chat.get_chat([user, peer])
+    message = chat.messages.first()
+    return [
+        ('User.get_available_chats_query',
+         user.get_available_chats_query()),
+        ('User.get_chat_summaries_query',
+         user.get_chat_summaries_query()),
+        ('User.get_chat_query', user.get_chat_query([peer.id])),
+        ('User.get_removed_query', user.get_removed_query()),
+        ('User.get_unread_messages_query',
+         user.get_unread_messages_query(chat)),
+        ('User.get_last_read_message_id',
+         (database
+          .session
+          .query(ChatReadState.last_read_message_id)
+          .filter_by(user_id=user.id, chat_id=chat.id))),
+        ('User.has_contact', user.contacts.filter_by(contact_id=peer.id)),
+        ('User.is_contacted_by', peer.contacted.filter_by(user_id=user.id)),
+        ('User.get_other_users_query', user.get_other_users_query()),
+        ('User.search_users_query',
+         user.search_users_query('ser1', user.get_other_users_query())),
+        ('Chat.search_chats_query', Chat.search_chats_query('ser1', user)),
+        ('Chat.users', chat.users),
+        ('Chat.get_direct_chats_query',
+         Chat.get_direct_chats_query(user.id, [peer.id])),
+        ('Message.get_page (newest)',
+         (chat
+          .messages
+          .order_by(Message._date_created.desc(), Message.id.desc())
+          .limit(10))),
+        ('Message.get_page (before)',
+         (chat
+          .messages
+          .filter(Message._date_created < message._date_created)
+          .order_by(Message._date_created.desc(), Message.id.desc())
+          .limit(10))),
+        ('RemovedChat by chat',
+         RemovedChat.query.filter(RemovedChat.chat_id == chat.id)),
+        ('Chat.increment_unread_counts',
+         (ChatReadState
+          .__table__
+          .update()
+          .where(ChatReadState.chat_id == chat.id)
+          .values(unread_count=ChatReadState.unread_count + 1))),
+        ('User.mark_chat_as_read',
+         (ChatReadState
+          .__table__
+          .update()
+          .where(and_(ChatReadState.user_id == user.id,
+                      ChatReadState.chat_id == chat.id))
+          .values(unread_count=0, last_read_message_id=message.id))),
+    ]
+
+
+def explain(statement):
+    """
+    Return the lines of the query plan of the given statement.
+
+    :param statement: SQLAlchemy query or Core statement
+    :returns: list of strings
+    """
+    statement = getattr(statement, 'statement', statement)
+    dialect = database.engine.dialect
+    compiled = statement.compile(dialect=dialect)
+    connection = database.session.connection()
+    if dialect.name == 'postgresql':
+        rows = connection.execute('EXPLAIN ' + str(compiled),
+                                  compiled.params)
+    else:
+        parameters = tuple(compiled.params[name]
+                           for name in compiled.positiontup)
+        rows = connection.execute('EXPLAIN QUERY PLAN ' + str(compiled),
+                                  parameters)
+    return [str(row[-1]) for row in rows]
+
+
+def is_table_scan(line):
+    """
+    Check if the given query plan line
+    describes reading a whole table.
+    """
+    line = line.strip()
+    if 'Seq Scan' in line:
+        return True
+    return (line.startswith('SCAN')
+            and 'USING' not in line
+            and 'SUBQUERY' not in line
+            and 'CONSTANT ROW' not in line)
+
+
+def run():
+    set_up_database()
+    try:
+        user, peer = seed()
+        if database.engine.dialect.name == 'postgresql':
+            database.session.execute('ANALYZE')
+            database.session.execute('SET enable_seqscan = off')
+        failed = []
+        for description, statement in get_queries(user, peer):
+            plan = explain(statement)
+            scans = [line for line in plan if is_table_scan(line)]
+            print(f'{description}: {"FAIL" if scans else "ok"}')
+            for line in plan:
+                print(f'    {line}')
+            if scans:
+                failed.append(description)
+        assert not failed, f'Full table scans in: {", ".join(failed)}'
+    finally:
+        database.session.rollback()
+        tear_down_database()
@@ -13,8 +13,6 @@ class Config:
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-    SESSION_TYPE = os.environ.get('SESSION_TYPE', 'filesystem')
-    
     MAIL_SUBJECT_PREFIX = os.environ.get('MAIL_SUBJECT_PREFIX',
                                          '[Simple Messenger]')
     MAIL_SENDER = os.environ.get('MAIL_SENDER', 'Admin <use@some.mail')
@@ -31,6 +29,88 @@ class Config:
     MESSAGES_PER_PAGE = 10
 
     CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL')
+
+    # Redis URL shared by all workers,
+    # required when running more than one worker
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    SOCKET_REGISTRY_URL = os.environ.get('SOCKET_REGISTRY_URL',
+                                         SOCKETIO_MESSAGE_QUEUE)
+    SOCKET_REGISTRY_TTL = int(os.environ.get('SOCKET_REGISTRY_TTL', 86400))
+    # state of every socket (the chosen chat), kept in Redis if given
+    CONNECTION_STATE_URL = os.environ.get('CONNECTION_STATE_URL',
+                                          SOCKET_REGISTRY_URL)
+    CONNECTION_STATE_TTL = int(os.environ.get('CONNECTION_STATE_TTL',
+                                              SOCKET_REGISTRY_TTL))
+
+    # server-side sessions kept in Redis if given, otherwise
+    # at most SESSION_CACHE_SIZE sessions in every worker's memory,
+    # written only when changed, permanent sessions keep users
+    # logged in after closing the browser
+    SESSION_STORE_URL = os.environ.get('SESSION_STORE_URL',
+                                       SOCKETIO_MESSAGE_QUEUE)
+    SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 100000))
+    SESSION_PERMANENT = int(os.environ.get('SESSION_PERMANENT', True))
+
+    # chat updates sent to sockets by a bounded pool of greenlets,
+    # submitting to a full queue waits for a free place
+    FANOUT_POOL_SIZE = int(os.environ.get('FANOUT_POOL_SIZE', 50))
+    FANOUT_MAX_PENDING = int(os.environ.get('FANOUT_MAX_PENDING', 1000))
+
+    # usernames kept in memory by every worker for prefix search,
+    # the index is switched off above USERNAME_INDEX_MAX_SIZE users,
+    # users signed up through other workers show up
+    # after at most USERNAME_INDEX_REFRESH_INTERVAL seconds
+    USERNAME_INDEX_MAX_SIZE = int(os.environ.get('USERNAME_INDEX_MAX_SIZE',
+                                                 1000000))
+    USERNAME_INDEX_REFRESH_INTERVAL = float(
+        os.environ.get('USERNAME_INDEX_REFRESH_INTERVAL', 5))
+
+    # names of chats without a 'name' (the peer's username)
+    # cached by every worker per (chat id, viewer id)
+    CHAT_NAME_CACHE_SIZE = int(os.environ.get('CHAT_NAME_CACHE_SIZE', 10000))
+
+    # logged in confirmed users cached by every worker,
+    # changes made through another worker are seen
+    # after at most USER_PRINCIPAL_CACHE_TTL seconds
+    USER_PRINCIPAL_CACHE_SIZE = int(os.environ.get('USER_PRINCIPAL_CACHE_SIZE',
+                                                   10000))
+    USER_PRINCIPAL_CACHE_TTL = float(os.environ.get('USER_PRINCIPAL_CACHE_TTL',
+                                                    60))
+
+    # verified API tokens cached by digest until they expire
+    AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 10000))
+
+    # password hashing policy, stored hashes made otherwise
+    # are replaced on the next successful login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD',
+                                          'pbkdf2:sha256:150000')
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+    # successful API basic authentication checks cached by every worker
+    CREDENTIALS_CACHE_SIZE = int(os.environ.get('CREDENTIALS_CACHE_SIZE',
+                                                10000))
+    CREDENTIALS_CACHE_TTL = float(os.environ.get('CREDENTIALS_CACHE_TTL', 60))
+
+    # native threads running CPU-bound work (password hashing)
+    # off the gevent loop, the loop's delay is measured
+    # every LOOP_LAG_INTERVAL seconds (0 to disable)
+    OFFLOAD_POOL_SIZE = int(os.environ.get('OFFLOAD_POOL_SIZE', 4))
+    LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', 1))
+
+    # SQL statements counted per HTTP request (by endpoint)
+    # and socket event ('socket:<event>'), handlers executing
+    # more than their budget are logged with their worst call sites,
+    # SQL_STATEMENT_BUDGET_STRICT raises instead (used by the tests)
+    SQL_PROFILER_ENABLED = int(os.environ.get('SQL_PROFILER_ENABLED', True))
+    SQL_STATEMENT_BUDGET = int(os.environ.get('SQL_STATEMENT_BUDGET', 50))
+    SQL_STATEMENT_BUDGETS = {'auth.login': 4,
+                             'main.index': 6,
+                             'socket:add_contacts_and_chats': 20,
+                             'socket:connect': 5,
+                             'socket:join_chats': 3,
+                             'socket:search_users': 4,
+                             'socket:send_message': 12}
+    SQL_STATEMENT_BUDGET_STRICT = int(
+        os.environ.get('SQL_STATEMENT_BUDGET_STRICT', False))
     
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI',
                                              'sqlite:///memory')
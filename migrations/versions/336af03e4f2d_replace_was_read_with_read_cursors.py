@@ -0,0 +1,46 @@
+"""replace was_read with read cursors
+
+Revision ID: 336af03e4f2d
+Revises: ce04dbd79fc3
+Create Date: 2026-10-18 11:03:15.118840
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '336af03e4f2d'
+down_revision = 'ce04dbd79fc3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # users without unread messages have read the whole chat
+    op.execute("""
+        UPDATE chat_read_states
+        SET last_read_message_id = (
+            SELECT MAX(messages.id)
+            FROM messages
+            WHERE messages.chat_id = chat_read_states.chat_id
+        )
+        WHERE unread_count = 0
+    """)
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('was_read')
+
+
+def downgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.add_column(sa.Column('was_read', sa.Boolean(), nullable=True))
+    op.execute("""
+        UPDATE messages
+        SET was_read = EXISTS (
+            SELECT 1
+            FROM chat_read_states
+            WHERE chat_read_states.chat_id = messages.chat_id
+                  AND chat_read_states.user_id != messages.sender_id
+                  AND chat_read_states.last_read_message_id >= messages.id
+        )
+    """)
@@ -0,0 +1,58 @@
+"""add trigram search indexes
+
+Revision ID: 4c8d1f6b2e93
+Revises: 7b1e5c2d9a40
+Create Date: 2026-10-18 14:02:51.774016
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8d1f6b2e93'
+down_revision = '7b1e5c2d9a40'
+branch_labels = None
+depends_on = None
+
+
+# (owner table, column, side table)
+INDEXES = (('users', 'username', 'users_username_trigrams'),
+           ('chats', 'name', 'chats_name_trigrams'))
+
+
+def get_trigrams(text):
+    text = (text or '').lower()
+    return {text[start:start + 3] for start in range(len(text) - 2)}
+
+
+def upgrade():
+    bind = op.get_bind()
+    for owner, column, side_table in INDEXES:
+        table = op.create_table(side_table,
+        sa.Column('trigram', sa.String(length=3), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['owner_id'], [f'{owner}.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('trigram', 'owner_id')
+        )
+        op.create_index(f'ix_{side_table}_owner_id', side_table, ['owner_id'], unique=False)
+        if bind.dialect.name == 'postgresql':
+            op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            op.execute(f'CREATE INDEX ix_{owner}_{column}_trgm '
+                       f'ON {owner} USING gin ({column} gin_trgm_ops)')
+        else:
+            rows = [{'trigram': trigram, 'owner_id': owner_id}
+                    for owner_id, text
+                    in bind.execute(f'SELECT id, {column} FROM {owner}')
+                    for trigram in get_trigrams(text)]
+            if rows:
+                op.bulk_insert(table, rows)
+
+
+def downgrade():
+    bind = op.get_bind()
+    for owner, column, side_table in INDEXES:
+        if bind.dialect.name == 'postgresql':
+            op.execute(f'DROP INDEX ix_{owner}_{column}_trgm')
+        op.drop_index(f'ix_{side_table}_owner_id', table_name=side_table)
+        op.drop_table(side_table)
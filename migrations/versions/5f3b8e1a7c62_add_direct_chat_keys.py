@@ -0,0 +1,50 @@
+"""add direct chat keys
+
+Revision ID: 5f3b8e1a7c62
+Revises: 9e2a7c4b1d58
+Create Date: 2026-10-18 19:05:43.281907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3b8e1a7c62'
+down_revision = '9e2a7c4b1d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chats') as batch_op:
+        batch_op.add_column(sa.Column('direct_low_user_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('direct_high_user_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_chats_direct_low_user_id_users', 'users', ['direct_low_user_id'], ['id'], ondelete='SET NULL')
+        batch_op.create_foreign_key('fk_chats_direct_high_user_id_users', 'users', ['direct_high_user_id'], ['id'], ondelete='SET NULL')
+    # chats which are not group chats and have two users are direct chats
+    op.execute('UPDATE chats SET '
+               'direct_low_user_id = (SELECT min(user_id) FROM user_chat_link '
+               'WHERE user_chat_link.chat_id = chats.id), '
+               'direct_high_user_id = (SELECT max(user_id) FROM user_chat_link '
+               'WHERE user_chat_link.chat_id = chats.id) '
+               'WHERE (is_group_chat IS NULL OR NOT is_group_chat) '
+               'AND (SELECT count(*) FROM user_chat_link '
+               'WHERE user_chat_link.chat_id = chats.id) = 2')
+    # only the oldest of duplicate direct chats keeps the key
+    op.execute('UPDATE chats SET '
+               'direct_low_user_id = NULL, direct_high_user_id = NULL '
+               'WHERE EXISTS (SELECT 1 FROM chats AS other '
+               'WHERE other.direct_low_user_id = chats.direct_low_user_id '
+               'AND other.direct_high_user_id = chats.direct_high_user_id '
+               'AND other.id < chats.id)')
+    op.create_index('ix_chats_direct_user_ids', 'chats', ['direct_low_user_id', 'direct_high_user_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_chats_direct_user_ids', table_name='chats')
+    with op.batch_alter_table('chats') as batch_op:
+        batch_op.drop_constraint('fk_chats_direct_high_user_id_users', type_='foreignkey')
+        batch_op.drop_constraint('fk_chats_direct_low_user_id_users', type_='foreignkey')
+        batch_op.drop_column('direct_high_user_id')
+        batch_op.drop_column('direct_low_user_id')
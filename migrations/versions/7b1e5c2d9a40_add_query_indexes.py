@@ -0,0 +1,39 @@
+"""add query indexes
+
+Revision ID: 7b1e5c2d9a40
+Revises: 336af03e4f2d
+Create Date: 2026-10-18 12:20:07.310552
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7b1e5c2d9a40'
+down_revision = '336af03e4f2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_user_chat_link_chat_id_user_id', 'user_chat_link', ['chat_id', 'user_id'], unique=False)
+    op.create_index('ix_removed_chats_chat_id', 'removed_chats', ['chat_id'], unique=False)
+    op.create_index('ix_chat_read_states_chat_id', 'chat_read_states', ['chat_id'], unique=False)
+    op.create_index('ix_contacts_contact_id', 'contacts', ['contact_id'], unique=False)
+    op.create_index('ix_chats_date_modified', 'chats', ['_date_modified'], unique=False)
+    op.create_index('ix_messages_chat_id_date_created_id', 'messages', ['chat_id', '_date_created', 'id'], unique=False)
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_messages_sender_id', 'messages', ['sender_id'], unique=False)
+    op.create_index('ix_messages_recipient_id', 'messages', ['recipient_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_messages_recipient_id', table_name='messages')
+    op.drop_index('ix_messages_sender_id', table_name='messages')
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
+    op.drop_index('ix_messages_chat_id_date_created_id', table_name='messages')
+    op.drop_index('ix_chats_date_modified', table_name='chats')
+    op.drop_index('ix_contacts_contact_id', table_name='contacts')
+    op.drop_index('ix_chat_read_states_chat_id', table_name='chat_read_states')
+    op.drop_index('ix_removed_chats_chat_id', table_name='removed_chats')
+    op.drop_index('ix_user_chat_link_chat_id_user_id', table_name='user_chat_link')
@@ -0,0 +1,60 @@
+"""add chat display names
+
+Revision ID: 9e2a7c4b1d58
+Revises: 4c8d1f6b2e93
+Create Date: 2026-10-18 16:40:12.518237
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e2a7c4b1d58'
+down_revision = '4c8d1f6b2e93'
+branch_labels = None
+depends_on = None
+
+
+def get_trigrams(text):
+    text = (text or '').lower()
+    return {text[start:start + 3] for start in range(len(text) - 2)}
+
+
+def upgrade():
+    op.add_column('chat_read_states', sa.Column('display_name', sa.String(length=64), nullable=True))
+    op.execute('UPDATE chat_read_states SET display_name = coalesce('
+               '(SELECT nullif(chats.name, \'\') FROM chats '
+               'WHERE chats.id = chat_read_states.chat_id), '
+               '(SELECT users.username FROM user_chat_link, users '
+               'WHERE user_chat_link.chat_id = chat_read_states.chat_id '
+               'AND users.id = user_chat_link.user_id '
+               'AND users.id != chat_read_states.user_id LIMIT 1))')
+    # chats are searched by display names now
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX ix_chats_name_trgm')
+    op.drop_index('ix_chats_name_trigrams_owner_id', table_name='chats_name_trigrams')
+    op.drop_table('chats_name_trigrams')
+
+
+def downgrade():
+    bind = op.get_bind()
+    table = op.create_table('chats_name_trigrams',
+    sa.Column('trigram', sa.String(length=3), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('trigram', 'owner_id')
+    )
+    op.create_index('ix_chats_name_trigrams_owner_id', 'chats_name_trigrams', ['owner_id'], unique=False)
+    if bind.dialect.name == 'postgresql':
+        op.execute('CREATE INDEX ix_chats_name_trgm '
+                   'ON chats USING gin (name gin_trgm_ops)')
+    else:
+        rows = [{'trigram': trigram, 'owner_id': owner_id}
+                for owner_id, text
+                in bind.execute('SELECT id, name FROM chats')
+                for trigram in get_trigrams(text)]
+        if rows:
+            op.bulk_insert(table, rows)
+    with op.batch_alter_table('chat_read_states') as batch_op:
+        batch_op.drop_column('display_name')
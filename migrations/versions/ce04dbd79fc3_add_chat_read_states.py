@@ -0,0 +1,52 @@
+"""add chat read states
+
+Revision ID: ce04dbd79fc3
+Revises: a8c3769ee6f3
+Create Date: 2026-10-18 10:12:41.504213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ce04dbd79fc3'
+down_revision = 'a8c3769ee6f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('chat_read_states',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('unread_count', sa.Integer(), nullable=False),
+    sa.Column('last_read_message_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['last_read_message_id'], ['messages.id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'chat_id')
+    )
+    # backfill: one row per chat member,
+    # counting the messages from other users which were not read
+    op.execute("""
+        INSERT INTO chat_read_states
+            (user_id, chat_id, unread_count, last_read_message_id)
+        SELECT link.user_id,
+               link.chat_id,
+               (SELECT COUNT(*)
+                FROM messages
+                WHERE messages.chat_id = link.chat_id
+                      AND messages.sender_id != link.user_id
+                      AND NOT messages.was_read),
+               (SELECT MAX(messages.id)
+                FROM messages
+                WHERE messages.chat_id = link.chat_id
+                      AND (messages.sender_id = link.user_id
+                           OR messages.was_read))
+        FROM user_chat_link AS link
+    """)
+
+
+def downgrade():
+    op.drop_table('chat_read_states')
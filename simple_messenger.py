@@ -4,6 +4,9 @@ from app.models import UserChatTable, Chat, RemovedChat
 from app.models import User, Role, Contact, Message
 from sqlalchemy.exc import IntegrityError
 
+import click
+import os
+
 
 app = create_app()
 
@@ -24,6 +27,36 @@ def test_all():
     unittest.TextTestRunner(verbosity=2).run(tests)
 
 
+def use_benchmark_database():
+    app.config['SQLALCHEMY_DATABASE_URI'] = (os
+                                             .environ
+                                             .get('BENCHMARK_DATABASE_URI',
+                                                  'sqlite://'))
+
+
+@app.cli.command('benchmark', help='Run benchmarks.')
+@click.argument('names', nargs=-1)
+def benchmark(names):
+    import benchmarks, importlib, pkgutil
+    use_benchmark_database()
+    modules = [module.name for module 
+               in pkgutil.iter_modules(benchmarks.__path__)
+               if module.name.startswith('bench_')]
+    for name in modules:
+        if names and name[len('bench_'):] not in names:
+            continue
+        print(f'{name}:')
+        importlib.import_module(f'benchmarks.{name}').run()
+
+
+@app.cli.command('check_query_plans', 
+                 help='Check that model queries use indexes.')
+def check_query_plans():
+    from benchmarks import query_plans
+    use_benchmark_database()
+    query_plans.run()
+
+
 @app.shell_context_processor
 def make_shell_context():
     return {'database': database,
@@ -0,0 +1,49 @@
+from app.cache import LRUCache
+import unittest
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache('test_cache', max_size=3)
+
+    def test_get_and_set(self):
+        hits = self.cache.hits.value
+        misses = self.cache.misses.value
+        self.assertIsNone(self.cache.get((1, 1)))
+        self.assertEqual(self.cache.get((1, 1), 'default'), 'default')
+        self.cache.set((1, 1), 'bob')
+        self.assertEqual(self.cache.get((1, 1)), 'bob')
+        self.assertEqual(self.cache.hits.value - hits, 1)
+        self.assertEqual(self.cache.misses.value - misses, 2)
+        self.assertEqual(self.cache.size.value, 1)
+
+    def test_eviction(self):
+        evictions = self.cache.evictions.value
+        self.cache.set((1, 1), 'a')
+        self.cache.set((1, 2), 'b')
+        self.cache.set((2, 1), 'c')
+        self.cache.get((1, 1))
+        self.cache.set((2, 2), 'd')
+        self.assertIsNone(self.cache.get((1, 2)))
+        self.assertEqual(self.cache.get((1, 1)), 'a')
+        self.assertEqual(self.cache.evictions.value - evictions, 1)
+        self.assertEqual(self.cache.size.value, 3)
+        self.assertEqual(self.cache.groups[1], {(1, 1)})
+
+    def test_invalidate(self):
+        self.cache.set((1, 1), 'a')
+        self.cache.set((1, 2), 'b')
+        self.cache.set((2, 1), 'c')
+        self.cache.invalidate((2, 1))
+        self.cache.invalidate((3, 1))
+        self.assertIsNone(self.cache.get((2, 1)))
+        self.assertNotIn(2, self.cache.groups)
+        self.cache.invalidate_group(1)
+        self.assertIsNone(self.cache.get((1, 1)))
+        self.assertIsNone(self.cache.get((1, 2)))
+        self.assertEqual(self.cache.size.value, 0)
+
+    def test_disabled(self):
+        self.cache.max_size = 0
+        self.cache.set((1, 1), 'a')
+        self.assertIsNone(self.cache.get((1, 1)))
@@ -1,5 +1,6 @@
-from app import create_app, database
-from app.models import Chat, User, Role
+from app import chat_name_cache, create_app, database
+from app.models import Chat, ChatReadState, RemovedChat, User, Role
+from app.profiling import QueryCounter
 from flask import url_for
 from app.exceptions import ValidationError
 
@@ -57,6 +58,9 @@ class ChatModelTestCase(unittest.TestCase):
         self.assertIn(self.bob, chat.users.all())
         self.assertIn(self.arthur, chat.users.all())
         self.assertEqual(chat.users.count(), 2)
+        self.assertEqual(set(read_state.user 
+                             for read_state in chat.read_states),
+                         {self.bob, self.arthur})
     
     def test_remove_users(self):
         chat = Chat()
@@ -66,8 +70,40 @@ class ChatModelTestCase(unittest.TestCase):
         chat.remove_users([self.bob])
         self.assertEqual(chat.users.count(), 2)
         self.assertNotIn(self.bob, chat.users.all())
+        self.assertEqual(chat.read_states.count(), 2)
         chat.remove_users([self.morgana, self.clair])
         self.assertEqual(chat.users.count(), 0)
+        self.assertEqual(chat.read_states.count(), 0)
+
+    def test_add_users_in_bulk(self):
+        chat = Chat(name='group', is_group_chat=True)
+        chat.add_users([self.bob])
+        database.session.commit()
+        users = [self.bob, self.arthur, self.clair, self.morgana]
+        with QueryCounter() as counter:
+            chat.add_users(users)
+        self.assertLessEqual(counter.count, 3)
+        self.assertEqual(chat.users.count(), 4)
+        self.assertEqual(chat.read_states.count(), 4)
+        # callers control the transaction
+        database.session.rollback()
+        self.assertEqual(chat.users.count(), 1)
+        self.assertEqual(chat.read_states.count(), 1)
+        chat.add_users(users)
+        chat.add_users(users)
+        database.session.commit()
+        self.assertEqual(chat.users.count(), 4)
+        self.assertIn(chat, self.arthur.chats)
+
+    def test_unmark_as_removed(self):
+        self.bob.mark_chats_as_removed([self.chat_bob_arthur,
+                                        self.chat_bob_clair])
+        self.arthur.mark_chats_as_removed([self.chat_bob_arthur])
+        self.chat_bob_arthur.unmark_as_removed()
+        database.session.commit()
+        self.assertEqual([removed_chat.chat 
+                          for removed_chat in RemovedChat.query],
+                         [self.chat_bob_clair])
 
     def test_get_chat(self):
         self.assertEqual(Chat.get_chat([self.bob, self.arthur]),
@@ -77,6 +113,46 @@ class ChatModelTestCase(unittest.TestCase):
         self.assertEqual(Chat.get_chat([self.arthur, self.morgana]),
                          self.chat_morgana_arthur)
    
+    def test_direct_key(self):
+        self.assertEqual(Chat.get_direct_key(self.bob.id, self.arthur.id),
+                         Chat.get_direct_key(self.arthur.id, self.bob.id))
+        self.assertEqual(self.chat_bob_arthur.get_direct_peer_id(self.bob.id),
+                         self.arthur.id)
+        # a second chat of the pair is not keyed
+        chat = Chat()
+        chat.add_users([self.arthur, self.bob])
+        database.session.commit()
+        self.assertIsNone(chat.direct_low_user_id)
+        self.assertIsNone(chat.direct_high_user_id)
+        # group chats have no key
+        group = Chat(name='group', is_group_chat=True)
+        group.add_users([self.bob, self.arthur])
+        database.session.commit()
+        self.assertIsNone(group.direct_low_user_id)
+        self.assertEqual(Chat.get_chat([self.arthur, self.bob]),
+                         self.chat_bob_arthur)
+
+    def test_get_or_create_direct_chats(self):
+        peer_ids = [self.arthur.id, self.clair.id, self.ophelia.id]
+        self.assertEqual(Chat.get_direct_chats(self.bob.id, peer_ids),
+                         {self.arthur.id: self.chat_bob_arthur,
+                          self.clair.id: self.chat_bob_clair})
+        with QueryCounter() as counter:
+            chats, created = Chat.get_or_create_direct_chats(
+                self.bob.id, peer_ids + [self.bob.id])
+        self.assertLessEqual(counter.count, 6)
+        database.session.commit()
+        self.assertEqual(created, {self.ophelia.id})
+        chat = chats[self.ophelia.id]
+        self.assertEqual(set(chat.users), {self.bob, self.ophelia})
+        self.assertEqual(chat.read_states.count(), 2)
+        self.assertEqual(chat.get_name(self.bob), 'ophelia')
+        self.assertEqual(Chat.search_chats_query('phel', self.bob).all(),
+                         [chat])
+        self.assertEqual(Chat.get_or_create_direct_chat(self.ophelia,
+                                                        self.bob),
+                         (chat, False))
+
     def test_get_name(self):
         self.assertEqual(self.chat_morgana_bob.get_name(self.bob),
                          self.chat_morgana_bob.name)
@@ -87,6 +163,35 @@ class ChatModelTestCase(unittest.TestCase):
         self.assertEqual(self.chat_bob_arthur.get_name(self.arthur),
                          self.bob.username)
 
+    def test_get_name_cache(self):
+        chat = self.chat_bob_arthur
+        self.assertEqual(chat.get_name(self.bob), 'arthur')
+        with QueryCounter() as counter:
+            self.assertEqual(chat.get_name(self.bob), 'arthur')
+        self.assertEqual(counter.count, 0)
+        self.assertIn((chat.id, self.bob.id), chat_name_cache.entries)
+        chat.remove_users([self.arthur])
+        self.assertNotIn((chat.id, self.bob.id), chat_name_cache.entries)
+        chat.add_users([self.clair])
+        self.assertEqual(chat.get_name(self.bob), 'clair')
+        self.clair.username = 'clara'
+        database.session.commit()
+        self.assertEqual(chat.get_name(self.bob), 'clara')
+
+    def test_get_name_cache_transaction_end(self):
+        chat = self.chat_bob_arthur
+        key = (chat.id, self.bob.id)
+        chat.remove_users([self.arthur])
+        # cached by another greenlet before the change is committed
+        chat_name_cache.set(key, 'arthur')
+        database.session.rollback()
+        self.assertNotIn(key, chat_name_cache.entries)
+        self.assertEqual(chat.get_name(self.bob), 'arthur')
+        chat.add_users([self.clair])
+        chat_name_cache.set(key, 'arthur')
+        database.session.commit()
+        self.assertNotIn(key, chat_name_cache.entries)
+
     def test_search_chats_query(self):
         chats = Chat.search_chats_query('mor', self.bob).all()
         self.assertIn(self.chat_morgana_bob, chats)
@@ -102,6 +207,59 @@ class ChatModelTestCase(unittest.TestCase):
         self.assertIn(self.chat_bob_artorias, chats)
         self.assertEqual(len(chats), 2)
 
+    def test_search_chats_after_reading(self):
+        chats = Chat.search_chats_query('bob', self.arthur).all()
+        self.assertEqual(chats, [self.chat_bob_arthur])
+        self.arthur.mark_chat_as_read(self.chat_bob_arthur)
+        chats = Chat.search_chats_query('bob', self.arthur).all()
+        self.assertEqual(chats, [self.chat_bob_arthur])
+        self.assertEqual(self.get_display_names(self.chat_bob_arthur),
+                         {self.bob.id: 'arthur', self.arthur.id: 'bob'})
+
+    def get_display_names(self, chat):
+        return {read_state.user_id: read_state.display_name
+                for read_state in chat.read_states}
+
+    def test_display_names(self):
+        chat = self.chat_bob_arthur
+        self.assertEqual(self.get_display_names(chat),
+                         {self.bob.id: 'arthur', self.arthur.id: 'bob'})
+        chat.name = 'Round table'
+        database.session.commit()
+        self.assertEqual(self.get_display_names(chat),
+                         {self.bob.id: 'Round table',
+                          self.arthur.id: 'Round table'})
+        chat.name = None
+        chat.remove_users([self.arthur])
+        self.assertEqual(self.get_display_names(chat), {self.bob.id: None})
+        chat.add_users([self.clair])
+        self.assertEqual(self.get_display_names(chat),
+                         {self.bob.id: 'clair', self.clair.id: 'bob'})
+        for read_state in chat.read_states:
+            read_state.display_name = None
+        database.session.commit()
+        Chat.refresh_display_names([chat.id])
+        self.assertEqual(self.get_display_names(chat),
+                         {self.bob.id: 'clair', self.clair.id: 'bob'})
+        self.clair.username = 'clara'
+        database.session.commit()
+        self.assertEqual(self.get_display_names(chat),
+                         {self.bob.id: 'clara', self.clair.id: 'bob'})
+        self.assertIn(chat,
+                      Chat.search_chats_query('clara', self.bob).all())
+
+    def test_search_chats_names(self):
+        self.assertEqual(Chat
+                         .search_chats_query('ART', self.bob)
+                         .with_entities(Chat.id, ChatReadState.display_name)
+                         .order_by(None)
+                         .order_by(ChatReadState.display_name)
+                         .all(),
+                         [(self.chat_bob_arthur.id, 'arthur'),
+                          (self.chat_bob_artorias.id, 'artorias')])
+        self.assertEqual(Chat.search_chats_query('_', self.bob).all(),
+                         [self.chat_morgana_bob])
+
     def test_from_json(self):
         json_chat = {'chat_name': None,
                      'users': ['morgana']}
@@ -111,6 +269,12 @@ class ChatModelTestCase(unittest.TestCase):
         self.assertEqual(chat.get_name(self.morgana), self.clair.username)
         self.assertIn(self.clair, chat.users.all())
         self.assertIn(self.morgana, chat.users.all())
+        # the existing direct chat is reused
+        database.session.commit()
+        self.assertEqual(Chat.from_json({'users': ['clair']}, self.morgana),
+                         chat)
+        self.assertEqual(Chat.from_json({'users': ['arthur']}, self.bob),
+                         self.chat_bob_arthur)
         json_chat = {'chat_name': None,
                      'users': ['morgana', 'bob']}
         with self.assertRaises(ValidationError):
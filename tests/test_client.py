@@ -1,12 +1,17 @@
-from app import create_app, database
-from app.models import User, Role, Chat
-import unittest
+from app import connection_states, create_app, database
+from app import socket_io, socket_registry
+from app.main.decorators import get_event_metrics
+from app.metrics import metrics
+from app.profiling import QueryCounter
+from app.models import User, Role, Chat, RemovedChat
+import base64, unittest
         
 
 class ClientTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
         self.app_context = self.app.app_context()
+        self.app.config['SQL_STATEMENT_BUDGET_STRICT'] = True
         self.app_context.push()
         database.create_all()
         Role.insert_roles()
@@ -33,6 +38,194 @@ class ClientTestCase(unittest.TestCase):
         self.assertIn('Simple Messenger - bob',
                       response.get_data(as_text=True))
 
+    def login(self, client, email, password):
+        client.post('/auth/login', data={
+            'email': email,
+            'password': password
+        })
+
+    def test_socket_per_tab(self):
+        bob_id = self.bob.id
+        chat_id = self.chat_bob_arthur.id
+        bob_client = self.app.test_client(use_cookies=True)
+        arthur_client = self.app.test_client(use_cookies=True)
+        self.login(bob_client, 'bob@bob.bob', 'bobbobbob')
+        self.login(arthur_client, 'arthur@arthur.arthur', 'arthurarthur')
+        bob_tabs = [socket_io.test_client(self.app, 
+                                          flask_test_client=bob_client)
+                    for _ in range(2)]
+        arthur_tab = socket_io.test_client(self.app,
+                                           flask_test_client=arthur_client)
+        self.assertEqual(len(socket_registry.get_sids(bob_id)), 2)
+        arthur_tab.emit('send_message', 
+                        {'message_text': 'hi bob',
+                         'chat_id': chat_id})
+        for tab in bob_tabs:
+            events = [event['name'] for event in tab.get_received()]
+            self.assertIn('new_message', events)
+        events = [event['name'] for event in arthur_tab.get_received()]
+        self.assertEqual(events, ['send_message'])
+        bob_tabs[0].disconnect()
+        self.assertEqual(len(socket_registry.get_sids(bob_id)), 1)
+
+    def test_choose_chat_per_tab(self):
+        bob_id = self.bob.id
+        chat_id = self.chat_bob_arthur.id
+        bob_client = self.app.test_client(use_cookies=True)
+        self.login(bob_client, 'bob@bob.bob', 'bobbobbob')
+        bob_tabs = [socket_io.test_client(self.app,
+                                          flask_test_client=bob_client)
+                    for _ in range(2)]
+        sids = [tab.sid for tab in bob_tabs]
+        bob_tabs[0].emit('choose_chat', {'chat_id': chat_id})
+        self.assertEqual(connection_states.get_current_chat_id(bob_id,
+                                                               sids[0]),
+                         chat_id)
+        self.assertIsNone(connection_states.get_current_chat_id(bob_id,
+                                                                sids[1]))
+        # the page and the next tab start with the chat last chosen
+        response = bob_client.get('/')
+        self.assertIn('selected-current-chat',
+                      response.get_data(as_text=True))
+        new_tab = socket_io.test_client(self.app,
+                                        flask_test_client=bob_client)
+        self.assertEqual(connection_states.get(new_tab.sid).current_chat_id,
+                         chat_id)
+        bob_tabs[0].emit('choose_chat', {'chat_id': chat_id})
+        self.assertIsNone(connection_states.get_current_chat_id(bob_id,
+                                                                sids[0]))
+        bob_tabs[0].disconnect()
+        self.assertIsNone(connection_states.get(sids[0]))
+
+    def test_send_message_query_count(self):
+        def count_queries():
+            with QueryCounter() as counter:
+                arthur_tab.emit('send_message', 
+                                {'message_text': 'hi',
+                                 'chat_id': chat_id})
+            return counter.count
+
+        self.bob.mark_chats_as_removed([self.chat_bob_arthur])
+        chat_id = self.chat_bob_arthur.id
+        bob_client = self.app.test_client(use_cookies=True)
+        arthur_client = self.app.test_client(use_cookies=True)
+        self.login(bob_client, 'bob@bob.bob', 'bobbobbob')
+        self.login(arthur_client, 'arthur@arthur.arthur', 'arthurarthur')
+        arthur_tab = socket_io.test_client(self.app,
+                                           flask_test_client=arthur_client)
+        count_queries()
+        self.assertEqual(RemovedChat.query.count(), 0)
+        count_offline = count_queries()
+        bob_tabs = [socket_io.test_client(self.app, 
+                                          flask_test_client=bob_client)
+                    for _ in range(3)]
+        # the recipient's tabs get the message without extra queries
+        self.assertEqual(count_queries(), count_offline)
+
+    def test_event_metrics(self):
+        seconds, payload_bytes, errors = get_event_metrics('search_users')
+        count, error_count = seconds.count, errors.value
+        bob_client = self.app.test_client(use_cookies=True)
+        self.login(bob_client, 'bob@bob.bob', 'bobbobbob')
+        bob_tab = socket_io.test_client(self.app,
+                                        flask_test_client=bob_client)
+        bob_tab.emit('search_users', {'username': 'art', 'page_number': 1})
+        self.assertEqual(seconds.count - count, 1)
+        self.assertEqual(metrics.get('handler_statements',
+                                     {'handler': 'socket:search_users'})
+                         .count,
+                         seconds.count)
+        self.assertGreater(payload_bytes.sum, 0)
+        self.assertEqual(errors.value, error_count)
+
+    def get_api_headers(self, email, password):
+        credentials = base64.b64encode(f'{email}:{password}'.encode('utf-8'))
+        return {'Authorization': 'Basic ' + credentials.decode('utf-8')}
+
+    def test_metrics_endpoint(self):
+        response = self.client.get(
+            '/api/v1.0/metrics',
+            headers=self.get_api_headers('bob@bob.bob', 'bobbobbob'))
+        self.assertEqual(response.status_code, 403)
+        admin = User(username='admin', password='adminadmin',
+                     email=self.app.config['ADMIN_MAIL'], confirmed=True)
+        database.session.add(admin)
+        database.session.commit()
+        response = self.client.get(
+            '/api/v1.0/metrics',
+            headers=self.get_api_headers(admin.email, 'adminadmin'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('# TYPE event_loop_lag_seconds histogram',
+                      response.get_data(as_text=True))
+
+    def test_api_chat_lookup(self):
+        headers = self.get_api_headers('bob@bob.bob', 'bobbobbob')
+        chat_id = self.chat_bob_arthur.id
+        for url in (f'/api/v1.0/chats/{chat_id}',
+                    f'/api/v1.0/chats/{chat_id}/messages'):
+            self.assertEqual(self.client.get(url, headers=headers)
+                             .status_code, 200)
+        response = self.client.get('/api/v1.0/chats/1000', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_api_messages_count(self):
+        headers = self.get_api_headers('bob@bob.bob', 'bobbobbob')
+        url = f'/api/v1.0/chats/{self.chat_bob_arthur.id}/messages'
+        with QueryCounter() as counter:
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.get_json())
+        self.assertFalse(any('count(' in statement.lower()
+                             for statement in counter.statements))
+        response = self.client.get(url + '?count=1', headers=headers)
+        self.assertEqual(response.get_json()['count'], 0)
+
+    def test_add_contacts_and_chats(self):
+        def add_chats(tab, user_ids):
+            with QueryCounter() as counter:
+                tab.emit('add_contacts_and_chats', {'user_ids': user_ids})
+            return counter.count
+
+        self.arthur.mark_chats_as_removed([self.chat_bob_arthur])
+        peers = [User(username=f'peer{number}', password='peerpeerpeer',
+                      email=f'peer{number}@peer.peer', confirmed=True)
+                 for number in range(4)]
+        database.session.add_all(peers)
+        database.session.commit()
+        peer_ids = [peer.id for peer in peers]
+        bob_id, clair_id = self.bob.id, self.clair.id
+        arthur_client = self.app.test_client(use_cookies=True)
+        peer_client = self.app.test_client(use_cookies=True)
+        self.login(arthur_client, 'arthur@arthur.arthur', 'arthurarthur')
+        self.login(peer_client, 'peer0@peer.peer', 'peerpeerpeer')
+        arthur_tab = socket_io.test_client(self.app,
+                                           flask_test_client=arthur_client)
+        peer_tab = socket_io.test_client(self.app,
+                                         flask_test_client=peer_client)
+        add_chats(arthur_tab, [bob_id, clair_id] + peer_ids[:1])
+        events = arthur_tab.get_received()
+        added = [event['args'][0]['added_chats'] for event in events
+                 if event['name'] == 'add_contacts_and_chats']
+        self.assertEqual(len(added), 1)
+        self.assertEqual([chat['chat_name'] for chat in added[0]],
+                         ['bob', 'clair', 'peer0'])
+        self.assertEqual(RemovedChat.query.count(), 2)
+        self.assertEqual(RemovedChat
+                         .query
+                         .filter_by(user_id=peer_ids[0])
+                         .one()
+                         .chat_id,
+                         int(added[0][2]['chat_id']))
+        self.assertIn('join_chats',
+                      [event['name'] for event in peer_tab.get_received()])
+        # the statements do not depend on the number of selected users
+        count = add_chats(arthur_tab, peer_ids[1:2])
+        self.assertEqual(add_chats(arthur_tab, peer_ids[2:]), count)
+        self.assertEqual(Chat.query.count(), 6)
+        add_chats(arthur_tab, peer_ids)
+        self.assertEqual(Chat.query.count(), 6)
+
     def test_register_and_login(self):
         response = self.client.post('/auth/signup', data={
             'email': 'no_such_email@gmail.com',
@@ -0,0 +1,40 @@
+from app.connections import ConnectionState, ConnectionStates, MemoryBackend
+import unittest
+
+
+class ConnectionStatesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.states = ConnectionStates()
+        self.states.backend = MemoryBackend()
+
+    def test_current_chat_per_connection(self):
+        self.states.open(1, 'sid_1')
+        self.states.open(1, 'sid_2')
+        self.states.set_current_chat_id(1, 'sid_1', 10)
+        self.assertEqual(self.states.get_current_chat_id(1, 'sid_1'), 10)
+        self.assertIsNone(self.states.get_current_chat_id(1, 'sid_2'))
+        self.assertEqual(self.states.get('sid_1'), ConnectionState(1, 10))
+        # the next connection starts with the chat last chosen
+        self.assertEqual(self.states.open(1, 'sid_3').current_chat_id, 10)
+        self.assertEqual(self.states.get_current_chat_id(1), 10)
+        self.states.set_current_chat_id(1, 'sid_3', None)
+        self.assertIsNone(self.states.get_current_chat_id(1))
+        self.assertEqual(self.states.get_current_chat_id(1, 'sid_1'), 10)
+
+    def test_close(self):
+        self.states.open(1, 'sid_1')
+        self.states.set_current_chat_id(1, 'sid_1', 10)
+        self.states.close('sid_1')
+        self.states.close('sid_2')
+        self.assertIsNone(self.states.get('sid_1'))
+        self.assertEqual(self.states.get_current_chat_id(1, 'sid_1'), 10)
+
+    def test_other_user(self):
+        self.states.open(1, 'sid_1')
+        self.states.set_current_chat_id(1, 'sid_1', 10)
+        self.assertIsNone(self.states.get_current_chat_id(2, 'sid_1'))
+
+    def test_to_dict(self):
+        for state in (ConnectionState(1), ConnectionState(1, 10)):
+            self.assertEqual(ConnectionState.from_dict(state.to_dict()),
+                             state)
@@ -0,0 +1,117 @@
+from app.fanout import FanOutExecutor
+from app.metrics import MetricsRegistry
+from flask import Flask
+import gevent
+import unittest
+
+
+class FanOutExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.executor = FanOutExecutor('test_fanout')
+        self.executor.configure(2, 3)
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.release = gevent.event.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.join(timeout=1)
+
+    def work(self, value):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.release.wait()
+        self.running -= 1
+        self.calls.append(value)
+
+    def test_bounded_pool(self):
+        for value in range(3):
+            self.executor.submit(self.work, value)
+        gevent.sleep(0)
+        self.assertEqual(self.executor.in_flight_gauge.value, 2)
+        self.assertEqual(self.executor.pending_gauge.value, 1)
+        self.release.set()
+        self.assertTrue(self.executor.join(timeout=1))
+        self.assertEqual(sorted(self.calls), [0, 1, 2])
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(self.executor.pending_gauge.value, 0)
+        self.assertEqual(self.executor.in_flight_gauge.value, 0)
+
+    def test_block(self):
+        self.executor.configure(1, 1)
+        self.executor.submit(self.work, 0)
+        self.executor.submit(self.work, 1)
+        submitter = gevent.spawn(self.executor.submit, self.work, 2)
+        gevent.sleep(0.01)
+        self.assertFalse(submitter.ready())
+        self.release.set()
+        submitter.join(timeout=1)
+        self.assertTrue(submitter.ready())
+        self.executor.join(timeout=1)
+        self.assertEqual(self.calls, [0, 1, 2])
+
+    def test_failed_task(self):
+        app = Flask(__name__)
+        app.config.update(FANOUT_POOL_SIZE=2,
+                          FANOUT_MAX_PENDING=3)
+        self.executor.init_app(app)
+        failed = self.executor.failed.value
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            self.executor.submit(lambda: 1 / 0)
+            self.executor.join(timeout=1)
+        self.assertEqual(self.executor.failed.value - failed, 1)
+        self.assertIn('test_fanout task', logs.output[0])
+        self.assertIn('ZeroDivisionError', logs.output[0])
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.bucket_counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+
+    def test_get_or_create(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('sent')
+        self.assertIs(registry.counter('sent'), counter)
+        with self.assertRaises(ValueError):
+            registry.gauge('sent')
+        registry.gauge('pending')
+        self.assertEqual([metric.name for metric in registry.get_metrics()],
+                         ['pending', 'sent'])
+
+    def test_labels(self):
+        registry = MetricsRegistry()
+        sent = registry.counter('events', labels={'event': 'send'})
+        read = registry.counter('events', labels={'event': 'read'})
+        self.assertIsNot(sent, read)
+        self.assertIs(registry.get('events', {'event': 'send'}), sent)
+        self.assertIsNone(registry.get('events'))
+
+    def test_to_prometheus(self):
+        registry = MetricsRegistry()
+        registry.counter('events', 'Handled events',
+                         labels={'event': 'send'}).inc(2)
+        registry.counter('events', 'Handled events',
+                         labels={'event': 'read'}).inc()
+        histogram = registry.histogram('latency', 'Latency', (0.1, 1))
+        for value in (0.05, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(registry.to_prometheus().splitlines(), [
+            '# HELP events Handled events',
+            '# TYPE events counter',
+            'events{event="read"} 1',
+            'events{event="send"} 2',
+            '# HELP latency Latency',
+            '# TYPE latency histogram',
+            'latency_bucket{le="0.1"} 1',
+            'latency_bucket{le="1"} 2',
+            'latency_bucket{le="+Inf"} 3',
+            'latency_sum 2.55',
+            'latency_count 3',
+        ])
@@ -2,6 +2,7 @@ from app import create_app, database
 from app.models import Chat, Message
 from app.models import User, Role
 from app.exceptions import ValidationError
+from app.profiling import QueryCounter
 import unittest
 
 
@@ -24,7 +25,6 @@ class MessageModelTestCase(unittest.TestCase):
         self.message1 = Message(text='hi there1', 
                                 sender=self.arthur, 
                                 recipient=self.bob,
-                                was_read=True, 
                                 chat=self.chat_bob_arthur)
         self.message2 = Message(text='hi there2', 
                                 sender=self.arthur, 
@@ -52,18 +52,15 @@ class MessageModelTestCase(unittest.TestCase):
         database.drop_all()
         self.app_context.pop()
     
-    def test_flush_messages(self):
-        self.assertFalse(self.message2.was_read)
-        self.assertFalse(self.message3.was_read)
-        self.assertTrue(self.message1.was_read)
-        self.assertFalse(self.message4.was_read)
-        Message.flush_messages(Message
-                               .query
-                               .filter(Message.sender == self.arthur))
-        self.assertTrue(self.message2.was_read)
-        self.assertTrue(self.message3.was_read)
-        self.assertTrue(self.message1.was_read)
-        self.assertFalse(self.message4.was_read)
+    def test_is_read_by(self):
+        self.assertFalse(self.message1.is_read_by(self.bob))
+        self.assertTrue(self.message1.is_read_by(self.arthur))
+        self.assertTrue(self.message4.is_read_by(self.bob))
+        self.assertFalse(self.message4.is_read_by(self.arthur))
+        self.bob.mark_chat_as_read(self.chat_bob_arthur)
+        for message in (self.message1, self.message2, self.message3):
+            self.assertTrue(message.is_read_by(self.bob))
+        self.assertFalse(self.message4.is_read_by(self.arthur))
 
     def test_to_json(self):
         message = self.message1
@@ -71,10 +68,91 @@ class MessageModelTestCase(unittest.TestCase):
         self.assertEqual(json_message,
                          {'id': message.id,
                           'chat_id': message.chat_id,
-                          'was_read': message.was_read,
+                          'was_read': message.is_read_by(self.bob),
                           'date_created': message.date_created,
                           'text': message.text,
                           'sender_username': message.sender.username,
                           'recipient_username': message.recipient.username,
                           'chat_name': message.chat.get_name(self.bob)
                          })        
+
+    def test_to_json_list(self):
+        messages = [self.message1, self.message4]
+        self.bob.mark_chat_as_read(self.chat_bob_arthur)
+        self.assertEqual(Message.to_json_list(messages, self.arthur,
+                                              self.chat_bob_arthur),
+                         [message.to_json(self.arthur) 
+                          for message in messages])
+
+    def test_serialization_query_count(self):
+        users = [User(username=f'user{number}', 
+                      email=f'user{number}@user.user',
+                      password_hash='hash')
+                 for number in range(20)]
+        chat = Chat(is_group_chat=True, name='group')
+        chat.add_users([self.bob] + users)
+        database.session.add_all(
+            [Message(text=f'message {number}',
+                     sender=users[number % len(users)],
+                     recipient=users[(number + 1) % len(users)],
+                     chat=chat)
+             for number in range(500)])
+        database.session.commit()
+        chat_id = chat.id
+        bob_id = self.bob.id
+        database.session.expunge_all()
+        chat = Chat.query.get(chat_id)
+        bob = User.query.get(bob_id)
+        with QueryCounter() as counter:
+            messages, _ = Message.get_page(chat.messages, per_page=500)
+            json_messages = Message.to_json_list(messages, bob, chat)
+        self.assertEqual(len(json_messages), 500)
+        # the page and the read cursor, the group chat name is stored
+        self.assertEqual(counter.count, 2)
+        database.session.expunge_all()
+        chat = Chat.query.get(chat_id)
+        with QueryCounter() as counter:
+            message_list = Message.get_messages_list(chat.messages)
+        self.assertEqual(len(message_list), 500)
+        self.assertEqual(counter.count, 1)
+
+    def test_get_page(self):
+        messages = [self.message1, self.message2, 
+                    self.message3, self.message4]
+        query = self.chat_bob_arthur.messages
+        page, has_more = Message.get_page(query, per_page=3)
+        self.assertEqual(page, messages[1:])
+        self.assertTrue(has_more)
+        page, has_more = Message.get_page(query, per_page=3,
+                                          before=page[0].get_cursor())
+        self.assertEqual(page, messages[:1])
+        self.assertFalse(has_more)
+        page, has_more = Message.get_page(query, per_page=2,
+                                          after=page[0].get_cursor())
+        self.assertEqual(page, messages[1:3])
+        self.assertTrue(has_more)
+        page, has_more = Message.get_page(query, per_page=2,
+                                          after=page[-1].get_cursor())
+        self.assertEqual(page, messages[3:])
+        self.assertFalse(has_more)
+
+    def test_get_page_same_date(self):
+        for message in (self.message2, self.message3, self.message4):
+            message.date_created = self.message1.date_created
+        database.session.commit()
+        query = self.chat_bob_arthur.messages
+        page, has_more = Message.get_page(query, per_page=2)
+        self.assertEqual(page, [self.message3, self.message4])
+        page, has_more = Message.get_page(query, per_page=2,
+                                          before=page[0].get_cursor())
+        self.assertEqual(page, [self.message1, self.message2])
+        self.assertFalse(has_more)
+
+    def test_parse_cursor(self):
+        cursor = self.message1.get_cursor()
+        date_created, message_id = Message.parse_cursor(cursor)
+        self.assertEqual(message_id, self.message1.id)
+        with self.assertRaises(ValidationError):
+            Message.parse_cursor('wrong')
+        with self.assertRaises(ValidationError):
+            Message.parse_cursor(None)
@@ -0,0 +1,54 @@
+from app.offload import LoopLagMonitor, ThreadOffload
+import gevent, threading, time, unittest
+
+
+class ThreadOffloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.offload = ThreadOffload('test_offload', size=2)
+
+    def tearDown(self):
+        self.offload.configure(2)
+
+    def test_run(self):
+        completed = self.offload.completed.value
+        self.assertEqual(self.offload.run(int, '101', base=2), 5)
+        self.assertNotEqual(self.offload.run(threading.get_ident),
+                            threading.get_ident())
+        self.assertEqual(self.offload.completed.value - completed, 2)
+        self.assertEqual(self.offload.in_flight.value, 0)
+
+    def test_exception(self):
+        failed = self.offload.failed.value
+        with self.assertRaises(ZeroDivisionError):
+            self.offload.run(divmod, 1, 0)
+        self.assertEqual(self.offload.failed.value - failed, 1)
+
+    def test_loop_not_blocked(self):
+        ticks = []
+
+        def tick():
+            for _ in range(5):
+                ticks.append(time.monotonic())
+                gevent.sleep(0.01)
+
+        ticker = gevent.spawn(tick)
+        self.offload.run(time.sleep, 0.2)
+        ticker.join()
+        self.assertEqual(len(ticks), 5)
+        self.assertLess(ticks[-1] - ticks[0], 0.2)
+
+
+class LoopLagMonitorTestCase(unittest.TestCase):
+    def test_lag(self):
+        monitor = LoopLagMonitor()
+        count = monitor.lag.count
+        monitor.start(0.01)
+        try:
+            gevent.sleep(0)
+            # blocks the loop
+            time.sleep(0.1)
+            gevent.sleep(0.05)
+        finally:
+            monitor.stop()
+        self.assertGreater(monitor.lag.count, count)
+        self.assertGreater(monitor.lag.sum, 0.05)
@@ -0,0 +1,73 @@
+from app.prefix_index import PrefixIndex
+import unittest
+
+
+class PrefixIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = PrefixIndex(max_size=100, refresh_interval=60)
+        self.index.build([(1, 'bob'), (2, 'Arthur'), (3, 'artorias'),
+                          (4, 'morgana'), (5, 'art')])
+
+    def test_search(self):
+        self.assertEqual(self.index.search('art'),
+                         [(5, 'art'), (2, 'Arthur'), (3, 'artorias')])
+        self.assertEqual(self.index.search('ART', limit=2),
+                         [(5, 'art'), (2, 'Arthur')])
+        self.assertEqual(self.index.search('art', offset=2),
+                         [(3, 'artorias')])
+        self.assertEqual(self.index.search('x'), [])
+        self.assertEqual(len(self.index.search('')), 5)
+        self.assertEqual(self.index.count('art'), 3)
+
+    def test_exclude(self):
+        exclude = (2, 'Arthur')
+        self.assertEqual(self.index.search('art', exclude),
+                         [(5, 'art'), (3, 'artorias')])
+        self.assertEqual(self.index.search('art', exclude, limit=1),
+                         [(5, 'art')])
+        self.assertEqual(self.index.search('art', exclude, offset=1),
+                         [(3, 'artorias')])
+        self.assertEqual(self.index.search('art', exclude, 1, 1),
+                         [(3, 'artorias')])
+        self.assertEqual(self.index.count('art', exclude), 2)
+        self.assertEqual(self.index.count('bob', exclude), 1)
+
+    def test_add_and_remove(self):
+        self.index.add(6, 'artemis')
+        self.index.add(6, 'artemis')
+        self.assertEqual(self.index.count('art'), 4)
+        self.assertEqual(self.index.last_id, 5)
+        self.index.remove(2, 'Arthur')
+        self.index.remove(7, 'nobody')
+        self.assertEqual(self.index.search('art'),
+                         [(5, 'art'), (6, 'artemis'), (3, 'artorias')])
+
+    def test_add_many(self):
+        rows = [(number, f'user{number}') for number in range(6, 40)]
+        self.index.add_many(rows + [(6, 'user6')])
+        self.assertEqual(self.index.count('user'), 34)
+        self.assertEqual(self.index.last_id, 39)
+        self.assertEqual(self.index.search('user1', limit=2),
+                         [(10, 'user10'), (11, 'user11')])
+        self.assertEqual(self.index.search('art')[0], (5, 'art'))
+
+    def test_max_size(self):
+        self.index.add_many((number, f'user{number}')
+                            for number in range(6, 200))
+        self.assertFalse(self.index.enabled)
+        self.assertEqual(self.index.search('user'), [])
+        self.index.add(300, 'user300')
+        self.assertFalse(self.index.enabled)
+        # disabled for good until cleared
+        self.assertEqual(self.index.last_id, 199)
+        self.assertTrue(self.index.is_built)
+        self.index.refresh_interval = 0
+        self.assertFalse(self.index.is_stale())
+
+    def test_is_stale(self):
+        self.assertFalse(self.index.is_stale())
+        self.index.refresh_interval = 0
+        self.assertTrue(self.index.is_stale())
+        self.index.clear()
+        self.assertFalse(self.index.is_built)
+        self.assertTrue(self.index.is_stale())
@@ -0,0 +1,64 @@
+from app import create_app, database, socket_io, statement_profiler
+from app.exceptions import StatementBudgetExceeded
+from app.models import Role, User
+from app.profiling import StatementProfile, get_call_site
+import unittest
+
+
+class StatementProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['SQL_STATEMENT_BUDGET_STRICT'] = True
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        database.create_all()
+        Role.insert_roles()
+        self.bob = User(username='bob', password='bobbobbob',
+                        email='bob@bob.bob', confirmed=True)
+        database.session.add(self.bob)
+        database.session.commit()
+        self.client = self.app.test_client(use_cookies=True)
+        self.client.post('/auth/login', data={'email': 'bob@bob.bob',
+                                              'password': 'bobbobbob'})
+
+    def tearDown(self):
+        database.session.remove()
+        database.drop_all()
+        self.app_context.pop()
+
+    def test_worst_sites(self):
+        profile = StatementProfile('main.index')
+        profile.record('app/models.py:1 in a', 0.5)
+        profile.record('app/models.py:2 in b', 0.1)
+        profile.record('app/models.py:2 in b', 0.1)
+        self.assertEqual(profile.count, 3)
+        self.assertEqual(profile.get_worst_sites(1),
+                         [('app/models.py:2 in b', 2, 0.2)])
+        self.assertEqual(get_call_site(), 'outside of the application')
+
+    def test_request_budget(self):
+        self.app.config['SQL_STATEMENT_BUDGETS'] = {'main.index': 0}
+        with self.assertRaises(StatementBudgetExceeded) as raised:
+            self.client.get('/')
+        self.assertIn('main.index executed', str(raised.exception))
+        self.assertIn('app/main/routes.py', str(raised.exception))
+        self.assertEqual(statement_profiler.violations[-1].name,
+                         'main.index')
+
+    def test_socket_event_budget(self):
+        self.app.config['SQL_STATEMENT_BUDGETS'] = {'socket:search_users': 0}
+        self.app.config['SQL_STATEMENT_BUDGET_STRICT'] = False
+        bob_tab = socket_io.test_client(self.app,
+                                        flask_test_client=self.client)
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            bob_tab.emit('search_users', {'username': 'b',
+                                          'page_number': 1})
+        self.assertIn('socket:search_users executed', logs.output[0])
+        self.assertEqual(statement_profiler.violations[-1].name,
+                         'socket:search_users')
+
+    def test_disabled(self):
+        self.app.config['SQL_PROFILER_ENABLED'] = False
+        self.app.config['SQL_STATEMENT_BUDGETS'] = {'main.index': 0}
+        self.assertEqual(self.client.get('/').status_code, 200)
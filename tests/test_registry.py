@@ -0,0 +1,31 @@
+from app.registry import MemoryBackend, SocketRegistry
+import unittest
+
+
+class SocketRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = SocketRegistry()
+        self.registry.backend = MemoryBackend()
+
+    def test_several_sockets(self):
+        self.registry.add(1, 'sid_1')
+        self.registry.add(1, 'sid_2')
+        self.registry.add(2, 'sid_3')
+        self.assertEqual(self.registry.get_sids(1), {'sid_1', 'sid_2'})
+        self.assertEqual(self.registry.get_sids(2), {'sid_3'})
+        self.registry.remove(1, 'sid_1')
+        self.assertEqual(self.registry.get_sids(1), {'sid_2'})
+        self.assertTrue(self.registry.is_online(1))
+        self.registry.remove(1, 'sid_2')
+        self.assertFalse(self.registry.is_online(1))
+        self.assertEqual(self.registry.get_sids(1), set())
+
+    def test_remove_unknown(self):
+        self.registry.remove(1, 'sid_1')
+        self.registry.add(1, 'sid_1')
+        self.registry.remove(1, 'sid_2')
+        self.assertEqual(self.registry.get_sids(1), {'sid_1'})
+
+    def test_get_room(self):
+        self.assertNotEqual(SocketRegistry.get_room(1),
+                            SocketRegistry.get_room(2))
@@ -0,0 +1,94 @@
+from app import create_app, database
+from app.models import Role, User, username_index
+from app.search import escape_like, get_trigrams
+import unittest
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        database.create_all()
+        Role.insert_roles()
+        self.bob = User(username='bob', password='bob',
+                        email='bob@bob.bob', confirmed=True)
+        self.arthur = User(username='Arthur', password='arthur',
+                           email='arthur@arthur.arthur', confirmed=True)
+        self.martha = User(username='martha', password='martha',
+                           email='martha@martha.martha', confirmed=True)
+        database.session.add_all([self.bob, self.arthur, self.martha])
+        database.session.commit()
+
+    def tearDown(self):
+        database.session.remove()
+        database.drop_all()
+        self.app_context.pop()
+
+    def get_indexed_trigrams(self, index, owner_id):
+        table = index.table
+        return {trigram for trigram, 
+                in (database
+                    .session
+                    .query(table.c.trigram)
+                    .filter(table.c.owner_id == owner_id))}
+
+    def test_get_trigrams(self):
+        self.assertEqual(get_trigrams('Arthur'), 
+                         {'art', 'rth', 'thu', 'hur'})
+        self.assertEqual(get_trigrams('ab'), set())
+        self.assertEqual(get_trigrams(None), set())
+
+    def test_escape_like(self):
+        self.assertEqual(escape_like('100%_\\'), '100\\%\\_\\\\')
+
+    def test_index_maintenance(self):
+        self.assertEqual(self.get_indexed_trigrams(username_index, 
+                                                   self.arthur.id),
+                         get_trigrams('arthur'))
+        self.arthur.username = 'artorias'
+        database.session.commit()
+        self.assertEqual(self.get_indexed_trigrams(username_index,
+                                                   self.arthur.id),
+                         get_trigrams('artorias'))
+        arthur_id = self.arthur.id
+        database.session.delete(self.arthur)
+        database.session.commit()
+        self.assertEqual(self.get_indexed_trigrams(username_index,
+                                                   arthur_id),
+                         set())
+
+    def test_rebuild(self):
+        database.session.execute(username_index.table.delete())
+        username_index.rebuild()
+        self.assertEqual(self.get_indexed_trigrams(username_index,
+                                                   self.arthur.id),
+                         get_trigrams('arthur'))
+
+    def test_get_filter(self):
+        def search(term):
+            return (User
+                    .query
+                    .filter(username_index.get_filter(term))
+                    .order_by(User.username)
+                    .all())
+
+        self.assertEqual(search('ART'), [self.arthur, self.martha])
+        self.assertEqual(search('rthu'), [self.arthur])
+        self.assertEqual(search('ob'), [self.bob])
+        self.assertEqual(search('%'), [])
+        self.assertEqual(search('a_t'), [])
+
+    def test_get_rank(self):
+        users = (User
+                 .query
+                 .filter(username_index.get_filter('art'))
+                 .order_by(username_index.get_rank('art'), User.username)
+                 .all())
+        self.assertEqual(users, [self.arthur, self.martha])
+        users = (User
+                 .query
+                 .filter(username_index.get_filter('ar'))
+                 .order_by(username_index.get_rank('mar'), User.username)
+                 .all())
+        self.assertEqual(users, [self.martha, self.arthur])
@@ -0,0 +1,133 @@
+from app.cache import LRUCache
+from app.sessions import MemorySessionBackend, StoreSessionInterface
+from datetime import timedelta
+from flask import Flask, flash, get_flashed_messages, session
+import time, unittest
+
+
+class CountingBackend(MemorySessionBackend):
+    def __init__(self):
+        super().__init__(LRUCache('test_session_cache'))
+        self.saved = 0
+
+    def save(self, sid, data, ttl):
+        self.saved += 1
+        super().save(sid, data, ttl)
+
+
+class StoreSessionInterfaceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = CountingBackend()
+        self.app = Flask(__name__)
+        self.app.secret_key = 'secret'
+        self.app.config['SESSION_PERMANENT'] = False
+        self.app.session_interface = StoreSessionInterface(self.backend)
+
+        @self.app.route('/set/<value>')
+        def set_value(value):
+            session['value'] = value
+            return ''
+
+        @self.app.route('/get')
+        def get_value():
+            return session.get('value', '')
+
+        @self.app.route('/clear')
+        def clear():
+            session.clear()
+            return ''
+
+        @self.app.route('/flash')
+        @self.app.route('/flash/<message>')
+        def flash_message(message='hello'):
+            flash(message)
+            return ''
+
+        # in-place changes are saved when the value is assigned back
+        @self.app.route('/append')
+        def append():
+            session.setdefault('items', []).append(1)
+            session['items'] = session['items']
+            return ''
+
+        @self.app.route('/items')
+        def items():
+            return str(session.get('items'))
+
+        @self.app.route('/flashed')
+        def flashed():
+            return ','.join(get_flashed_messages())
+
+        self.client = self.app.test_client(use_cookies=True)
+
+    def get_cookie(self, response):
+        return response.headers.get('Set-Cookie')
+
+    def test_write_only_when_modified(self):
+        response = self.client.get('/get')
+        self.assertIsNone(self.get_cookie(response))
+        self.assertEqual(self.backend.saved, 0)
+        response = self.client.get('/set/bob')
+        self.assertIsNotNone(self.get_cookie(response))
+        self.assertEqual(self.backend.saved, 1)
+        for _ in range(3):
+            response = self.client.get('/get')
+            self.assertEqual(response.get_data(as_text=True), 'bob')
+            self.assertIsNone(self.get_cookie(response))
+        self.assertEqual(self.backend.saved, 1)
+        # the cookie holds the session id only
+        self.client.get('/set/arthur')
+        self.assertEqual(self.backend.saved, 2)
+        self.assertEqual(len(self.backend.cache.entries), 1)
+        self.assertNotIn('arthur', self.get_cookie(self.client.get('/set/x')))
+
+    def test_clear(self):
+        self.client.get('/set/bob')
+        response = self.client.get('/clear')
+        self.assertIn('session=;', self.get_cookie(response))
+        self.assertEqual(len(self.backend.cache.entries), 0)
+        self.assertEqual(self.client.get('/get').get_data(as_text=True), '')
+
+    def test_flashed_messages(self):
+        self.client.get('/flash')
+        self.assertEqual(self.client.get('/flashed').get_data(as_text=True),
+                         'hello')
+        self.assertEqual(self.client.get('/flashed').get_data(as_text=True),
+                         '')
+
+    def test_flashed_messages_in_two_requests(self):
+        self.client.get('/flash/one')
+        self.client.get('/flash/two')
+        self.assertEqual(self.client.get('/flashed').get_data(as_text=True),
+                         'one,two')
+
+    def test_mutated_value(self):
+        self.client.get('/append')
+        self.client.get('/append')
+        self.assertEqual(self.client.get('/items').get_data(as_text=True),
+                         '[1, 1]')
+
+    def test_unknown_session_id(self):
+        self.client.set_cookie('localhost', 'session', 'unknown')
+        self.assertEqual(self.client.get('/get').get_data(as_text=True), '')
+        response = self.client.get('/set/bob')
+        self.assertNotIn('unknown', self.get_cookie(response))
+        self.assertEqual(self.client.get('/get').get_data(as_text=True),
+                         'bob')
+
+    def test_refresh_permanent_session(self):
+        self.app.config['SESSION_PERMANENT'] = True
+        self.app.permanent_session_lifetime = timedelta(seconds=1)
+        self.client.get('/set/bob')
+        # requests within the lifetime keep the session alive
+        for _ in range(4):
+            time.sleep(0.4)
+            response = self.client.get('/get')
+            self.assertEqual(response.get_data(as_text=True), 'bob')
+            self.assertIn('Expires=', self.get_cookie(response))
+        self.assertEqual(self.backend.saved, 1)
+        self.app.config['SESSION_REFRESH_EACH_REQUEST'] = False
+        self.assertIsNone(self.get_cookie(self.client.get('/get')))
+        (sid,), = self.backend.cache.entries
+        time.sleep(1.1)
+        self.assertIsNone(self.backend.load(sid))
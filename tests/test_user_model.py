@@ -1,8 +1,12 @@
 import time
 
-from app import create_app, database
-from app.models import Contact, Chat, Message
+from app import create_app, database, username_prefixes
+from app import auth_token_cache, credentials_cache, user_principal_cache
+from app.passwords import needs_rehash
+from app.models import ChatReadState, Contact, Chat, Message, UserPrincipal
+from app.models import load_user
 from app.models import User, UserChatTable, RemovedChat, Role, Permission
+from app.profiling import QueryCounter
 import unittest
 
 
@@ -75,6 +79,14 @@ class UserModelTestCase(unittest.TestCase):
                          self.chat_bob_arthur)
         self.assertEqual(RemovedChat.query.first().user, self.bob)
 
+    def test_get_chat_ids_query(self):
+        self.bob.mark_chats_as_removed([self.chat_bob_clair])
+        self.assertEqual({chat_id 
+                          for chat_id, in self.bob.get_chat_ids_query()},
+                         {self.chat_bob_arthur.id,
+                          self.chat_bob_clair.id,
+                          self.chat_morgana_bob.id})
+
     def test_get_removed_query(self):
         self.bob.mark_chats_as_removed([self.chat_bob_clair,
                                         self.chat_morgana_bob])
@@ -144,6 +156,32 @@ class UserModelTestCase(unittest.TestCase):
         self.assertFalse(self.bob.has_contact(self.clair))
         self.assertFalse(self.clair.is_contacted_by(self.bob))
     
+    def test_bulk_contacts(self):
+        users = [self.arthur, self.clair, self.morgana, self.ophelia]
+        with QueryCounter() as counter:
+            self.bob.add_contacts(users, contact_group='friends')
+        self.assertEqual(counter.count, 1)
+        database.session.commit()
+        self.assertEqual(self.bob.contacts.count(), 4)
+        # existing contacts keep their group
+        self.assertIsNone(self.bob
+                          .contacts
+                          .filter_by(contact_id=self.clair.id)
+                          .one()
+                          .contact_group)
+        contact = self.bob.contacts.filter_by(contact_id=self.arthur.id).one()
+        self.assertEqual(contact.contact_group, 'friends')
+        self.assertIsNotNone(contact.date_created.tzinfo)
+        user_ids = {user.id for user in users} | {self.bob.id}
+        with QueryCounter() as counter:
+            self.assertEqual(self.bob.get_contact_ids(user_ids),
+                             user_ids - {self.bob.id})
+            self.bob.delete_contacts([self.clair, self.ophelia])
+        self.assertEqual(counter.count, 2)
+        database.session.commit()
+        self.assertEqual(self.bob.get_contact_ids(user_ids),
+                         {self.arthur.id, self.morgana.id})
+
     def test_confirm_user(self):
         user1 = User(username='user1', email='user1@user.user', password='pass')
         user2 = User(username='user2', email='user2@user.user', password='pass')
@@ -171,11 +209,9 @@ class UserModelTestCase(unittest.TestCase):
     
     def test_chat_two_users_1(self):
         message1 = Message(text='hi there1', sender=self.arthur, 
-                           recipient=self.bob, was_read=True, 
-                           chat=self.chat_bob_arthur)
+                           recipient=self.bob, chat=self.chat_bob_arthur)
         message2 = Message(text='hi there2', sender=self.arthur, 
-                           recipient=self.bob, was_read=True, 
-                           chat=self.chat_bob_arthur)
+                           recipient=self.bob, chat=self.chat_bob_arthur)
         message3 = Message(text='hi there3', sender=self.arthur, 
                            recipient=self.bob, chat=self.chat_bob_arthur)
         message4 = Message(text='hi there4', sender=self.arthur,
@@ -202,10 +238,9 @@ class UserModelTestCase(unittest.TestCase):
 
     def test_chat_two_users_2(self):
         message1 = Message(text='hi there1', sender=self.arthur,
-                           recipient=self.bob, 
-                           was_read=True, chat=self.chat_bob_arthur)
+                           recipient=self.bob, chat=self.chat_bob_arthur)
         message2 = Message(text='hi there2', sender=self.arthur,
-                           recipient=self.bob, was_read=True, chat=self.chat_bob_arthur)
+                           recipient=self.bob, chat=self.chat_bob_arthur)
         message3 = Message(text='hi there3', sender=self.arthur,
                            recipient=self.bob, chat=self.chat_bob_arthur)
         message4 = Message(text='hi there4', sender=self.arthur,
@@ -273,7 +308,7 @@ class UserModelTestCase(unittest.TestCase):
     def test_get_messages(self):
         message1 = Message(text='hi arthur', 
                            sender=self.bob, recipient=self.arthur,
-                           chat=self.chat_bob_arthur, was_read=True)
+                           chat=self.chat_bob_arthur)
         message2 = Message(text='hi bob', 
                            sender=self.arthur, recipient=self.bob,
                            chat=self.chat_bob_arthur)
@@ -286,46 +321,80 @@ class UserModelTestCase(unittest.TestCase):
                             'text':message1.text,
                             'date_created': message1.date_created.isoformat(),
                             'sender_username': message1.sender.username,
-                            'recipient_username': message1.recipient.username
+                            'recipient_username': message1.recipient.username,
+                            'cursor': message1.get_cursor()
                          }
         message_dict_2 = {
                             'text':message2.text,
                             'date_created': message2.date_created.isoformat(),
                             'sender_username': message2.sender.username,
-                            'recipient_username': message2.recipient.username
+                            'recipient_username': message2.recipient.username,
+                            'cursor': message2.get_cursor()
                          }
         message_dict_3 = {
                             'text':message3.text,
                             'date_created': message3.date_created.isoformat(),
                             'sender_username': message3.sender.username,
-                            'recipient_username': message3.recipient.username
+                            'recipient_username': message3.recipient.username,
+                            'cursor': message3.get_cursor()
                          }        
-        messages = self.bob.get_messages(self.chat_bob_arthur)
+        messages, has_more = self.bob.get_messages(self.chat_bob_arthur)
+        self.assertFalse(has_more)
         self.assertIn(message_dict_1, messages)
         self.assertIn(message_dict_2, messages)
         self.assertIn(message_dict_3, messages)
         self.assertEqual(len(messages), 3)
 
+    def test_get_messages_query_count(self):
+        self.app.config['MESSAGES_PER_PAGE'] = 500
+        database.session.add_all(
+            [Message(text=f'message {number}',
+                     sender=(self.bob, self.arthur)[number % 2],
+                     recipient=(self.arthur, self.bob)[number % 2],
+                     chat=self.chat_bob_arthur)
+             for number in range(500)])
+        database.session.commit()
+        chat_id = self.chat_bob_arthur.id
+        bob_id = self.bob.id
+        database.session.expunge_all()
+        chat = Chat.query.get(chat_id)
+        bob = User.query.get(bob_id)
+        with QueryCounter() as counter:
+            messages, has_more = bob.get_messages(chat)
+        self.assertEqual(len(messages), 500)
+        self.assertEqual(counter.count, 1)
+        # a history of exactly one page has nothing more
+        self.assertFalse(has_more)
+        messages, has_more = bob.get_messages(chat,
+                                              before=messages[0]['cursor'])
+        self.assertEqual(messages, [])
+        self.assertFalse(has_more)
+
     def test_get_unread_messages_query(self):
         message_1 = Message(text='hi arthur', 
                            sender=self.bob, recipient=self.arthur,
-                           chat=self.chat_bob_arthur, was_read=True)
+                           chat=self.chat_bob_arthur)
         message_2 = Message(text='hi bob', 
                            sender=self.arthur, recipient=self.bob,
                            chat=self.chat_bob_arthur)
+        database.session.add_all([message_1, message_2])
+        database.session.commit()
+        self.bob.mark_chat_as_read(self.chat_bob_arthur)
         message_3 = Message(text='what\'s up', 
                            sender=self.arthur, recipient=self.bob,
                            chat=self.chat_bob_arthur)
         message_4 = Message(text='see you', 
                            sender=self.arthur, recipient=self.bob,
-                           chat=self.chat_bob_arthur, was_read=True)
-        database.session.add_all([message_1, message_2, 
-                                  message_3, message_4])
-        database.session.commit()  
+                           chat=self.chat_bob_arthur)
+        message_5 = Message(text='bye', 
+                           sender=self.bob, recipient=self.arthur,
+                           chat=self.chat_bob_arthur)
+        database.session.add_all([message_3, message_4, message_5])
+        database.session.commit()
         messages = self.bob.get_unread_messages_query(self.chat_bob_arthur)
-        self.assertIn(message_2, messages.all())
-        self.assertIn(message_3, messages.all())
-        self.assertEqual(len(messages.all()), 2)
+        self.assertEqual(set(messages.all()), {message_3, message_4})
+        messages = self.arthur.get_unread_messages_query(self.chat_bob_arthur)
+        self.assertEqual(set(messages.all()), {message_1, message_5})
 
     def test_search_users_query(self):
         other_users_query = self.bob.get_other_users_query()
@@ -352,3 +421,304 @@ class UserModelTestCase(unittest.TestCase):
                          .bob
                          .search_users_query('art', other_users_query)
                          .count(), 2)
+        self.assertEqual(self
+                         .bob
+                         .search_users_query('or', other_users_query)
+                         .all(),
+                         [artorias, self.morgana])
+
+    def test_search_users_page(self):
+        artorias = User(username='artorias',
+                        password='artorias',
+                        email='artorias@artorias.artorias',
+                        confirmed=True)
+        database.session.add(artorias)
+        database.session.commit()
+        self.assertEqual(self.bob.search_users_page('art', 1, 10),
+                         [(self.arthur.id, 'arthur'),
+                          (artorias.id, 'artorias')])
+        self.assertEqual(self.bob.search_users_page('art', 2, 1),
+                         [(artorias.id, 'artorias')])
+        self.assertEqual(self.bob.search_users_page('bob', 1, 10), [])
+        self.assertEqual(self.bob.search_users_page('or', 1, 10),
+                         [(artorias.id, 'artorias'),
+                          (self.morgana.id, 'morgana')])
+        self.assertEqual(self.bob.search_users_page('or', 2, 1),
+                         [(self.morgana.id, 'morgana')])
+        self.assertEqual(self.bob.search_users_page('o', 1, 10),
+                         [(self.ophelia.id, 'ophelia'),
+                          (artorias.id, 'artorias'),
+                          (self.morgana.id, 'morgana')])
+        self.assertEqual(self.bob.search_users_page('o', 2, 2),
+                         [(self.morgana.id, 'morgana')])
+        username_prefixes.disable()
+        self.assertEqual(self.bob.search_users_page('o', 1, 2),
+                         [(self.ophelia.id, 'ophelia'),
+                          (artorias.id, 'artorias')])
+
+    def test_search_users_page_disabled_index(self):
+        self.app.config['USERNAME_INDEX_MAX_SIZE'] = 1
+        username_prefixes.init_app(self.app)
+        username_prefixes.refresh_interval = 0
+        self.assertEqual(self.bob.search_users_page('or', 1, 10),
+                         [(self.morgana.id, 'morgana')])
+        self.assertFalse(username_prefixes.enabled)
+        with QueryCounter() as counter:
+            self.assertEqual(self.bob.search_users_page('or', 1, 10),
+                             [(self.morgana.id, 'morgana')])
+        self.assertEqual(counter.count, 1)
+        self.assertFalse(any('users.id >' in statement
+                             for statement in counter.statements))
+
+    def test_refresh_username_prefixes(self):
+        self.assertEqual(self.bob.search_users_page('gw', 1, 10), [])
+        gwyn = User(username='gwyn', password='gwyn',
+                    email='gwyn@gwyn.gwyn', confirmed=True)
+        database.session.add(gwyn)
+        database.session.commit()
+        self.assertEqual(self.bob.search_users_page('gw', 1, 10), [])
+        username_prefixes.refresh_interval = 0
+        self.assertEqual(self.bob.search_users_page('gw', 1, 10),
+                         [(gwyn.id, 'gwyn')])
+
+    def test_load_user(self):
+        bob_id = self.bob.id
+        principal = load_user(str(bob_id))
+        self.assertIsInstance(principal, UserPrincipal)
+        self.assertEqual(principal, self.bob)
+        self.assertEqual(principal.email, 'bob@bob.bob')
+        self.assertFalse(principal.is_admin)
+        database.session.remove()
+        with QueryCounter() as counter:
+            principal = load_user(str(bob_id))
+            self.assertTrue(principal.is_authenticated)
+            self.assertTrue(principal.confirmed)
+            self.assertEqual(principal.username, 'bob')
+            self.assertFalse(principal.has_permission(Permission
+                                                      .ADMINISTRATION))
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(principal.get_user().id, bob_id)
+        self.assertIsNone(load_user('0'))
+
+    def test_load_user_invalidation(self):
+        bob_id = self.bob.id
+        load_user(str(bob_id))
+        self.assertIsNotNone(user_principal_cache.get((bob_id,)))
+        self.bob.password = 'new password'
+        database.session.commit()
+        self.assertIsNone(user_principal_cache.get((bob_id,)))
+        load_user(str(bob_id))
+        admin_role = Role.query.filter_by(name='Admin').first()
+        self.bob.role = admin_role
+        database.session.commit()
+        self.assertIsNone(user_principal_cache.get((bob_id,)))
+        self.assertTrue(load_user(str(bob_id)).is_admin)
+        admin_role.permissions = 0
+        database.session.commit()
+        self.assertFalse(load_user(str(bob_id)).is_admin)
+        self.bob.confirmed = False
+        database.session.commit()
+        self.assertFalse(load_user(str(bob_id)).confirmed)
+        self.assertIsNone(user_principal_cache.get((bob_id,)))
+
+    def test_verify_auth_token(self):
+        bob_id = self.bob.id
+        token = self.bob.generate_auth_token()
+        self.assertEqual(User.verify_auth_token(token).id, bob_id)
+        database.session.remove()
+        with QueryCounter() as counter:
+            principal = User.verify_auth_token(token.decode())
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(principal.username, 'bob')
+        self.assertIsNone(User.verify_auth_token('wrong'))
+        self.assertIsNone(User.verify_auth_token(token[:-1]))
+        confirmation_token = User.query.get(bob_id).generate_confirmation_token()
+        self.assertIsNone(User.verify_auth_token(confirmation_token))
+
+    def test_auth_token_cache_expiration(self):
+        token = self.bob.generate_auth_token(expiration=1)
+        self.assertIsNotNone(User.verify_auth_token(token))
+        self.assertEqual(len(auth_token_cache.entries), 1)
+        time.sleep(2)
+        self.assertIsNone(User.verify_auth_token(token))
+        self.assertEqual(len(auth_token_cache.entries), 0)
+
+    def test_password_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        user = User(username='gwyn', password='gwyn', email='gwyn@gwyn.gwyn')
+        old_hash = user.password_hash
+        self.assertTrue(old_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(needs_rehash(old_hash))
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+        self.assertTrue(needs_rehash(old_hash))
+        self.assertFalse(user.verify_password('wrong'))
+        self.assertEqual(user.password_hash, old_hash)
+        self.assertTrue(user.verify_password('gwyn'))
+        self.assertNotEqual(user.password_hash, old_hash)
+        self.assertFalse(needs_rehash(user.password_hash))
+        self.assertTrue(user.verify_password('gwyn'))
+
+    def test_verify_credentials(self):
+        bob_id = self.bob.id
+        self.assertIsNone(User.verify_credentials('bob@bob.bob', 'wrong'))
+        self.assertIsNone(User.verify_credentials('nobody@bob.bob', 'bob'))
+        self.assertEqual(User.verify_credentials('bob@bob.bob', 'bob').id,
+                         bob_id)
+        database.session.remove()
+        with QueryCounter() as counter:
+            principal = User.verify_credentials('bob@bob.bob', 'bob')
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(principal.id, bob_id)
+        self.assertIn('bob@bob.bob', credentials_cache.groups)
+        bob = User.query.get(bob_id)
+        bob.password = 'new password'
+        database.session.commit()
+        self.assertNotIn('bob@bob.bob', credentials_cache.groups)
+        self.assertIsNone(User.verify_credentials('bob@bob.bob', 'bob'))
+
+    def test_get_updated_chats(self):
+        self.assertIsNone(self.bob.get_updated_chats())
+        message_1 = Message(text='hi bob', 
+                            sender=self.arthur, recipient=self.bob,
+                            chat=self.chat_bob_arthur)
+        message_2 = Message(text='what\'s up', 
+                            sender=self.arthur, recipient=self.bob,
+                            chat=self.chat_bob_arthur)
+        message_3 = Message(text='hi clair', 
+                            sender=self.bob, recipient=self.clair,
+                            chat=self.chat_bob_clair)
+        message_4 = Message(text='hi bob', 
+                            sender=self.morgana, recipient=self.bob,
+                            chat=self.chat_morgana_bob)
+        database.session.add_all([message_1, message_2, 
+                                  message_3, message_4])
+        for message in (message_1, message_2, message_3, message_4):
+            message.chat.increment_unread_counts(message.sender)
+        database.session.commit()
+        data = self.bob.get_updated_chats(self.chat_bob_arthur.id)
+        self.assertEqual(data['current_username'], self.bob.username)
+        chats = {chat['chat_id']: chat for chat in data['chats']}
+        self.assertEqual(set(chats), {str(self.chat_bob_arthur.id),
+                                      str(self.chat_morgana_bob.id)})
+        chat = chats[str(self.chat_bob_arthur.id)]
+        self.assertEqual(chat['unread_messages_count'], 2)
+        self.assertEqual(chat['chat_name'], self.arthur.username)
+        chat = chats[str(self.chat_morgana_bob.id)]
+        self.assertEqual(chat['unread_messages_count'], 1)
+        self.assertEqual(chat['chat_name'], self.morgana.username)
+        self.assertEqual([message['text'] 
+                          for message in data['current_chat_messages']],
+                         [message_1.text, message_2.text])
+
+    def test_get_updated_chats_query_count(self):
+        def count_queries():
+            with QueryCounter() as counter:
+                self.bob.get_updated_chats()
+            return counter.count
+
+        for number in range(20):
+            user = User(username=f'user{number}', 
+                        email=f'user{number}@user.user',
+                        password_hash='hash')
+            chat = Chat()
+            chat.add_users([self.bob, user])
+            database.session.add(Message(text='hi', sender=user,
+                                         recipient=self.bob, chat=chat))
+            chat.increment_unread_counts(user)
+            if number == 1:
+                database.session.commit()
+                count_few_chats = count_queries()
+        database.session.commit()
+        self.assertEqual(count_queries(), count_few_chats)
+
+    def test_get_chat_summaries_query(self):
+        message_1 = Message(text='hi bob', 
+                            sender=self.arthur, recipient=self.bob,
+                            chat=self.chat_bob_arthur)
+        message_2 = Message(text='hi clair', 
+                            sender=self.bob, recipient=self.clair,
+                            chat=self.chat_bob_clair)
+        database.session.add_all([message_1, message_2])
+        for message in (message_1, message_2):
+            message.chat.increment_unread_counts(message.sender)
+        database.session.commit()
+        self.bob.mark_chats_as_removed([self.chat_morgana_bob])
+        summaries = {chat: (name, count) 
+                     for chat, name, count 
+                     in self.bob.get_chat_summaries_query()}
+        self.assertEqual(summaries,
+                         {self.chat_bob_arthur: (self.arthur.username, 1),
+                          self.chat_bob_clair: (self.clair.username, 0)})
+        with QueryCounter() as counter:
+            self.bob.get_chat_summaries_query().limit(10).all()
+        self.assertEqual(counter.count, 1)
+
+    def test_mark_chat_as_read(self):
+        messages = [Message(text=f'hi bob {number}',
+                            sender=self.arthur, recipient=self.bob,
+                            chat=self.chat_bob_arthur)
+                    for number in range(3)]
+        database.session.add_all(messages)
+        for message in messages:
+            self.chat_bob_arthur.increment_unread_counts(self.arthur)
+        database.session.commit()
+        read_state = (ChatReadState
+                      .query
+                      .filter_by(user_id=self.bob.id, 
+                                 chat_id=self.chat_bob_arthur.id)
+                      .first())
+        self.assertEqual(read_state.unread_count, 3)
+        self.assertEqual((ChatReadState
+                          .query
+                          .filter_by(user_id=self.arthur.id,
+                                     chat_id=self.chat_bob_arthur.id)
+                          .first()
+                          .unread_count), 0)
+        self.bob.mark_chat_as_read(self.chat_bob_arthur)
+        database.session.refresh(read_state)
+        self.assertEqual(read_state.unread_count, 0)
+        self.assertEqual(read_state.last_read_message_id, messages[-1].id)
+        self.assertEqual((self
+                          .bob
+                          .get_unread_messages_query(self.chat_bob_arthur)
+                          .count()), 0)
+        self.assertEqual((self
+                          .arthur
+                          .get_unread_messages_query(self.chat_bob_arthur)
+                          .count()), 0)
+
+    def test_mark_chat_as_read_not_member(self):
+        chat = self.chat_bob_arthur
+        self.clair.mark_chat_as_read(chat)
+        self.assertIsNone(self.clair.get_last_read_message_id(chat))
+        chat.increment_unread_counts(self.arthur)
+        database.session.commit()
+        self.assertEqual({read_state.user_id
+                          for read_state in chat.read_states},
+                         {self.bob.id, self.arthur.id})
+        self.assertNotIn(chat,
+                         [summary[0]
+                          for summary
+                          in self.clair.get_chat_summaries_query()])
+
+    def test_mark_chat_as_read_query_count(self):
+        messages = [Message(text=f'hi bob {number}',
+                            sender=self.arthur, recipient=self.bob,
+                            chat=self.chat_bob_arthur)
+                    for number in range(50)]
+        database.session.add_all(messages)
+        database.session.commit()
+        chat = self.chat_bob_arthur
+        database.session.refresh(chat)
+        database.session.refresh(self.bob)
+        with QueryCounter() as counter:
+            self.bob.mark_chat_as_read(chat)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(self.bob.get_last_read_message_id(chat),
+                         messages[-1].id)
+        # no row is created for a user without one
+        database.session.query(ChatReadState).delete()
+        database.session.commit()
+        self.bob.mark_chat_as_read(chat)
+        self.assertIsNone(self.bob.get_last_read_message_id(chat))
+        self.assertEqual(ChatReadState.query.count(), 0)